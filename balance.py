@@ -0,0 +1,22 @@
+"""
+Load balancing for split-frame rendering (see raycl.raycl_multi): each
+frame is cut into bands of rows, one per device, sized by how fast each
+device has been rendering.
+"""
+import numpy
+
+def split_rows(rows, weights):
+    """ split_rows: divide rows into consecutive bands in proportion to
+    weights, returning the (first row, number of rows) of each band. Every
+    band gets at least one row if there are enough to go round, however
+    small its weight, so that a device's speed keeps being measured. """
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    ends = numpy.round(numpy.cumsum(weights) / weights.sum() *
+        rows).astype(int)
+    counts = numpy.diff(numpy.concatenate(([0], ends)))
+    if rows >= len(counts):
+        for i in numpy.nonzero(counts == 0)[0]:
+            counts[numpy.argmax(counts)] -= 1
+            counts[i] = 1
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    return [(int(y), int(n)) for (y, n) in zip(starts, counts)]
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Rendering benchmark: renders scripted camera paths through a set of maps
+at several resolutions and both field-of-view modes, and writes the
+results as JSON so runs can be compared across commits and devices.
+
+    python bench.py --output results.json
+    python bench.py --compare before.json after.json
+"""
+import json
+import math
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import numpy
+
+try:
+    import raycl
+except ImportError:
+    raycl = None
+import raynp
+import testmaps
+import world as wd
+
+MAPS = {
+    "testmap1": testmaps.testmap1,
+    "openmap": testmaps.openmap,
+    "pillarmap": testmaps.pillarmap,
+    "citymap": testmaps.citymap,
+    "portalmap": testmaps.portalmap,
+}
+
+# Camera paths: keyframes of (x, y, z, rot_x, rot_y), with the position
+# given as fractions of the grid size. Poses are linearly interpolated
+# between keyframes over the frames of a run.
+PATHS = {
+    "walk": [(0.05, 0.1, 0.05, math.pi/4, 0.0),
+             (0.5, 0.1, 0.5, math.pi/4, 0.2),
+             (0.95, 0.1, 0.95, math.pi/4, -0.2)],
+    "spin": [(0.5, 0.3, 0.5, 0.0, 0.0),
+             (0.5, 0.3, 0.5, 2*math.pi, 0.0)],
+    "look": [(0.05, 0.1, 0.05, 0.0, -math.pi/2),
+             (0.05, 0.1, 0.05, math.pi, math.pi/2)],
+}
+
+FOVS = {"default": wd.FOV_DEFAULT, "360": wd.FOV_360}
+
+# Resolution at which the numpy renderer estimates voxels traversed and
+# loop iterations per ray, whatever the resolution of the run
+VOXEL_SAMPLE_DIM = (80, 60)
+
+def path_pose(keyframes, world, f):
+    """ path_pose: the camera pose at fraction f (0 to 1) of the way
+    along a path """
+    pos = f * (len(keyframes) - 1)
+    i = min(int(pos), len(keyframes) - 2)
+    s = pos - i
+    (a, b) = (keyframes[i], keyframes[i+1])
+    pose = [a[k] + s * (b[k] - a[k]) for k in xrange(5)]
+    size = (world.x_size(), world.y_size(), world.z_size())
+    return (pose[0] * size[0], pose[1] * size[1], pose[2] * size[2],
+            pose[3], pose[4])
+
+def set_camera(world, pose, fov):
+    cam = world.camera
+    (cam.x, cam.y, cam.z, cam.rot_x, cam.rot_y) = pose
+    (cam.fov, cam.prev_fov, cam.target_fov) = (fov, fov, fov)
+
+def make_renderer(name, tex_dim, world, skip_empty, specialize=True,
+                  autotune=True):
+    if name == "cl":
+        renderer = raycl.raycl_offscreen(tex_dim, world, skip_empty,
+            specialize, autotune)
+    elif name == "multi":
+        renderer = raycl.raycl_multi(tex_dim, world, skip_empty=skip_empty,
+            specialize=specialize, autotune=autotune)
+    else:
+        renderer = raynp.raynp(tex_dim, world, skip_empty)
+    # Every frame is timed, even when the camera hasn't moved
+    renderer.skip_unchanged = False
+    return renderer
+
+def device_info(renderer):
+    if isinstance(renderer, raynp.raynp):
+        return {"name": "numpy", "version": numpy.__version__}
+    if isinstance(renderer, raycl.raycl_multi):
+        return {"devices": [device_info(r) for r in renderer.renderers]}
+    device = renderer.queue.device
+    return {"name": device.name.strip(),
+            "platform": device.platform.name.strip(),
+            "driver": device.driver_version.strip()}
+
+def percentiles(times):
+    ms = numpy.array(times) * 1000.0
+    return {"min": float(ms.min()), "mean": float(ms.mean()),
+            "p50": float(numpy.percentile(ms, 50)),
+            "p90": float(numpy.percentile(ms, 90)),
+            "p99": float(numpy.percentile(ms, 99)),
+            "max": float(ms.max())}
+
+def run(renderer, world, path, fov, frames, warmup, voxel_every):
+    """ run: render one camera path and return its measurements """
+    tex_dim = renderer.tex_dim
+    sampler = raynp.raynp(VOXEL_SAMPLE_DIM, world, renderer.skip_empty)
+    sampler.skip_unchanged = False
+    keyframes = PATHS[path]
+
+    for i in xrange(warmup):
+        set_camera(world, path_pose(keyframes, world, 0.0), FOVS[fov])
+        renderer.execute()
+
+    kernel_times = []
+    voxels = []
+    iterations = []
+    elapsed = 0.0
+    for i in xrange(frames):
+        set_camera(world, path_pose(keyframes, world,
+            i / float(max(frames - 1, 1))), FOVS[fov])
+
+        time_start = time.time()
+        renderer.execute()
+        elapsed += time.time() - time_start
+        kernel_times.append(renderer.kernel_time())
+
+        if i % voxel_every == 0:
+            sampler.execute()
+            voxels.append(sampler.voxels.mean())
+            iterations.append(sampler.iterations.mean())
+
+    rays = tex_dim[0] * tex_dim[1] * frames
+    return {"path": path, "fov": fov,
+            "resolution": "%dx%d" % tex_dim,
+            "frames": frames,
+            "fps": frames / elapsed,
+            "rays_per_s": rays / elapsed,
+            "kernel_ms": percentiles(kernel_times),
+            "voxels_per_ray": float(numpy.mean(voxels)),
+            "iterations_per_ray": float(numpy.mean(iterations))}
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(args):
+    results = {"commit": git_commit(),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "host": platform.node(),
+               "python": platform.python_version(),
+               "renderer": args.renderer,
+               "skip_empty": not args.no_skip,
+               "specialize": not args.no_specialize,
+               "autotune": not args.no_autotune,
+               "runs": []}
+
+    for map_name in args.maps.split(","):
+        for size in args.sizes.split(","):
+            tex_dim = tuple(int(d) for d in size.split("x"))
+            world = MAPS[map_name]()
+            world.physics_on = False
+            renderer = make_renderer(args.renderer, tex_dim, world,
+                not args.no_skip, not args.no_specialize,
+                not args.no_autotune)
+            results["device"] = device_info(renderer)
+
+            for path in args.paths.split(","):
+                for fov in args.fovs.split(","):
+                    r = run(renderer, world, path, fov, args.frames,
+                        args.warmup, args.voxel_every)
+                    r["map"] = map_name
+                    if args.renderer == "cl":
+                        r["launch"] = renderer.launch_config
+                    elif args.renderer == "multi":
+                        r["bands"] = [rows for (y, rows) in renderer.bands]
+                    results["runs"].append(r)
+                    print "%-10s %-5s %-8s %9s %8.2f fps %12.0f rays/s " \
+                          "p50 %7.2f ms %6.2f voxels/ray %6.2f " \
+                          "iterations/ray" % (map_name, path, fov,
+                          r["resolution"], r["fps"], r["rays_per_s"],
+                          r["kernel_ms"]["p50"], r["voxels_per_ray"],
+                          r["iterations_per_ray"])
+
+    if args.output is not None:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+def startup(args):
+    """ startup: time from creating the renderer to its first finished
+    frame, first with an empty program cache and then with a warm one """
+    results = {"commit": git_commit(),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "host": platform.node(),
+               "startup": []}
+    world = MAPS[args.maps.split(",")[0]]()
+    world.physics_on = False
+    tex_dim = tuple(int(d) for d in args.sizes.split(",")[0].split("x"))
+
+    cache_dir = raycl.CACHE_DIR
+    raycl.CACHE_DIR = tempfile.mkdtemp()
+    try:
+        for run in ("cold", "warm"):
+            time_start = time.time()
+            renderer = make_renderer("cl", tex_dim, world, not args.no_skip,
+                not args.no_specialize, not args.no_autotune)
+            renderer.execute()
+            first_frame = time.time() - time_start
+            results["device"] = device_info(renderer)
+            # Autotuning builds a variant per launch candidate, so every
+            # variant built counts, not just the one the frame ran with
+            results["startup"].append({"run": run,
+                "cached": renderer.variants_built == 0,
+                "variants_built": renderer.variants_built,
+                "variants_cached": renderer.variants_cached,
+                "build_s": renderer.build_time,
+                "first_frame_s": first_frame})
+            print "%s: %d program variants built and %d loaded in " \
+                "%.3f s, first frame after %.3f s" % (run,
+                renderer.variants_built, renderer.variants_cached,
+                renderer.build_time, first_frame)
+    finally:
+        shutil.rmtree(raycl.CACHE_DIR)
+        raycl.CACHE_DIR = cache_dir
+
+    if args.output is not None:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+def run_key(r):
+    return (r["map"], r["path"], r["fov"], r["resolution"])
+
+def compare(before_fname, after_fname):
+    """ compare: print the change in median kernel time and throughput
+    between two result files, for every run they have in common """
+    before = json.load(open(before_fname))
+    after = json.load(open(after_fname))
+    runs = dict((run_key(r), r) for r in before["runs"])
+    for r in after["runs"]:
+        b = runs.get(run_key(r))
+        if b is None:
+            continue
+        print "%-10s %-5s %-8s %9s p50 %7.2f -> %7.2f ms (%+6.1f%%) " \
+              "rays/s %+6.1f%%" % (run_key(r) + (b["kernel_ms"]["p50"],
+              r["kernel_ms"]["p50"],
+              100.0 * (r["kernel_ms"]["p50"] / b["kernel_ms"]["p50"] - 1),
+              100.0 * (r["rays_per_s"] / b["rays_per_s"] - 1)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fishpye benchmark")
+    parser.add_argument("--renderer", choices=["cl", "multi", "numpy"],
+        default="cl" if raycl is not None else "numpy")
+    parser.add_argument("--maps", default=",".join(sorted(MAPS)),
+        help="comma-separated map names (default: all)")
+    parser.add_argument("--paths", default=",".join(sorted(PATHS)),
+        help="comma-separated camera paths (default: all)")
+    parser.add_argument("--fovs", default="default,360",
+        help="comma-separated FOV modes (default: default,360)")
+    parser.add_argument("--sizes", default="320x240,640x480",
+        help="comma-separated resolutions")
+    parser.add_argument("--frames", type=int, default=60,
+        help="frames rendered along each path")
+    parser.add_argument("--warmup", type=int, default=3,
+        help="untimed frames before each run")
+    parser.add_argument("--voxel-every", type=int, default=10,
+        help="estimate voxels and iterations per ray on every Nth frame")
+    parser.add_argument("--no-skip", action="store_true",
+        help="disable empty-space skipping")
+    parser.add_argument("--no-specialize", action="store_true",
+        help="use one kernel for every map instead of building variants "
+             "with the map's size, edge type and portal count built in")
+    parser.add_argument("--no-autotune", action="store_true",
+        help="launch with the driver's choice of work-group size instead "
+             "of tuning the launch configuration for the device")
+    parser.add_argument("--output", metavar="FILE",
+        help="write the results to FILE as JSON")
+    parser.add_argument("--compare", nargs=2, metavar="FILE",
+        help="compare two result files instead of running")
+    parser.add_argument("--startup", action="store_true",
+        help="time startup to the first frame of the first map and size, "
+             "with a cold and then a warm program cache")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+    elif args.startup:
+        startup(args)
+    else:
+        benchmark(args)
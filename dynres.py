@@ -0,0 +1,60 @@
+"""
+Adaptive render resolution: picks how much of the texture to render
+into from measured kernel times, so frames stay within a time budget when
+the view gets expensive (e.g. in the 360 degree FOV) and go back to full
+resolution when there is headroom again. The window scales the rendered
+part of the texture up to fill the screen.
+"""
+import numpy
+
+# Render scales the controller steps between, from full resolution down
+SCALES = (1.0, 0.85, 0.7, 0.6, 0.5, 0.4, 0.3, 0.25)
+
+def render_dim(tex_dim, scale):
+    """ render_dim: the size of the part of a tex_dim texture rendered
+    at scale """
+    return (max(1, int(round(tex_dim[0] * scale))),
+            max(1, int(round(tex_dim[1] * scale))))
+
+class resolution_controller(object):
+    """
+    Decides the render scale from the kernel time of each frame. It
+    waits for `window' frames at a scale and goes by their median, so a
+    single slow frame doesn't change anything. It steps down when over
+    budget, but only steps up when the time at the next scale (which
+    grows with the number of pixels) is predicted to fit within
+    `headroom' of the budget - the gap between the two keeps it from
+    oscillating between neighbouring scales.
+    """
+    def __init__(self, tex_dim, budget, window=8, headroom=0.8):
+        self.tex_dim = tex_dim
+        self.budget = budget # s
+        self.window = window
+        self.headroom = headroom
+        self.level = 0
+        self.times = []
+
+    def scale(self):
+        return SCALES[self.level]
+
+    def render_dim(self):
+        return render_dim(self.tex_dim, self.scale())
+
+    def render_dims(self):
+        """ render_dims: every size the controller may render at """
+        return [render_dim(self.tex_dim, scale) for scale in SCALES]
+
+    def update(self, kernel_time):
+        """ update: record the kernel time of a frame rendered at the
+        current scale, and return the render size for the next frame """
+        self.times.append(kernel_time)
+        if len(self.times) >= self.window:
+            t = numpy.median(self.times)
+            self.times = []
+            if t > self.budget and self.level < len(SCALES) - 1:
+                self.level += 1
+            elif self.level > 0:
+                up = (SCALES[self.level - 1] / SCALES[self.level]) ** 2
+                if t * up < self.budget * self.headroom:
+                    self.level -= 1
+        return self.render_dim()
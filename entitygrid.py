@@ -0,0 +1,184 @@
+"""
+The index the renderers use to draw entities. Entities are drawn as
+spheres, and rather than every ray being tested against every one of
+them, they are binned each frame by the bricks of the map that their
+bounding boxes overlap, so that a ray only looks at the spheres binned in
+the bricks it passes through (see ray_entities in raytrace.cl). Rendering
+cost then follows the entities rays pass near, however many there are.
+
+The grid is kept in compact arrays:
+    index    a uint32 per brick, laid out like brick_index: the bin of
+             the entities in the brick, or 0 for none
+    bins     (start, count) of each bin's spheres, with bin 0 empty
+    spheres  (x, y, z, radius) of each entity in each bin it is in,
+             sorted by bin
+    dist     a uint8 per brick: the Chebyshev distance (in bricks) to the
+             nearest brick with a bin, or MAX_BRICK_DIST where the brick
+             distance field is no bigger anyway, so that empty-space
+             skipping (which goes by the smaller of the two) never jumps
+             over an entity
+They are only rebuilt when the entities or the map have changed.
+"""
+import numpy
+
+import world as wd
+
+class entity_grid(object):
+    def __init__(self, world):
+        self.world = world
+        self.index = numpy.zeros(0, dtype=numpy.uint32)
+        # Bricks with a bin, sorted
+        self.occupied = numpy.zeros(0, dtype=numpy.int64)
+        self.bins = numpy.zeros((1,2), dtype=numpy.uint32)
+        self.spheres = numpy.zeros((1,4), dtype=numpy.float32)
+        self.dist = numpy.zeros(0, dtype=numpy.uint8)
+        # world.brick_dist_version dist was worked out for
+        self.dist_version = None
+        self.key = None
+        # entity_buffers to tell about changes
+        self.uploads = []
+
+    def init_cldata(self, ctx):
+        """ init_cldata: copy the grid to the device, returning the
+        entity_buffers that keep it up to date """
+        bufs = entity_buffers(self, ctx)
+        self.uploads.append(bufs)
+        return bufs
+
+    def entity_spheres(self):
+        """ entity_spheres: the (N,4) float32 spheres (x, y, z, radius) of
+        the entities to draw: the crowd, and the player if there are
+        portals to see them through (from anywhere else the camera is
+        inside them) """
+        world = self.world
+        crowd = world.crowd
+        spheres = numpy.empty((len(crowd), 4), dtype=numpy.float32)
+        spheres[:,0:3] = crowd.pos
+        spheres[:,3] = crowd.radius
+        if world.portal_count() > 0:
+            p = world.player
+            spheres = numpy.concatenate((spheres, numpy.array(
+                [(p.x, p.y, p.z, p.radius)], dtype=numpy.float32)))
+        return spheres
+
+    def update(self):
+        """ update: rebuild the grid if the entities or the map have
+        changed since it was last built """
+        world = self.world
+        p = world.player
+        key = (world.map_version, world.crowd.version,
+            (p.x, p.y, p.z, p.radius) if world.portal_count() > 0 else None)
+        # Bricks being loaded into a streaming world change the brick
+        # distances dist is bounded by without changing map_version
+        world.brick_distances()
+        if key == self.key and world.brick_dist_version == self.dist_version:
+            return
+        self.key = key
+
+        info = world.mapinfo
+        n_bricks = numpy.array([info[wd.MI_BRICKS_X], info[wd.MI_BRICKS_Y],
+            info[wd.MI_BRICKS_Z]], dtype=numpy.int64)
+        spheres = self.entity_spheres()
+        (brick, entity) = self.bin_entities(spheres, n_bricks)
+        order = numpy.argsort(brick, kind='mergesort')
+        (occupied, start, count) = numpy.unique(brick[order],
+            return_index=True, return_counts=True)
+
+        n_index = int(numpy.prod(n_bricks))
+        if len(self.index) != n_index:
+            self.index = numpy.zeros(n_index, dtype=numpy.uint32)
+            for bufs in self.uploads:
+                bufs.mark_all('index')
+        else:
+            self.index[self.occupied] = 0
+            for bufs in self.uploads:
+                for row in numpy.union1d(self.occupied, occupied):
+                    bufs.mark('index', row)
+        self.index[occupied] = numpy.arange(1, len(occupied) + 1)
+
+        self.bins = numpy.zeros((len(occupied) + 1, 2), dtype=numpy.uint32)
+        self.bins[1:,0] = start
+        self.bins[1:,1] = count
+        # Never empty, as there are no empty device buffers
+        self.spheres = numpy.zeros((max(len(brick), 1), 4),
+            dtype=numpy.float32)
+        self.spheres[0:len(brick)] = spheres[entity[order]]
+
+        if (world.brick_dist_version != self.dist_version or
+                not numpy.array_equal(occupied, self.occupied)):
+            self.dist_version = world.brick_dist_version
+            self.dist = self.entity_distances(occupied, n_bricks)
+            for bufs in self.uploads:
+                bufs.mark_all('dist')
+        self.occupied = occupied
+        for bufs in self.uploads:
+            bufs.mark_all('bins')
+            bufs.mark_all('spheres')
+
+    def bin_entities(self, spheres, n_bricks):
+        """ bin_entities: (brick, entity) pairs of the offset of each brick
+        that the bounding box of each sphere overlaps, and the sphere's
+        row in spheres """
+        c = spheres[:,0:3].astype(numpy.float64)
+        r = spheres[:,3:4].astype(numpy.float64)
+        lo = numpy.floor(c - r).astype(numpy.int64)
+        hi = numpy.floor(c + r).astype(numpy.int64)
+        size = n_bricks << wd.BRICK_SHIFT
+        # Rays only look for entities inside the grid
+        inside = numpy.all((hi >= 0) & (lo < size), axis=1)
+        (lo, hi) = (numpy.clip(lo[inside], 0, size - 1) >> wd.BRICK_SHIFT,
+                    numpy.clip(hi[inside], 0, size - 1) >> wd.BRICK_SHIFT)
+        ids = numpy.nonzero(inside)[0]
+
+        brick = []
+        entity = []
+        span = (hi - lo).max(axis=0) if len(ids) else (0, 0, 0)
+        for dz in xrange(span[2] + 1):
+            for dy in xrange(span[1] + 1):
+                for dx in xrange(span[0] + 1):
+                    d = numpy.array([dx, dy, dz])
+                    sel = numpy.all(lo + d <= hi, axis=1)
+                    b = lo[sel] + d
+                    brick.append(b[:,0] + (b[:,1] + b[:,2] * n_bricks[1]) *
+                        n_bricks[0])
+                    entity.append(ids[sel])
+        return (numpy.concatenate(brick).astype(numpy.int64),
+                numpy.concatenate(entity).astype(numpy.int64))
+
+    def entity_distances(self, occupied, n_bricks):
+        """ entity_distances: the dist array for the bricks with bins in
+        occupied (see the top of this file) """
+        shape = (n_bricks[2], n_bricks[1], n_bricks[0])
+        brick_dist = self.world.brick_distances().reshape(shape)
+        reached = numpy.zeros(shape, dtype=bool)
+        reached.flat[occupied] = True
+        dist = numpy.where(reached, 0, wd.MAX_BRICK_DIST).astype(
+            numpy.uint8)
+        # Grow the bricks with bins as world.brick_distances grows the
+        # non-empty ones, until every brick grown to is at least as far
+        # from an entity as from the map: past there the brick distance
+        # is no bigger, as it changes by at most one from brick to brick
+        for d in xrange(1, wd.MAX_BRICK_DIST):
+            grown = reached.copy()
+            for axis in xrange(3):
+                a = numpy.swapaxes(grown, 0, axis)
+                a[1:] |= a[:-1].copy()
+                a[:-1] |= a[1:].copy()
+            grown &= ~reached
+            if not (grown & (brick_dist > d)).any():
+                break
+            dist[grown] = d
+            reached |= grown
+        return dist.ravel()
+
+class entity_buffers(wd.map_buffers):
+    """
+    The OpenCL copies of an entity_grid's arrays, kept up to date the
+    same way as the map's.
+    """
+    # In the order the raytrace kernel takes them
+    ARRAYS = ('index', 'bins', 'spheres', 'dist')
+
+    def host_array(self, name):
+        # self.world is the entity_grid
+        return getattr(self.world, name)
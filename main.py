@@ -2,25 +2,51 @@
 import sys
 import numpy
 import ctypes
+import argparse
 import datetime
 
-from OpenGL.GL import *
-from OpenGL.GLU import *
-from OpenGL.GLUT import *
-
-import raycl
+try:
+    from OpenGL.GL import *
+    from OpenGL.GLU import *
+    from OpenGL.GLUT import *
+except ImportError:
+    # Only --headless mode can run without PyOpenGL
+    pass
+
+try:
+    import raycl
+except ImportError:
+    # No OpenCL: fall back to the numpy renderer
+    raycl = None
+import raynp
+import dynres
+import profiler
+import replay
+import simulation
+import streaming
 import testmaps
 
+# The numpy renderer is far slower than OpenCL, so it gets a smaller
+# texture
+TEX_DIM = {"cl": (640,480), "numpy": (160,120)}
+
 class window(object):
-    def __init__(self, unlimited, *args, **kwargs):
+    def __init__(self, unlimited, renderer="cl", crowd=0, pipeline=1,
+                 budget=None, reproject=False, multi_device=False,
+                 profile_csv=None, heatmap=False, map_file=None,
+                 stream=False, record=None, replay_file=None,
+                 replay_dt=None, *args, **kwargs):
         self.width = 640
         self.height = 480
         self.cx = self.width / 2
         self.cy = self.height / 2
 
-        self.tex_dim = (640,480)
+        self.tex_dim = TEX_DIM[renderer]
 
         self.count_to_30 = 0
+        # Timings of every frame, shown in an overlay toggled with 't'
+        self.profiler = profiler.frame_profiler(csv_file=profile_csv)
+        self.show_profile = False
 
         glutInit(sys.argv)
         glutInitDisplayMode(GLUT_RGBA | GLUT_DOUBLE | GLUT_DEPTH)
@@ -39,21 +65,77 @@ class window(object):
         glutMouseFunc(self.on_click)
         glutPassiveMotionFunc(self.on_mouse_motion)
 
-        # Limit to 50fps
+        # Limit to 50fps; frames are also never asked for faster than
+        # the device renders them (see timer)
         self.time_limit = 20 if not unlimited else 1
+        self.gpu_time = 0.0
         self.last_tick = datetime.datetime.now()
         glutTimerFunc(self.time_limit, self.timer, 0)
 
         # set up OpenGL scene
         self.glinit()
 
-        # set up world for the game
-        self.world = testmaps.testmap1()
+        # Input is either recorded to a file as it is sent to the world,
+        # or replayed from one in place of the live input and timing
+        self.recorder = None
+        self.script = None
+        self.replay_dt = replay_dt
+        if replay_file is not None:
+            (setup, self.script) = replay.load(replay_file)
+            (map_file, stream, crowd) = (setup["map"], setup["stream"],
+                setup["crowd"])
+        elif record is not None:
+            self.recorder = replay.recorder(record,
+                {"map": map_file, "stream": stream, "crowd": crowd})
+
+        # set up world for the game; a streamed map is loaded the same
+        # way every time it is recorded or replayed
+        self.world = make_world(map_file, stream, background=(
+            self.recorder is None and self.script is None))
+        self.stream = stream
+        self.world.crowd.scatter(crowd, 1.5, .40)
+        # The world is advanced in fixed steps, each of which is sent
+        # (and so recorded) or replayed as a frame of the script
+        if self.script is not None:
+            self.sim = simulation.fixed_timestep(self.world,
+                self.play_step)
+        else:
+            self.sim = simulation.fixed_timestep(self.world,
+                lambda dt: self.send("advance", dt))
 
-        # set up display texture and opencl
+        # set up display texture and renderer
         self.texture = self.create_blank_texture()
-        self.raycl = raycl.raycl(self.texture, self.tex_dim,
-            self.world)
+        # With a pipeline, frames render into a ring of textures while
+        # the world moves on
+        self.pipelined = renderer == "cl" and pipeline > 1
+        if renderer == "cl" and multi_device:
+            self.pipelined = False
+            self.renderer = raycl.raycl_multi(self.tex_dim, self.world)
+        elif self.pipelined:
+            textures = [self.texture] + [self.create_blank_texture()
+                for i in xrange(pipeline - 1)]
+            self.renderer = raycl.raycl_pipelined(textures, self.tex_dim,
+                self.world, reproject=reproject)
+        elif renderer == "cl":
+            self.renderer = raycl.raycl(self.texture, self.tex_dim,
+                self.world, reproject=reproject)
+        else:
+            self.renderer = raynp.raynp(self.tex_dim, self.world)
+        # Renderers without GL interop hand back frames to upload
+        self.multi_device = renderer == "cl" and multi_device
+        self.upload_frames = renderer != "cl" or self.multi_device
+        self.reproject = (renderer == "cl" and reproject and
+            not self.multi_device)
+        # Toggled with 'h'
+        self.renderer.set_heatmap(heatmap)
+
+        # Adaptive resolution, to keep the kernel time within budget ms
+        self.controller = None
+        if budget is not None:
+            self.controller = dynres.resolution_controller(self.tex_dim,
+                budget / 1000.0)
+            if renderer == "cl":
+                self.renderer.build_variants(self.controller.render_dims())
 
     def create_blank_texture(self):
         tex_buf = (ctypes.c_char_p(
@@ -88,30 +170,65 @@ class window(object):
         dt = (t - self.last_tick).total_seconds() * 1000.0
         self.last_tick = t
 
-        # Set up timer again
-        glutTimerFunc(self.time_limit, self.timer, foo)
+        # Set up timer again, for no sooner than the last frame took the
+        # device to render, so that frames don't queue up behind it
+        glutTimerFunc(max(self.time_limit, int(self.gpu_time * 1000)),
+            self.timer, foo)
+
+        if self.script == []:
+            print "replay finished"
+            self.quit()
 
-        # Update world by calculated time difference & display
-        self.world.advance(dt)
+        # Catch the world up on the time that has passed & display
+        with self.profiler.timed("advance"):
+            self.sim.advance(dt)
         glutPostRedisplay()
 
+    def play_step(self, dt):
+        """ play_step: advance the world by the next frame of the script
+        being replayed, if there is one left """
+        if self.script:
+            replay.play_frame(self.world, self.script.pop(0),
+                self.replay_dt)
+
+    def send(self, event, *args):
+        """ send: pass live input (or a time step) on to the world,
+        recording it if recording; while replaying, there is none """
+        if self.script is not None:
+            return
+        if self.recorder is not None:
+            self.recorder.record(event, *args)
+        replay.send(self.world, event, args)
+
+    def quit(self):
+        self.profiler.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.world.close()
+        sys.exit()
+
     def on_key_down(self, key, x, y):
         ESCAPE = '\033'
         if key == ESCAPE or key == 'q':
-            sys.exit()
+            self.quit()
         else:
-            self.world.send_key_down(key, x, y)
+            if key == 't':
+                self.show_profile = not self.show_profile
+            if key == 'h':
+                # Show how many iterations each pixel's ray took instead
+                self.renderer.set_heatmap(not self.renderer.heatmap)
+            self.send("key_down", key, x, y)
 
     def on_key_up(self, key, x, y):
-        self.world.send_key_up(key, x, y)
+        self.send("key_up", key, x, y)
 
     def on_click(self, button, state, x, y):
-        self.world.send_click(button, state, x, y)
+        self.send("click", button, state, x, y)
 
     def on_mouse_motion(self, x, y):
         if x != self.cx and y != self.cy:
             if not self.skip_first_motion:
-                self.world.send_mouse_motion(x - self.cx, y - self.cy)
+                self.send("motion", x - self.cx, y - self.cy)
             else:
                 self.skip_first_motion = False
             self.reset_pointer()
@@ -128,22 +245,48 @@ class window(object):
             self.time_start = datetime.datetime.now()
         
         try:
-            self.raycl.execute()
+            # When nothing has changed, no new frame is rendered and the
+            # last one is drawn again. The camera is drawn in between
+            # simulation steps.
+            with self.sim.interpolated():
+                if self.pipelined:
+                    rendered = self.renderer.submit()
+                    texture = self.renderer.present()
+                    render_dim = self.renderer.shown_dim
+                else:
+                    rendered = self.renderer.execute()
+                    texture = self.texture
+                    render_dim = self.renderer.render_dim
+            if rendered:
+                for (stage, t) in self.renderer.stage_times().items():
+                    self.profiler.record(stage, t)
+                self.gpu_time = self.renderer.kernel_time()
+            if self.upload_frames and rendered:
+                with self.profiler.timed("draw"):
+                    self.upload_texture(self.renderer.read_frame())
+            if self.controller is not None and rendered:
+                self.renderer.set_render_dim(self.controller.update(
+                    self.renderer.kernel_time()))
         except:
             import traceback
             traceback.print_exc()
             sys.exit(1)
 
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
+        with self.profiler.timed("draw"):
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            glMatrixMode(GL_MODELVIEW)
+            glLoadIdentity()
 
-        self.draw_texture()
-        if self.count_to_30 < 15:
-            self.draw_axes()
+            self.draw_texture(texture, render_dim)
+            if self.count_to_30 < 15:
+                self.draw_axes()
+            if self.show_profile:
+                self.draw_profile()
 
-        glutSwapBuffers()
+        with self.profiler.timed("swap"):
+            glutSwapBuffers()
 
+        self.profiler.end_frame()
         self.count_frame()
 
     def count_frame(self):
@@ -155,19 +298,65 @@ class window(object):
 
             fps = 30 / dt
 
-            print "%f fps" % fps
+            if self.upload_frames:
+                print "%f fps" % fps
+            else:
+                print "%f fps, %d bytes of map changes uploaded" % (fps,
+                    self.renderer.map.bytes_uploaded)
+            if self.controller is not None:
+                print "rendering at %dx%d" % self.renderer.render_dim
+            if self.multi_device:
+                print "rows per device: %s" % " ".join(str(rows)
+                    for (y, rows) in self.renderer.bands)
+            print "%d frames unchanged" % self.renderer.frames_skipped
+            self.renderer.frames_skipped = 0
+            print_sim_stats(self.sim, dt)
+            if self.renderer.heatmap:
+                print_stats(self.renderer.traversal_stats())
+            if self.stream:
+                print_stream_stats(self.world.stream_stats())
+                self.world.reset_stream_stats()
+            if self.reproject:
+                print "%d frames reprojected" % (
+                    self.renderer.frames_reprojected)
+                self.renderer.frames_reprojected = 0
+            if self.pipelined:
+                print "%.0f%% CPU/GPU overlap" % (
+                    100 * self.renderer.overlap())
+                self.renderer.reset_overlap()
+
+    def upload_texture(self, frame):
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0,
+            frame.shape[1], frame.shape[0], GL_RGBA,
+            GL_UNSIGNED_BYTE, numpy.ascontiguousarray(frame))
 
-    def draw_texture(self):
+    def draw_texture(self, texture, render_dim):
         glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glBindTexture(GL_TEXTURE_2D, texture)
+
+        # Stretch the rendered part of the texture over the whole window
+        s = float(render_dim[0]) / self.tex_dim[0]
+        t = float(render_dim[1]) / self.tex_dim[1]
 
         glBegin(GL_QUADS)
         glTexCoord2d(0,0); glVertex2d(-1,-1)
-        glTexCoord2d(1,0); glVertex2d(1,-1)
-        glTexCoord2d(1,1); glVertex2d(1,1)
-        glTexCoord2d(0,1); glVertex2d(-1,1)
+        glTexCoord2d(s,0); glVertex2d(1,-1)
+        glTexCoord2d(s,t); glVertex2d(1,1)
+        glTexCoord2d(0,t); glVertex2d(-1,1)
         glEnd()
 
+    def draw_profile(self):
+        """ draw_profile: overlay the frame timing percentiles in the top
+        left corner """
+        glDisable(GL_TEXTURE_2D)
+        glColor3f(1,1,0)
+        for (i, line) in enumerate(self.profiler.report()):
+            glRasterPos2f(-0.95, -0.9 + 0.07 * i)
+            for c in line:
+                glutBitmapCharacter(GLUT_BITMAP_9_BY_15, ord(c))
+        glColor3f(1,1,1)
+
     def draw_axes(self):
 
         glBegin(GL_LINES)
@@ -197,9 +386,225 @@ class window(object):
         glColor3f(1,1,1)
         glEnd()
 
+def save_ppm(fname, frame):
+    """ save_ppm: write a (height, width, RGBA) uint8 frame as a binary
+    PPM, dropping the alpha channel """
+    f = open(fname, "wb")
+    f.write("P6\n%d %d\n255\n" % (frame.shape[1], frame.shape[0]))
+    f.write(frame[:,:,0:3].tostring())
+    f.close()
+
+def make_world(map_file, stream=False, background=True):
+    """ make_world: the map saved in map_file (see mapfile.py), or
+    testmap1 if there is none. With stream, the map is streamed in around
+    the player (see streaming.py) instead, and without a map file it is
+    streaming.terrain_world; unless background, its bricks are loaded on
+    the spot rather than by the background loader. """
+    if stream and map_file is None:
+        return streaming.terrain_world(background=background)
+    if map_file is None:
+        return testmaps.testmap1()
+    world = testmaps.filemap(map_file)
+    if stream:
+        return streaming.streaming_world(streaming.world_source(world),
+            (world.x_size(), world.y_size(), world.z_size()),
+            world.edge_type(), (world.player.x, world.player.y,
+            world.player.z), background=background)
+    return world
+
+def print_stats(stats):
+    """ print_stats: print a renderer's traversal_stats """
+    print ("iterations per pixel: mean %.1f, max %d; portal crossings: "
+        "mean %.2f, max %d; %.1f%% hit the loop limit" % (
+        stats["mean_iterations"], stats["max_iterations"],
+        stats["mean_crossings"], stats["max_crossings"],
+        100 * stats["limit_hit"]))
+
+def print_sim_stats(sim, dt):
+    """ print_sim_stats: print how many steps sim took over the last dt
+    seconds, and how much time the catch-up cap dropped """
+    print "%.0f simulation steps/s, %.0f ms dropped" % (sim.steps / dt,
+        sim.dropped)
+    sim.steps = 0
+    sim.dropped = 0.0
+
+def print_stream_stats(stats):
+    """ print_stream_stats: print a streaming world's stream_stats """
+    print ("bricks wanted that were loaded: %.1f%%; stalled %.1f ms "
+        "loading %d; %d loaded, %d evicted, %d resident" % (
+        100 * stats["hit_rate"], 1000 * stats["stall_time"],
+        stats["stalls"], stats["loads"], stats["evictions"],
+        stats["resident"]))
+
+def headless(frames, output, renderer, check, crowd, pipeline=1,
+             budget=None, reproject=False, multi_device=False,
+             profile_csv=None, heatmap=False, map_file=None, stream=False,
+             replay_file=None, replay_dt=None):
+    """ Render frames without a window, advancing the world by a fixed
+    20ms per frame in simulation steps (or by a step per frame recorded
+    in replay_file), and report the average framerate """
+    tex_dim = TEX_DIM[renderer]
+    script = None
+    if replay_file is not None:
+        (setup, script) = replay.load(replay_file)
+        (map_file, stream, crowd) = (setup["map"], setup["stream"],
+            setup["crowd"])
+        frames = len(script)
+    world = make_world(map_file, stream, background=script is None)
+    world.crowd.scatter(crowd, 1.5, .40)
+    if script is None:
+        sim = simulation.fixed_timestep(world)
+        frame_dt = 20.0
+    else:
+        sim = simulation.fixed_timestep(world, lambda dt:
+            replay.play_frame(world, script.pop(0), replay_dt))
+        frame_dt = sim.step
+    multi_device = renderer == "cl" and multi_device
+    reproject = renderer == "cl" and reproject and not multi_device
+    pipelined = renderer == "cl" and pipeline > 1 and not multi_device
+    if multi_device:
+        renderer = raycl.raycl_multi(tex_dim, world)
+    elif pipelined:
+        renderer = raycl.raycl_offscreen_pipelined(tex_dim, world,
+            reproject=reproject, depth=pipeline)
+    elif renderer == "cl":
+        renderer = raycl.raycl_offscreen(tex_dim, world,
+            reproject=reproject)
+    else:
+        renderer = raynp.raynp(tex_dim, world)
+    renderer.set_heatmap(heatmap)
+
+    controller = None
+    if budget is not None:
+        controller = dynres.resolution_controller(tex_dim, budget / 1000.0)
+        if not isinstance(renderer, raynp.raynp):
+            renderer.build_variants(controller.render_dims())
+    scales = []
+    frame_profiler = profiler.frame_profiler(csv_file=profile_csv)
+
+    time_start = datetime.datetime.now()
+    for i in xrange(frames):
+        with frame_profiler.timed("advance"):
+            sim.advance(frame_dt)
+        if controller is not None:
+            if i > 0:
+                renderer.set_render_dim(controller.update(
+                    renderer.kernel_time()))
+            scales.append(controller.scale())
+        with sim.interpolated():
+            if pipelined:
+                rendered = renderer.submit()
+                renderer.present()
+            else:
+                rendered = renderer.execute()
+        if rendered:
+            for (stage, t) in renderer.stage_times().items():
+                frame_profiler.record(stage, t)
+        frame_profiler.end_frame()
+    if pipelined:
+        renderer.drain()
+    frame_profiler.close()
+    dt = (datetime.datetime.now() - time_start).total_seconds()
+
+    print "%d frames in %f s: %f fps" % (frames, dt, frames / dt)
+    print "%d frames unchanged" % renderer.frames_skipped
+    if reproject:
+        print "%d frames reprojected" % renderer.frames_reprojected
+    if multi_device:
+        print "rows per device: %s" % " ".join(str(rows)
+            for (y, rows) in renderer.bands)
+    for line in frame_profiler.report():
+        print line
+    if pipelined:
+        print "%.0f%% CPU/GPU overlap" % (100 * renderer.overlap())
+    if controller is not None:
+        print "render scale: mean %.2f, last %.2f" % (numpy.mean(scales),
+            controller.scale())
+    if heatmap:
+        print_stats(renderer.traversal_stats())
+    if stream:
+        print_stream_stats(world.stream_stats())
+
+    if output is not None:
+        save_ppm(output, renderer.read_frame())
+
+    if check:
+        # Compare the last frame against the numpy reference renderer
+        reference = raynp.raynp(renderer.render_dim, world)
+        reference.set_heatmap(heatmap)
+        with sim.interpolated():
+            reference.execute()
+        diff = raynp.frame_diff(renderer.read_frame(),
+            reference.read_frame())
+        print "%f%% of pixels differ from the reference" % (100 * diff)
+    world.close()
+
 if __name__ == "__main__":
-    unlimited = False
-    if len(sys.argv) > 1 and sys.argv[1] == "--unlimited":
-        unlimited = True
-    w = window(unlimited)
-    glutMainLoop()
+    parser = argparse.ArgumentParser(description="fishpye raytracer")
+    parser.add_argument("--unlimited", action="store_true",
+        help="raise framerate limit from 50fps to 1000fps")
+    parser.add_argument("--headless", action="store_true",
+        help="render offscreen without a window or GL context")
+    parser.add_argument("--frames", type=int, default=100,
+        help="number of frames to render with --headless")
+    parser.add_argument("--output", metavar="FILE",
+        help="with --headless, save the last frame as a PPM image")
+    parser.add_argument("--renderer", choices=["cl", "numpy"],
+        help="render with OpenCL (the default) or the numpy reference "
+             "renderer (the default when OpenCL is missing)")
+    parser.add_argument("--crowd", type=int, default=0, metavar="N",
+        help="add N NPC entities to the world, drawn as spheres")
+    parser.add_argument("--pipeline", type=int, default=1, metavar="N",
+        help="with OpenCL, render into N targets so that up to N-1 "
+             "frames are in flight while the world advances")
+    parser.add_argument("--budget", type=float, metavar="MS",
+        help="lower the render resolution when frames take longer than "
+             "MS milliseconds to render, and raise it when they are fast")
+    parser.add_argument("--reproject", action="store_true",
+        help="with OpenCL, make frames after small camera movements by "
+             "reprojecting the last frame and tracing only the pixels it "
+             "doesn't cover")
+    parser.add_argument("--multi-device", action="store_true",
+        help="with OpenCL, split each frame into bands rendered on every "
+             "OpenCL device at once")
+    parser.add_argument("--profile-csv", metavar="FILE",
+        help="write the time each stage of every frame took to FILE")
+    parser.add_argument("--heatmap", action="store_true",
+        help="render how many traversal iterations each pixel's ray took "
+             "rather than the view, and report them (toggled with H in "
+             "the window)")
+    parser.add_argument("--map", metavar="FILE",
+        help="load the map saved in FILE (see mapfile.py) instead of the "
+             "built-in test map")
+    parser.add_argument("--stream", action="store_true",
+        help="stream the map in around the player rather than loading it "
+             "all: the --map FILE, or else a big map of procedural hills")
+    parser.add_argument("--record", metavar="FILE",
+        help="record the input sent to the world, and each simulation "
+             "step it is advanced by, to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+        help="drive the world from the input recorded in FILE instead "
+             "(and, with --headless, render as many frames as it has); "
+             "the map and crowd are those it was recorded with")
+    parser.add_argument("--replay-dt", type=float, metavar="MS",
+        help="with --replay, advance the world by MS milliseconds each "
+             "step instead of by the recorded time steps")
+    parser.add_argument("--check", action="store_true",
+        help="with --headless, compare the last frame against the numpy "
+             "reference renderer")
+    # Leave any GLUT options in sys.argv for glutInit
+    (args, _) = parser.parse_known_args()
+    if args.renderer is None:
+        args.renderer = "cl" if raycl is not None else "numpy"
+
+    if args.headless:
+        headless(args.frames, args.output, args.renderer, args.check,
+            args.crowd, args.pipeline, args.budget, args.reproject,
+            args.multi_device, args.profile_csv, args.heatmap, args.map,
+            args.stream, args.replay, args.replay_dt)
+    else:
+        w = window(args.unlimited, args.renderer, args.crowd,
+            args.pipeline, args.budget, args.reproject, args.multi_device,
+            args.profile_csv, args.heatmap, args.map, args.stream,
+            args.record, args.replay, args.replay_dt)
+        glutMainLoop()
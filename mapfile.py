@@ -0,0 +1,133 @@
+"""
+A binary file format for maps, so that big maps are loaded rather than
+built block by block with grid_set every time.
+
+The file is a fixed-size header followed by the world's map arrays as
+they are held in memory: the brick index, the used part of the brick
+pool (so the grid is stored brick-compressed, with all-air bricks taking
+no space), the portal matrices, and the brick distance field and portal
+exit table worked out from them. Every array starts on an ALIGN byte
+boundary and is little-endian. Loading memory-maps each array
+copy-on-write and hands it to the world as it is, so nothing is parsed
+or copied until the renderer uploads it, and editing the loaded map
+never writes to the file.
+
+Run as a script to save one of the maps in testmaps.py:
+    python mapfile.py citymap city.map
+"""
+import sys
+import time
+import numpy
+
+import world as wd
+
+MAGIC = "FISHPMAP"
+VERSION = 2
+ALIGN = 64
+
+HEADER = numpy.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("brick_shift", "<u4"),
+    ("mapinfo", "<i4", (wd.MAPINFO_SZ,)),
+    # Bricks of the pool in use, EMPTY_BRICK and UNKNOWN_BRICK included
+    ("n_bricks", "<u4"),
+    # Rows of the portal exit table (see world.portal_exit_table)
+    ("exit_rows", "<u4"),
+])
+
+def array_layout(header):
+    """ array_layout: (name, dtype, shape) of each array in a file with
+    this header, in file order """
+    info = header["mapinfo"]
+    n_index = int(info[wd.MI_BRICKS_X] * info[wd.MI_BRICKS_Y] *
+        info[wd.MI_BRICKS_Z])
+    return [("brick_index", "<u4", (n_index,)),
+            ("bricks", "u1", (int(header["n_bricks"]), wd.BRICK_SZ)),
+            ("portals", "<f4", (len(wd.BK_PORTAL), 4, 4)),
+            ("brick_dist", "u1", (n_index,)),
+            ("exit_index", "<u4", (n_index,)),
+            ("portal_exits", "u1", (int(header["exit_rows"]),
+                wd.PORTAL_DIRS * wd.BRICK_SZ))]
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+def save(world, fname):
+    """ save: write world's map to fname """
+    (exit_index, portal_exits) = world.portal_exit_table()
+    header = numpy.zeros((), dtype=HEADER)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["brick_shift"] = wd.BRICK_SHIFT
+    header["mapinfo"] = world.mapinfo
+    header["n_bricks"] = world.n_bricks
+    header["exit_rows"] = len(portal_exits)
+    arrays = {"brick_index": world.brick_index,
+              "bricks": world.bricks[0:world.n_bricks],
+              "portals": world.portals,
+              "brick_dist": world.brick_distances(),
+              "exit_index": exit_index,
+              "portal_exits": portal_exits}
+
+    f = open(fname, "wb")
+    f.write(header.tostring())
+    for (name, dtype, shape) in array_layout(header):
+        f.write("\0" * (aligned(f.tell()) - f.tell()))
+        f.write(numpy.ascontiguousarray(arrays[name],
+            dtype=dtype).tostring())
+    f.close()
+
+def load(world, fname):
+    """ load: replace world's map with the one saved in fname """
+    header = numpy.fromfile(fname, dtype=HEADER, count=1)
+    if len(header) == 0 or header[0]["magic"] != MAGIC:
+        raise ValueError("%s is not a map file" % fname)
+    header = header[0]
+    if header["version"] != VERSION:
+        raise ValueError("%s is a version %d map file, not version %d" % (
+            fname, header["version"], VERSION))
+    if header["brick_shift"] != wd.BRICK_SHIFT:
+        raise ValueError("%s has %d^3 bricks, not %d^3" % (fname,
+            1 << header["brick_shift"], wd.BRICK_DIM))
+
+    arrays = {}
+    offset = HEADER.itemsize
+    for (name, dtype, shape) in array_layout(header):
+        offset = aligned(offset)
+        if numpy.prod(shape) == 0:
+            arrays[name] = numpy.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = numpy.memmap(fname, dtype=dtype, mode="c",
+                offset=offset, shape=shape)
+        offset += numpy.dtype(dtype).itemsize * int(numpy.prod(shape))
+
+    world.mapinfo = numpy.array(header["mapinfo"], dtype=numpy.int32)
+    world.brick_index = arrays["brick_index"]
+    world.bricks = arrays["bricks"]
+    world.n_bricks = int(header["n_bricks"])
+    world.portals = arrays["portals"]
+    world.brick_dist = arrays["brick_dist"]
+    world.brick_dist_version += 1
+    (world.exit_index, world.portal_exits) = (arrays["exit_index"],
+        arrays["portal_exits"])
+    world.map_version += 1
+    for bufs in world.uploads:
+        for name in bufs.ARRAYS:
+            bufs.mark_all(name)
+
+if __name__ == "__main__":
+    import testmaps
+    if len(sys.argv) != 3:
+        print "usage: python mapfile.py MAP FILE"
+        sys.exit(1)
+    (map_name, fname) = sys.argv[1:3]
+    build_start = time.time()
+    world = getattr(testmaps, map_name)()
+    build_time = time.time() - build_start
+    save(world, fname)
+
+    load_start = time.time()
+    testmaps.filemap(fname)
+    print "built %s in %.3f s, loaded it back from %s in %.3f s" % (
+        map_name, build_time, fname, time.time() - load_start)
@@ -203,3 +203,121 @@ def _move_with_slide(w, obj, x, y, z, bx, by, bz):
                 dimensions_not_moved.remove(dim)
                 (rx,ry,rz) = _select(x,y,z,rx,ry,rz, dim)
     return (rx,ry,rz)
+
+# Batched physics: the functions below do the same as those above for
+# many objects at once, with one row per object in (N,3) arrays.
+
+def blocking_many(w, p):
+    """ blocking_many: blocking() for each row of points p """
+    p = np.floor(p).astype(np.int64)
+    inside = np.all((p >= 0) & (p < (w.x_size(), w.y_size(), w.z_size())),
+        axis=1)
+    result = np.ones(len(p), dtype=bool)
+    result[inside] = w.grid_get_many(
+        p[inside,0], p[inside,1], p[inside,2]) != world.BK_AIR
+    return result
+
+def trace_blocked_many(w, start, end):
+    """
+    trace_blocked_many: for each row, whether any cell on the line from
+    start to end (inclusive) is blocking - what trace_from_to() with a
+    visit function that stops at blocking cells finds out, for many
+    lines at once.
+    """
+    n = len(start)
+    u = start
+    v = end - start
+    last = np.floor(end)
+
+    p = np.floor(u)
+    step = np.sign(v)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tmax = np.where(step != 0, (p + np.maximum(step, 0) - u) / v, INF)
+        dt = np.where(step != 0, step / v, INF)
+
+    blocked = np.zeros(n, dtype=bool)
+    active = np.arange(n)
+    for i in xrange(TRACE_LOOP_LIMIT):
+        b = blocking_many(w, p[active])
+        blocked[active] = b
+        done = b | np.all(p[active] == last[active], axis=1)
+        active = active[~done]
+        if len(active) == 0:
+            break
+
+        (tx, ty, tz) = (tmax[active,0], tmax[active,1], tmax[active,2])
+        dim = np.where(tx < ty, np.where(tx < tz, 0, 2),
+                                np.where(ty < tz, 1, 2))
+        p[active, dim] += step[active, dim]
+        tmax[active, dim] += dt[active, dim]
+    return blocked
+
+def _climb_step_many(uy, target, foot, climb):
+    """ _climb_step() for the rows in mask climb, in place """
+    s = np.sign(uy)
+    # Which axis gravity is along, in the same order of preference as
+    # _climb_step
+    along_y = (uy[:,0] == 0) & (uy[:,2] == 0)
+    along_z = ~along_y & (uy[:,0] == 0) & (uy[:,1] == 0)
+    along_x = ~along_y & ~along_z & (uy[:,1] == 0) & (uy[:,2] == 0)
+    for (dim, along) in ((1, along_y), (2, along_z), (0, along_x)):
+        rows = climb & along
+        d = target[rows,dim] - foot[rows,dim]
+        foot[rows,dim] = np.where(s[rows,dim] == 1,
+            np.floor(foot[rows,dim]) + 1.0,
+            np.floor(foot[rows,dim]) - 0.005)
+        target[rows,dim] = foot[rows,dim] + d
+
+def legal_move_many(w, pos, target, uy, uz, hover_height):
+    """
+    legal_move_many: legal_move() for many objects at once. pos holds
+    the objects' current positions and target their attempted moves,
+    uy and uz their orientations, one row per object; hover_height is
+    per object too. Returns the new positions.
+    """
+    target = target.copy()
+    size = np.array([w.x_size(), w.y_size(), w.z_size()], dtype=float)
+
+    # Revert any coordinate that would leave the grid
+    out = (target < 0.0) | (target >= size)
+    target[out] = pos[out]
+    moving = ~np.all(out, axis=1)
+
+    foot = target - uy * hover_height[:,None]
+    # The cell above the step of a staircase
+    above = target + np.column_stack(
+        (np.sign(uy[:,0]), np.sign(uy[:,1]), np.sign(uz[:,2])))
+    climb = moving.copy()
+    climb[moving] = blocking_many(w, foot[moving]) & \
+        ~blocking_many(w, above[moving])
+    _climb_step_many(uy, target, foot, climb)
+
+    result = pos.copy()
+    result[~moving] = target[~moving]
+    m = np.nonzero(moving)[0]
+    result[m] = _move_with_slide_many(w, pos[m], target[m], foot[m])
+    return result
+
+def _move_with_slide_many(w, pos, target, foot):
+    """ _move_with_slide() for many objects at once """
+    r = pos.copy()
+    not_moved = np.ones(pos.shape, dtype=bool)
+    changed = np.ones(len(pos), dtype=bool)
+    # Each pass tries the remaining dimensions in x, y, z order and
+    # carries on while any of them could be moved along
+    while changed.any():
+        trying = changed
+        changed = np.zeros(len(pos), dtype=bool)
+        for dim in xrange(3):
+            rows = np.nonzero(trying & not_moved[:,dim])[0]
+            if len(rows) == 0:
+                continue
+            t = r[rows].copy()
+            t[:,dim] = target[rows,dim]
+            tb = foot[rows] - target[rows] + t
+            ok = ~trace_blocked_many(w, tb, t)
+            rows = rows[ok]
+            changed[rows] = True
+            not_moved[rows,dim] = False
+            r[rows,dim] = target[rows,dim]
+    return r
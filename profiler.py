@@ -0,0 +1,103 @@
+"""
+Per-frame timing: how long each stage of every frame took, from host
+timers for the stages run on the CPU and from OpenCL profiling events for
+those run on the device. The window shows percentiles over the last few
+seconds in an overlay (toggled with 't'), and can stream every frame to a
+CSV file for later analysis.
+"""
+import time
+import contextlib
+import numpy
+
+# Stages of a frame, in seconds: advancing the world, acquiring the GL
+# texture for OpenCL, the raytrace kernel, releasing the texture, drawing
+# (and uploading) the texture, swapping buffers, and the whole frame from
+# the end of the last one
+STAGES = ("advance", "acquire", "kernel", "release", "draw", "swap",
+          "frame")
+PERCENTILES = (50, 90, 99)
+
+class frame_profiler(object):
+    """
+    Records the time spent in each of STAGES for every frame. Host-side
+    stages are timed with timed(), and device-side ones passed to
+    record(); end_frame() then stores the frame in a ring buffer of the
+    last `size' frames for percentiles(), and writes it to the CSV file
+    if there is one.
+    """
+    def __init__(self, size=300, csv_file=None):
+        self.frames = numpy.zeros((size, len(STAGES)))
+        self.count = 0
+        self.current = numpy.zeros(len(STAGES))
+        self.last_end = None
+
+        self.csv = None
+        if csv_file is not None:
+            self.csv = open(csv_file, "w")
+            self.csv.write("frame," + ",".join(stage + "_ms"
+                for stage in STAGES) + "\n")
+
+    def record(self, stage, seconds):
+        """ record: add seconds to the current frame's time in stage """
+        self.current[STAGES.index(stage)] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """ timed: `with profiler.timed(stage):' adds the time the block
+        takes to stage """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - start)
+
+    def end_frame(self):
+        """ end_frame: store the current frame's times and start the next
+        frame """
+        now = time.time()
+        if self.last_end is not None:
+            self.record("frame", now - self.last_end)
+        self.last_end = now
+
+        self.frames[self.count % len(self.frames)] = self.current
+        if self.csv is not None:
+            self.csv.write("%d,%s\n" % (self.count, ",".join("%.3f" % ms
+                for ms in self.current * 1000.0)))
+            # So that the file can be followed while running
+            self.csv.flush()
+        self.count += 1
+        self.current = numpy.zeros(len(STAGES))
+
+    def recent(self):
+        """ recent: the (frames, STAGES) times of the frames in the ring
+        buffer, oldest first """
+        size = len(self.frames)
+        if self.count <= size:
+            return self.frames[0:self.count]
+        i = self.count % size
+        return numpy.concatenate((self.frames[i:], self.frames[0:i]))
+
+    def percentiles(self, stage, q=PERCENTILES):
+        """ percentiles: the q percentiles of the time in stage over the
+        recent frames, in milliseconds """
+        times = self.recent()[:,STAGES.index(stage)] * 1000.0
+        if len(times) == 0:
+            return [0.0 for p in q]
+        return [float(numpy.percentile(times, p)) for p in q]
+
+    def summary(self):
+        """ summary: {stage: {"p50": ms, ...}} over the recent frames """
+        return dict((stage, dict(("p%d" % p, ms) for (p, ms)
+            in zip(PERCENTILES, self.percentiles(stage))))
+            for stage in STAGES)
+
+    def report(self):
+        """ report: a line of percentiles per stage, for the overlay """
+        return ["%-8s" % stage + " ".join("p%d %6.2f" % (p, ms)
+            for (p, ms) in zip(PERCENTILES, self.percentiles(stage))) +
+            " ms" for stage in STAGES]
+
+    def close(self):
+        if self.csv is not None:
+            self.csv.close()
+            self.csv = None
@@ -1,20 +1,164 @@
+import os
 import sys
+import json
+import math
+import time
+import hashlib
 import numpy
 
-from OpenGL.GL import *
-from OpenGL.GLU import *
-from OpenGL import GLX
 import pyopencl as cl
 
-class raycl(object):
-    def __init__(self, texture, tex_dim, world):
-        self.tex_dim = tex_dim
-        self.world = world
+import world as wd
+import raynp
+import balance
 
-        self.clinit()
-        self.loadProgram("raytrace.cl")
+try:
+    from OpenGL.GL import *
+    from OpenGL.GLU import *
+    from OpenGL import GLX
+except ImportError:
+    # Headless render nodes may not have PyOpenGL at all, in which case
+    # only raycl_offscreen is usable.
+    pass
+
+# Built program binaries are kept here, so only the first run with a given
+# device, driver, source and build options pays for compiling the kernel
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fishpye")
+
+def cache_key(device, code, options):
+    h = hashlib.sha1()
+    for s in (device.platform.name, device.name, device.version,
+              device.driver_version, code, " ".join(options)):
+        h.update(s.encode("utf-8"))
+    return h.hexdigest()
+
+def build_program(ctx, code, options):
+    """
+    build_program: build code for the devices of ctx, loading the binaries
+    from CACHE_DIR if they are there and building from source (and caching
+    the result) if not. Returns the program and whether it came from the
+    cache.
+    """
+    fnames = [os.path.join(CACHE_DIR, cache_key(device, code, options) +
+        ".bin") for device in ctx.devices]
+    try:
+        binaries = [open(fname, "rb").read() for fname in fnames]
+        program = cl.Program(ctx, ctx.devices, binaries).build(
+            options=options)
+        return (program, True)
+    except (IOError, cl.Error):
+        # Not cached, or a binary the driver will no longer take
+        pass
+
+    program = cl.Program(ctx, code).build(options=options)
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        binaries = program.get_info(cl.program_info.BINARIES)
+        for (fname, binary) in zip(fnames, binaries):
+            # Write then rename, so another process never reads half a file
+            f = open(fname + ".tmp", "wb")
+            f.write(binary)
+            f.close()
+            os.rename(fname + ".tmp", fname)
+    except (IOError, OSError):
+        # Nowhere to cache it; we'll just build it again next time
+        pass
+    return (program, False)
+
+# Ways of launching the raytrace kernel tried by the autotuner: how
+# work-items map to pixels (PIXEL_ORDER in raytrace.cl), the tile size for
+# the tiled orders, and the work-group size (None leaves it to the driver)
+ORDERS = {"2d": 0, "tiled": 1, "morton": 2}
+LAUNCH_DEFAULT = {"order": "2d", "tile": None, "local": None}
+LAUNCH_CANDIDATES = [
+    LAUNCH_DEFAULT,
+    {"order": "2d", "tile": None, "local": [8, 8]},
+    {"order": "2d", "tile": None, "local": [16, 16]},
+    {"order": "2d", "tile": None, "local": [16, 4]},
+    {"order": "2d", "tile": None, "local": [32, 4]},
+    {"order": "tiled", "tile": [8, 8], "local": [64]},
+    {"order": "tiled", "tile": [16, 4], "local": [64]},
+    {"order": "tiled", "tile": [16, 16], "local": [256]},
+    {"order": "morton", "tile": [8, 8], "local": [64]},
+    {"order": "morton", "tile": [16, 16], "local": [256]},
+]
+# Frames timed for each candidate, after one untimed one
+TUNE_FRAMES = 5
+
+def round_up(n, m):
+    return (n + m - 1) // m * m
+
+def launch_options(config):
+    options = ["-D", "PIXEL_ORDER=%d" % ORDERS[config["order"]]]
+    if config["tile"] is not None:
+        options += ["-D", "TILE_W=%d" % config["tile"][0],
+                    "-D", "TILE_H=%d" % config["tile"][1]]
+    return options
+
+def launch_size(config, render_dim):
+    """ launch_size: the global and local sizes to launch the raytrace
+    kernel with to render render_dim pixels """
+    local = config["local"]
+    if config["order"] == "2d":
+        if local is None:
+            return (render_dim, None)
+        return ((round_up(render_dim[0], local[0]),
+                 round_up(render_dim[1], local[1])), tuple(local))
+    (tile_w, tile_h) = config["tile"]
+    n = (round_up(render_dim[0], tile_w) * round_up(render_dim[1], tile_h))
+    return ((round_up(n, local[0]),), tuple(local))
+
+def event_times(events):
+    """ event_times: {stage: seconds} the device spent on the command of
+    each of the {stage: event} events (see profiler.STAGES) """
+    return dict((stage, (event.profile.end - event.profile.start) * 1e-9)
+        for (stage, event) in events.items())
+
+def tuning_file():
+    return os.path.join(CACHE_DIR, "launch.json")
 
-        world.init_cldata(self.ctx)
+def load_tuning():
+    """ load_tuning: the autotuner's picks so far, by device and
+    resolution """
+    try:
+        return json.load(open(tuning_file()))
+    except (IOError, ValueError):
+        return {}
+
+def save_tuning(tuning):
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        f = open(tuning_file() + ".tmp", "w")
+        json.dump(tuning, f, indent=2, sort_keys=True)
+        f.close()
+        os.rename(tuning_file() + ".tmp", tuning_file())
+    except (IOError, OSError):
+        pass
+
+# Split-frame rendering (see raycl_multi): how much the speed of each
+# device in the latest frame counts towards its share of the next, against
+# its speed in the frames before
+BALANCE_RATE = 0.5
+
+def all_devices():
+    """ all_devices: every OpenCL device on every platform """
+    return [device for platform in cl.get_platforms()
+            for device in platform.get_devices()]
+
+# Reprojection (see raycl.prepare_reprojection) reuses the last frame only
+# when the camera has moved and turned less than this since, and for at
+# most this many frames in a row, so that errors don't build up
+REPROJECT_MOVE = 0.5 # m
+REPROJECT_TURN = 0.1 # rad
+REPROJECT_FRAMES = 8
+
+class raycl(object):
+    def __init__(self, texture, tex_dim, world, skip_empty=True,
+                 specialize=True, autotune=True, reproject=False):
+        self.setup(tex_dim, world, skip_empty, specialize, autotune,
+            reproject)
 
         self.tex = cl.GLTexture(
             self.ctx, cl.mem_flags.READ_WRITE,
@@ -23,6 +167,48 @@ class raycl(object):
 
         self.gl_objects = [self.tex]
 
+    def setup(self, tex_dim, world, skip_empty, specialize, autotune,
+              reproject):
+        """ setup: everything but the render target, which is up to the
+        subclass """
+        self.tex_dim = tex_dim
+        # Size of the part of the texture that is rendered to (see
+        # set_render_dim)
+        self.render_dim = tex_dim
+        self.world = world
+        self.skip_empty = skip_empty
+        self.specialize = specialize
+        self.autotune = autotune
+        self.launch_config = LAUNCH_DEFAULT
+        # (first row, number of rows) to render, if only a band of each
+        # frame is rendered here (see raycl_multi)
+        self.band = None
+        # Device copies of raynp.camera_directions, by FOV and render size
+        self.direction_tables = {}
+        # Frames are only rendered when something they depend on has
+        # changed (see changed)
+        self.skip_unchanged = True
+        self.last_key = None
+        self.frames_skipped = 0
+        self.reproject = reproject
+        self.reproject_bufs = None
+        self.last_view = None
+        self.reuse = False
+        self.reuse_run = 0
+        self.frames_reprojected = 0
+        # Render the traversal-cost heatmap rather than the view (see
+        # set_heatmap), with the per-pixel stats in heatmap_buf
+        self.heatmap = False
+        self.heatmap_buf = None
+
+        self.clinit()
+        self.tuning = load_tuning()
+        self.loadProgram("raytrace.cl")
+
+        self.map = world.init_cldata(self.ctx)
+        self.entities = world.entity_grid().init_cldata(self.ctx)
+        world.raycaster = self
+
     def clinit(self):
         plats = cl.get_platforms()
         ctx_props = cl.context_properties
@@ -37,36 +223,733 @@ class raycl(object):
         elif sys.platform == "win32":
             props.append((ctx_props.WGL_HDC_KHR,
                 WGL.wglGetCurrentDC()))
-        
+
         self.ctx = cl.Context(properties=props)
-        self.queue = cl.CommandQueue(self.ctx)
+        # Kernels are timed for adaptive resolution and overlap reporting
+        self.queue = cl.CommandQueue(self.ctx,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    def build_options(self):
+        options = ["-D", "SCREEN_W=%d" % self.render_dim[0],
+                   "-D", "SCREEN_H=%d" % self.render_dim[1],
+                   "-D", "BRICK_SHIFT=%d" % wd.BRICK_SHIFT]
+        if self.skip_empty:
+            options += ["-D", "SKIP_EMPTY"]
+        if self.reproject:
+            options += ["-D", "REPROJECT"]
+        if self.heatmap:
+            options += ["-D", "HEATMAP"]
+        if self.draw_entities():
+            options += ["-D", "ENTITIES"]
+        if self.specialize:
+            # Bake the map's size, edge type and number of portals into the
+            # kernel so the compiler can fold them into the traversal; a
+            # portal block with no matrix set still counts as a portal
+            world = self.world
+            options += ["-D", "MAP_X=%d" % world.x_size(),
+                        "-D", "MAP_Y=%d" % world.y_size(),
+                        "-D", "MAP_Z=%d" % world.z_size(),
+                        "-D", "MAP_EDGE_TYPE=%d" % world.edge_type(),
+                        "-D", "N_PORTALS=%d" % world.portals_in_use()]
+        return options + launch_options(self.launch_config)
 
     def loadProgram(self, fname):
         f = open(fname, "r")
-        code = "".join(f.readlines())
-        self.program = cl.Program(self.ctx, code).build()
+        self.code = "".join(f.readlines())
+        # Built variants of the program and their kernels (see kernel), by
+        # build options
+        self.programs = {}
+        # Seconds spent building (or loading from the cache) every
+        # variant so far, and how many of them were built and loaded
+        self.build_time = 0.0
+        self.variants_built = 0
+        self.variants_cached = 0
+        self.select_program()
+
+    def select_program(self):
+        """ select_program: switch to the program variant for the current
+        texture size, map and launch configuration, building it the first
+        time it is needed """
+        options = tuple(self.build_options())
+        variant = self.programs.get(options)
+        if variant is None:
+            build_start = time.time()
+            (program, self.program_cached) = build_program(self.ctx,
+                self.code, list(options))
+            self.build_time += time.time() - build_start
+            if self.program_cached:
+                self.variants_cached += 1
+            else:
+                self.variants_built += 1
+            # Every program.raytrace makes a new kernel object, so the
+            # kernels are made once per variant and kept
+            variant = (program, {"raytrace": cl.Kernel(program, "raytrace")})
+            self.programs[options] = variant
+        (self.program, self.kernels) = variant
+
+    def kernel(self, name):
+        """ kernel: the kernel called name in the current program
+        variant """
+        kernel = self.kernels.get(name)
+        if kernel is None:
+            kernel = cl.Kernel(self.program, name)
+            self.kernels[name] = kernel
+        return kernel
+
+    def set_render_dim(self, render_dim):
+        """ set_render_dim: render later frames into only the top-left
+        render_dim pixels of the texture """
+        self.render_dim = render_dim
+
+    def set_heatmap(self, heatmap):
+        """ set_heatmap: render later frames as the traversal-cost heatmap
+        rather than the view, or not. The heatmap colours each pixel by
+        how many iterations its ray took (see heat_color in raytrace.cl),
+        and read_stats gives the numbers behind it. """
+        if heatmap != self.heatmap:
+            self.heatmap = heatmap
+            self.last_key = None
+
+    def build_variants(self, render_dims):
+        """ build_variants: build the program variants for rendering at
+        each of render_dims now, rather than on the first frame at that
+        size """
+        render_dim = self.render_dim
+        for dim in render_dims:
+            self.render_dim = dim
+            self.launch_config = self.tuned_config()
+            self.select_program()
+        self.render_dim = render_dim
+        self.select_program()
+
+    def tuning_key(self):
+        device = self.queue.device
+        return "%s/%s/%s/%dx%d" % (device.platform.name.strip(),
+            device.name.strip(), device.driver_version.strip(),
+            self.tex_dim[0], self.tex_dim[1])
+
+    def tuned_config(self):
+        """ tuned_config: the autotuner's pick of launch configuration for
+        this device and texture size, running it first if it has not
+        been run and autotune is on """
+        key = self.tuning_key()
+        config = self.tuning.get(key)
+        if config is None:
+            if not self.autotune:
+                return LAUNCH_DEFAULT
+            config = self.tune()
+            self.tuning[key] = config
+            save_tuning(self.tuning)
+        return config
+
+    def tune(self):
+        """ tune: render the current view at full resolution with every
+        launch configuration in LAUNCH_CANDIDATES the device can run, and
+        return the fastest. Smaller render sizes (see set_render_dim) use
+        the same configuration. """
+        device = self.queue.device
+        (render_dim, launch_config, band) = (self.render_dim,
+            self.launch_config, self.band)
+        (self.render_dim, self.band) = (self.tex_dim, None)
+        scratch = cl.Image(self.ctx, cl.mem_flags.WRITE_ONLY,
+            cl.ImageFormat(cl.channel_order.RGBA,
+                           cl.channel_type.UNORM_INT8),
+            shape=self.tex_dim)
+        self.flush()
+        args = (scratch,) + self.kernel_args()[1:]
+
+        best = (None, LAUNCH_DEFAULT)
+        for config in LAUNCH_CANDIDATES:
+            self.launch_config = config
+            self.select_program()
+            (global_size, local_size) = launch_size(config, self.tex_dim)
+            if local_size is not None:
+                limit = self.kernel("raytrace").get_work_group_info(
+                    cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+                if (numpy.prod(local_size) > limit or
+                    any(l > m for (l, m) in zip(local_size,
+                        device.max_work_item_sizes))):
+                    continue
+
+            times = []
+            try:
+                for i in xrange(TUNE_FRAMES + 1):
+                    event = self.kernel("raytrace")(self.queue, global_size,
+                        local_size, *args)
+                    event.wait()
+                    times.append(event.profile.end - event.profile.start)
+            except cl.Error:
+                continue
+            t = numpy.median(times[1:])
+            if best[0] is None or t < best[0]:
+                best = (t, config)
+
+        (self.render_dim, self.launch_config, self.band) = (render_dim,
+            launch_config, band)
+        # The runs wrote over the reprojection buffers
+        self.last_view = None
+        return best[1]
+
+    def direction_table(self, fov):
+        """ direction_table: the buffer of camera-space ray directions
+        through each pixel at the current render size with the given FOV,
+        worked out the first time it is needed """
+        key = (fov, self.render_dim)
+        table = self.direction_tables.get(key)
+        if table is None:
+            cam = self.world.camera
+            n = raynp.camera_directions(cam.fov_x(fov), cam.fov_y(fov),
+                self.render_dim)
+            table = cl.Buffer(self.ctx,
+                cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                hostbuf=n)
+            self.direction_tables[key] = table
+        return table
+
+    def band_rows(self):
+        """ band_rows: (first row, number of rows) of the frame to
+        render """
+        if self.band is None:
+            return (0, self.render_dim[1])
+        return self.band
+
+    def kernel_args(self):
+        cam = self.world.camera
+        (fov_from, fov_to, s) = cam.fov_transition()
+        # Rotation sines and cosines are taken in single precision, the
+        # same as raynp.rotate
+        (rot_x, rot_y) = (numpy.float32(cam.rot_x), numpy.float32(cam.rot_y))
+        (band_y, band_h) = self.band_rows()
+        return (self.tex, numpy.int32(band_y), numpy.int32(band_h),
+                numpy.sin(rot_x), numpy.cos(rot_x),
+                numpy.sin(rot_y), numpy.cos(rot_y),
+                numpy.float32(cam.x),
+                numpy.float32(cam.y),
+                numpy.float32(cam.z),
+                self.direction_table(fov_from),
+                self.direction_table(fov_to),
+                numpy.float32(s)) + self.map.kernel_args() + (
+                self.entities.kernel_args() if self.draw_entities()
+                    else ()) + (
+                self.reprojection_args() if self.reproject else ()) + (
+                self.heatmap_args() if self.heatmap else ())
+
+    def heatmap_args(self):
+        """ heatmap_args: the extra raytrace argument with the heatmap on:
+        where the per-pixel traversal stats go """
+        if self.heatmap_buf is None:
+            # A uint4 per pixel of the whole texture
+            n = self.tex_dim[0] * self.tex_dim[1]
+            self.heatmap_buf = cl.Buffer(self.ctx, cl.mem_flags.WRITE_ONLY,
+                16 * n)
+        return (self.heatmap_buf,)
+
+    def read_stats(self):
+        """ read_stats: (iterations, crossings, limit_hit) of each pixel
+        of the last frame rendered with the heatmap on, as (height, width)
+        arrays - the same as raynp.read_stats """
+        (w, h) = self.render_dim
+        stats = numpy.zeros((h, w, 4), dtype=numpy.uint32)
+        if self.heatmap_buf is not None:
+            cl.enqueue_copy(self.queue, stats, self.heatmap_buf)
+        return (stats[:,:,0], stats[:,:,1], stats[:,:,2] != 0)
+
+    def traversal_stats(self):
+        """ traversal_stats: raynp.stats_summary of the last frame """
+        return raynp.stats_summary(*self.read_stats())
+
+    def reprojection_args(self):
+        """ reprojection_args: the extra raytrace arguments with
+        reprojection on: where this frame's hit distances and hit blocks
+        go, the last frame's hit blocks, and which pixels to reuse """
+        if self.reproject_bufs is None:
+            # Sized for the whole texture, so they do for any render size.
+            # Depths and hits are double-buffered: the last frame's are
+            # read while this frame's are written.
+            n = self.tex_dim[0] * self.tex_dim[1]
+            mf = cl.mem_flags
+            self.reproject_bufs = dict((name, cl.Buffer(self.ctx,
+                mf.READ_WRITE, 4 * n)) for name in ("depth", "last_depth",
+                "hit", "last_hit", "zbuf", "zmax", "source"))
+            # Both cameras (see prepare_reprojection)
+            self.reproject_bufs["cams"] = cl.Buffer(self.ctx, mf.READ_ONLY,
+                4 * 18)
+        bufs = self.reproject_bufs
+        return (bufs["depth"], bufs["hit"], bufs["last_hit"],
+                bufs["source"], bufs["zbuf"], bufs["zmax"],
+                bufs["last_depth"], bufs["cams"], numpy.int32(self.reuse))
+
+    def prepare_reprojection(self):
+        """
+        prepare_reprojection: decide whether the frame about to be rendered
+        can reuse the last one, and if so enqueue the passes that carry the
+        last frame's hit points into the current view. raytrace then only
+        traces the pixels that none of them landed on, those where the
+        depths around them show something may have come into view (see
+        reproject_disoccluded in raytrace.cl), and those whose rays miss
+        the face that landed on them. Only the camera may have changed,
+        and not by much (see REPROJECT_MOVE); when the crowd moves, or a
+        streaming world loads or evicts bricks, the whole frame is traced.
+        """
+        self.reprojection_args()
+        bufs = self.reproject_bufs
+        for name in ("depth", "hit"):
+            (bufs[name], bufs["last_" + name]) = (bufs["last_" + name],
+                bufs[name])
+
+        cam = self.world.camera
+        view = (cam.x, cam.y, cam.z, cam.rot_x, cam.rot_y)
+        state = (cam.fov, cam.prev_fov, cam.target_fov,
+                 self.world.map_version, self.world.residency_version,
+                 self.world.crowd.version, self.render_dim)
+        last = self.last_view
+        self.last_view = (view, state)
+
+        self.reuse = (last is not None and last[1] == state and
+            cam.prev_fov == cam.target_fov and
+            self.reuse_run < REPROJECT_FRAMES and
+            math.sqrt(sum((a - b) ** 2 for (a, b) in
+                zip(view[0:3], last[0][0:3]))) < REPROJECT_MOVE and
+            abs(view[3] - last[0][3]) < REPROJECT_TURN and
+            abs(view[4] - last[0][4]) < REPROJECT_TURN)
+        if not self.reuse:
+            self.reuse_run = 0
+            return
+        self.reuse_run += 1
+        self.frames_reprojected += 1
+
+        # Both cameras, laid out as raytrace.cl's CAM_* expect, with the
+        # rotations taken in single precision as in kernel_args
+        cams = numpy.zeros(18, dtype=numpy.float32)
+        for (i, (x, y, z, rot_x, rot_y)) in ((0, last[0]), (8, view)):
+            (rot_x, rot_y) = (numpy.float32(rot_x), numpy.float32(rot_y))
+            cams[i:i+8] = (x, y, z, 0.0, numpy.sin(rot_x),
+                numpy.cos(rot_x), numpy.sin(rot_y), numpy.cos(rot_y))
+        cams[16:18] = (cam.fov_x(), cam.fov_y())
+        # A new buffer each frame, as frames in flight may still read the
+        # last one
+        cams = bufs["cams"] = cl.Buffer(self.ctx,
+            cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=cams)
+
+        n = (self.render_dim[0] * self.render_dim[1],)
+        dirs = self.direction_table(cam.fov)
+        self.kernel("reproject_clear")(self.queue, n, None, bufs["zbuf"],
+            bufs["zmax"], bufs["source"])
+        self.kernel("reproject_depth")(self.queue, n, None,
+            bufs["last_depth"], dirs, cams, bufs["zbuf"], bufs["zmax"])
+        self.kernel("reproject_claim")(self.queue, n, None,
+            bufs["last_depth"], dirs, cams, bufs["zbuf"], bufs["source"])
+
+    def changed(self):
+        """ changed: whether the view or map have changed since the last
+        frame was rendered; if not, that frame can just be shown again """
+        key = (self.world.view_key(), self.render_dim)
+        if self.skip_unchanged and key == self.last_key:
+            self.frames_skipped += 1
+            return False
+        self.last_key = key
+        return True
+
+    def draw_entities(self):
+        """ draw_entities: whether there are entities to draw (see
+        entitygrid.py); without, the kernel is built without looking for
+        them """
+        return len(self.world.entity_grid().occupied) > 0
+
+    def flush(self):
+        """ flush: send any changes to the map, and to where the
+        entities are, since the last frame """
+        self.map.flush(self.queue)
+        self.world.entity_grid()
+        self.entities.flush(self.queue)
+
+    def launch(self):
+        self.flush()
+        self.launch_config = self.tuned_config()
+        self.select_program()
+        if self.reproject:
+            self.prepare_reprojection()
+
+        (global_size, local_size) = launch_size(self.launch_config,
+            (self.render_dim[0], self.band_rows()[1]))
+
+        self.event = self.kernel("raytrace")(self.queue, global_size,
+            local_size, *self.kernel_args())
+        return self.event
+
+    def kernel_time(self):
+        """ kernel_time: seconds the device spent running the raytrace
+        kernel for the last frame """
+        return (self.event.profile.end - self.event.profile.start) * 1e-9
+
+    def stage_times(self):
+        """ stage_times: {stage: seconds} the device spent on each stage
+        of the last frame (see profiler.STAGES) """
+        return event_times(self.events)
+
+    def raycast(self, u, v, max_dist):
+        """ raycast: run the raycast kernel on the rays starting at points
+        u along unit vectors v (both (N,4) float32 arrays); returns the
+        same as raynp.raycast """
+        self.map.flush(self.queue)
+        self.select_program()
+
+        mf = cl.mem_flags
+        n = len(u)
+        voxels = numpy.empty((n,4), dtype=numpy.int32)
+        normals = numpy.empty((n,4), dtype=numpy.float32)
+        u_buf = cl.Buffer(self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR,
+            hostbuf=u)
+        v_buf = cl.Buffer(self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR,
+            hostbuf=v)
+        voxels_buf = cl.Buffer(self.ctx, mf.WRITE_ONLY, voxels.nbytes)
+        normals_buf = cl.Buffer(self.ctx, mf.WRITE_ONLY, normals.nbytes)
+
+        self.kernel("raycast")(self.queue, (n,), None, u_buf, v_buf,
+            numpy.float32(max_dist), voxels_buf, normals_buf,
+            *self.map.kernel_args())
+        cl.enqueue_copy(self.queue, voxels, voxels_buf)
+        cl.enqueue_copy(self.queue, normals, normals_buf)
+
+        return (voxels[:,3] != 0, voxels[:,0:3],
+                normals[:,0:3].astype(numpy.int32), normals[:,3])
+
+    def enqueue_frame(self):
+        """ enqueue_frame: enqueue everything needed to render a frame
+        into self.tex, returning the kernel's event and the event of the
+        last command """
+        acquire = cl.enqueue_acquire_gl_objects(self.queue, self.gl_objects)
+        kernel_event = self.launch()
+        done = cl.enqueue_release_gl_objects(self.queue, self.gl_objects)
+        self.events = {"acquire": acquire, "kernel": kernel_event,
+                       "release": done}
+        return (kernel_event, done)
 
     def execute(self):
+        """ execute: render a frame, unless nothing has changed since the
+        last one; returns whether it did """
+        if not self.changed():
+            return False
         glFinish()
-        cl.enqueue_acquire_gl_objects(self.queue, self.gl_objects)
-
-        global_size = self.tex_dim
-        local_size = None
-        world = self.world
-
-        kernelargs = (self.tex,
-                      numpy.float32(world.camera.rot_x),
-                      numpy.float32(world.camera.rot_y),
-                      numpy.float32(world.camera.x),
-                      numpy.float32(world.camera.y),
-                      numpy.float32(world.camera.z),
-                      numpy.float32(world.camera.fov_x()),
-                      numpy.float32(world.camera.fov_y()),
-                      world.mapdat_clbuf)
-
-        self.program.raytrace(self.queue, global_size, local_size,
-            *kernelargs)
-
-        cl.enqueue_release_gl_objects(self.queue, self.gl_objects)
+        self.enqueue_frame()
         self.queue.flush()
         self.queue.finish()
+        return True
+
+class raycl_offscreen(raycl):
+    """
+    Renders into a plain cl.Image instead of a shared GL texture, so it
+    works without a window on any OpenCL device (including CPU runtimes
+    such as pocl). Unless a device is given, it is picked by pyopencl's
+    usual rules, i.e. the PYOPENCL_CTX environment variable.
+    """
+    def __init__(self, tex_dim, world, skip_empty=True, specialize=True,
+                 autotune=True, reproject=False, device=None):
+        self.device = device
+        self.setup(tex_dim, world, skip_empty, specialize, autotune,
+            reproject)
+
+        self.tex = cl.Image(self.ctx, cl.mem_flags.WRITE_ONLY,
+            cl.ImageFormat(cl.channel_order.RGBA,
+                           cl.channel_type.UNORM_INT8),
+            shape=tex_dim)
+
+        # Host-side copy of the last frame, in (row, column, RGBA) order
+        self.frame = numpy.zeros((tex_dim[1], tex_dim[0], 4),
+            dtype=numpy.uint8)
+
+    def clinit(self):
+        if self.device is None:
+            self.ctx = cl.create_some_context(interactive=False)
+        else:
+            self.ctx = cl.Context([self.device])
+        self.queue = cl.CommandQueue(self.ctx,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    def enqueue_frame(self):
+        kernel_event = self.launch()
+        self.events = {"kernel": kernel_event}
+        return (kernel_event, kernel_event)
+
+    def execute(self):
+        if not self.changed():
+            return False
+        self.enqueue_frame()
+        self.queue.finish()
+        return True
+
+    def read_frame(self):
+        """ read_frame: copy the last rendered frame back to the host and
+        return it as a (height, width, 4) uint8 numpy array """
+        (w, h) = self.render_dim
+        # The copy needs a contiguous array, so use the front of the frame
+        # buffer rather than a (strided) corner of it
+        frame = self.frame.reshape(-1)[0:h*w*4].reshape((h, w, 4))
+        cl.enqueue_copy(self.queue, frame, self.tex,
+            origin=(0, 0), region=self.render_dim)
+        return frame
+
+class pipeline(object):
+    """
+    Mixin for renderers that keeps several frames in flight, each
+    rendering into its own target, instead of waiting for every frame to
+    finish. submit() enqueues a frame and returns straight away, so the
+    caller can advance the world and set up the next frame while the
+    device renders; present() then waits (on events, not the whole
+    queue) only for the oldest frame it has to show.
+    """
+    def init_pipeline(self, targets):
+        self.targets = targets
+        self.next_target = 0
+        # (target number, {stage: event}, done event, render_dim) of
+        # frames in flight
+        self.in_flight = []
+        self.shown = 0
+        # Size, kernel time and stage times of the newest finished frame
+        self.shown_dim = self.render_dim
+        self.shown_time = 0.0
+        self.shown_stages = {}
+        self.reset_overlap()
+
+    def reset_overlap(self):
+        # Device time spent rendering retired frames, and host time spent
+        # blocked waiting for them
+        self.gpu_time = 0.0
+        self.wait_time = 0.0
+
+    def overlap(self):
+        """ overlap: the fraction of rendering time since reset_overlap()
+        during which the host was doing something other than waiting """
+        if self.gpu_time == 0.0:
+            return 0.0
+        return max(0.0, 1.0 - self.wait_time / self.gpu_time)
+
+    def submit(self):
+        """ submit: start rendering the world as it is now into the next
+        free target, unless nothing has changed since the last frame;
+        returns whether it did """
+        if not self.changed():
+            # Nothing new to render, so let present() catch up to the
+            # newest frame
+            self.drain()
+            return False
+        if len(self.in_flight) == len(self.targets):
+            self.retire()
+        k = self.next_target
+        self.next_target = (k + 1) % len(self.targets)
+
+        self.tex = self.targets[k]
+        (kernel_event, done) = self.enqueue_frame()
+        self.queue.flush()
+        self.in_flight.append((k, self.events, done, self.render_dim))
+        return True
+
+    def retire(self):
+        """ retire: wait for the oldest frame in flight """
+        (k, events, done, render_dim) = self.in_flight.pop(0)
+        wait_start = time.time()
+        done.wait()
+        self.wait_time += time.time() - wait_start
+        self.shown_stages = event_times(events)
+        self.shown_time = self.shown_stages["kernel"]
+        self.gpu_time += self.shown_time
+        (self.shown, self.shown_dim) = (k, render_dim)
+
+    def kernel_time(self):
+        """ kernel_time: seconds the device spent rendering the newest
+        finished frame """
+        return self.shown_time
+
+    def stage_times(self):
+        return self.shown_stages
+
+    def present(self):
+        """ present: retire frames until at most len(targets) - 1 are in
+        flight, and return the number of the target holding the newest
+        finished frame """
+        while len(self.in_flight) > len(self.targets) - 1:
+            self.retire()
+        return self.shown
+
+    def drain(self):
+        """ drain: wait for every frame in flight """
+        while self.in_flight:
+            self.retire()
+        return self.shown
+
+class raycl_pipelined(pipeline, raycl):
+    """
+    A raycl that renders into a ring of GL textures with up to
+    len(textures) - 1 frames in flight; draw whichever present() returns.
+    """
+    def __init__(self, textures, tex_dim, world, skip_empty=True,
+                 specialize=True, autotune=True, reproject=False):
+        raycl.__init__(self, textures[0], tex_dim, world, skip_empty,
+            specialize, autotune, reproject)
+        self.textures = textures
+
+        # Without cl_khr_gl_event, GL must be finished with a texture
+        # before OpenCL acquires it
+        self.gl_event = "cl_khr_gl_event" in self.queue.device.extensions
+
+        self.init_pipeline([self.tex] + [cl.GLTexture(
+            self.ctx, cl.mem_flags.READ_WRITE,
+            GL_TEXTURE_2D, 0,
+            texture, 2) for texture in textures[1:]])
+
+    def enqueue_frame(self):
+        if not self.gl_event:
+            glFinish()
+        self.gl_objects = [self.tex]
+        return raycl.enqueue_frame(self)
+
+    def present(self):
+        return self.textures[pipeline.present(self)]
+
+class raycl_offscreen_pipelined(pipeline, raycl_offscreen):
+    """ The offscreen equivalent of raycl_pipelined, with depth cl.Images.
+    Reading a frame back waits for the whole queue, so only drain() does
+    that, returning the last frame as read_frame does. """
+    def __init__(self, tex_dim, world, skip_empty=True, specialize=True,
+                 autotune=True, reproject=False, depth=2):
+        raycl_offscreen.__init__(self, tex_dim, world, skip_empty,
+            specialize, autotune, reproject)
+        self.init_pipeline([self.tex] + [cl.Image(self.ctx,
+            cl.mem_flags.WRITE_ONLY,
+            cl.ImageFormat(cl.channel_order.RGBA,
+                           cl.channel_type.UNORM_INT8),
+            shape=tex_dim) for i in xrange(depth - 1)])
+
+    def drain(self):
+        self.tex = self.targets[pipeline.drain(self)]
+        self.render_dim = self.shown_dim
+        return self.read_frame()
+
+class raycl_multi(object):
+    """
+    Split-frame rendering on several OpenCL devices at once - by default
+    every device of every platform, CPU runtimes included. Each frame is
+    cut into horizontal bands, one per device, which render in parallel
+    and are read back into one frame on the host; the window uploads that
+    to the display texture, as it does for raynp. Band heights follow the
+    rows per second each device has been managing, so that they all
+    finish at about the same time. Has the same interface as
+    raycl_offscreen.
+    """
+    def __init__(self, tex_dim, world, devices=None, skip_empty=True,
+                 specialize=True, autotune=True):
+        if devices is None:
+            devices = all_devices()
+        self.tex_dim = tex_dim
+        self.render_dim = tex_dim
+        self.world = world
+        self.skip_empty = skip_empty
+        self.renderers = [raycl_offscreen(tex_dim, world, skip_empty,
+            specialize, autotune, device=device) for device in devices]
+        for r in self.renderers:
+            # Whether there is a new frame is decided here, for all of them
+            r.skip_unchanged = False
+        world.raycaster = self
+        self.skip_unchanged = True
+        self.last_key = None
+        self.frames_skipped = 0
+        self.heatmap = False
+
+        # Rows per second rendered by each device; until the first frame
+        # is timed, they all get the same share
+        self.speeds = numpy.ones(len(self.renderers))
+        self.timed = False
+        self.bands = balance.split_rows(tex_dim[1], self.speeds)
+        # Host-side copy of the last frame, in (row, column, RGBA) order
+        self.frame = numpy.zeros((tex_dim[1], tex_dim[0], 4),
+            dtype=numpy.uint8)
+
+    def set_render_dim(self, render_dim):
+        self.render_dim = render_dim
+
+    def build_variants(self, render_dims):
+        for r in self.renderers:
+            r.build_variants(render_dims)
+
+    def set_heatmap(self, heatmap):
+        self.heatmap = heatmap
+        for r in self.renderers:
+            r.set_heatmap(heatmap)
+        self.last_key = None
+
+    def read_stats(self):
+        """ read_stats: the per-pixel traversal stats of the last frame
+        (see raycl.read_stats), put together from each device's band """
+        (w, h) = self.render_dim
+        stats = [numpy.zeros((h, w), dtype=numpy.uint32),
+                 numpy.zeros((h, w), dtype=numpy.uint32),
+                 numpy.zeros((h, w), dtype=bool)]
+        for (r, (y, rows)) in zip(self.renderers, self.bands):
+            if rows == 0:
+                continue
+            for (whole, band) in zip(stats, r.read_stats()):
+                whole[y:y+rows] = band[y:y+rows]
+        return tuple(stats)
+
+    def traversal_stats(self):
+        return raynp.stats_summary(*self.read_stats())
+
+    def changed(self):
+        """ changed: whether the view or map have changed since the last
+        frame was rendered """
+        key = (self.world.view_key(), self.render_dim)
+        if self.skip_unchanged and key == self.last_key:
+            self.frames_skipped += 1
+            return False
+        self.last_key = key
+        return True
+
+    def execute(self):
+        """ execute: render a frame on all the devices, unless nothing has
+        changed since the last one; returns whether it did """
+        if not self.changed():
+            return False
+        (w, h) = self.render_dim
+        frame = self.frame.reshape(-1)[0:h*w*4].reshape((h, w, 4))
+
+        self.bands = balance.split_rows(h, self.speeds)
+        for (r, (y, rows)) in zip(self.renderers, self.bands):
+            if rows == 0:
+                continue
+            (r.render_dim, r.band) = (self.render_dim, (y, rows))
+            r.launch()
+            cl.enqueue_copy(r.queue, frame[y:y+rows], r.tex,
+                origin=(0, y), region=(w, rows), is_blocking=False)
+            r.queue.flush()
+
+        for (i, (r, (y, rows))) in enumerate(zip(self.renderers,
+                                                 self.bands)):
+            if rows == 0:
+                continue
+            r.queue.finish()
+            speed = rows / max(r.kernel_time(), 1e-6)
+            if self.timed:
+                self.speeds[i] += BALANCE_RATE * (speed - self.speeds[i])
+            else:
+                self.speeds[i] = speed
+        self.timed = True
+        return True
+
+    def kernel_time(self):
+        """ kernel_time: seconds the slowest device spent rendering its
+        band of the last frame """
+        return max(r.kernel_time() for (r, (y, rows))
+            in zip(self.renderers, self.bands) if rows > 0)
+
+    def stage_times(self):
+        return {"kernel": self.kernel_time()}
+
+    def raycast(self, u, v, max_dist):
+        return self.renderers[0].raycast(u, v, max_dist)
+
+    def read_frame(self):
+        """ read_frame: the last rendered frame, as a (height, width, 4)
+        uint8 numpy array """
+        (w, h) = self.render_dim
+        return self.frame.reshape(-1)[0:h*w*4].reshape((h, w, 4))
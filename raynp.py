@@ -0,0 +1,589 @@
+"""
+A pure-numpy implementation of the raytrace kernel in raytrace.cl.
+
+All the rays of a frame are traced together as arrays, one voxel step per
+iteration, so there are no per-pixel Python loops. It follows the kernel
+step for step in single precision, so it can be used as a golden reference
+for the kernel's output as well as a fallback renderer on machines without
+OpenCL.
+"""
+import time
+import numpy
+
+import world as wd
+
+# Must match the #defines in raytrace.cl
+LOOP_LIMIT = 100
+COLOR_WALL = numpy.array([0.45, 0.75, 0.75, 1.0], dtype=numpy.float32)
+COLOR_WALLG = numpy.array([0.45, 0.75, 0.45, 1.0], dtype=numpy.float32)
+COLOR_UNKNOWN = numpy.array([0.4, 0.4, 0.45, 1.0], dtype=numpy.float32)
+COLOR_ENTITY = numpy.array([0.85, 0.5, 0.25, 1.0], dtype=numpy.float32)
+LIGHTEN = numpy.float32(4.0/3.0)
+DARKEN = numpy.float32(2.0/3.0)
+
+INF = numpy.float32(numpy.inf)
+
+f32 = numpy.float32
+
+def camera_directions(fov_x, fov_y, tex_dim):
+    """
+    camera_directions: the unit vector of the ray through every pixel as
+    if the camera was looking directly down the z-axis, as an (N,4) array
+    in row-major pixel order
+    """
+    (fov_x, fov_y) = (f32(fov_x), f32(fov_y))
+    (px, py) = numpy.meshgrid(numpy.arange(tex_dim[0], dtype=numpy.float32),
+                              numpy.arange(tex_dim[1], dtype=numpy.float32))
+    rz = (px.ravel() * fov_x) / f32(tex_dim[0]) - fov_x / f32(2)
+    rw = (py.ravel() * fov_y) / f32(tex_dim[1]) - fov_y / f32(2)
+
+    n = numpy.zeros((len(rz), 4), dtype=numpy.float32)
+    n[:,0] = numpy.cos(rw) * numpy.sin(rz)
+    n[:,1] = -numpy.sin(rw)
+    n[:,2] = numpy.cos(rw) * numpy.cos(rz)
+    return n
+
+def mix_directions(a, b, s):
+    """ mix_directions: the unit vectors s of the way from the direction
+    table a to table b, as the kernel interpolates during FOV
+    transitions """
+    if s == 0:
+        return a
+    n = a + (b - a) * f32(s)
+    return n / numpy.sqrt(numpy.sum(n * n, axis=1))[:,None]
+
+def rotate(n, rot_x, rot_y):
+    """ rotate: turn camera-space ray vectors n into world coordinates """
+    (sx, cx) = (numpy.sin(f32(rot_x)), numpy.cos(f32(rot_x)))
+    (sy, cy) = (numpy.sin(f32(rot_y)), numpy.cos(f32(rot_y)))
+
+    v = numpy.zeros(n.shape, dtype=numpy.float32)
+    v[:,0] = n[:,0]*cx + n[:,1]*sx*sy + n[:,2]*sx*cy
+    v[:,1] = n[:,1]*cy - n[:,2]*sy
+    v[:,2] = -n[:,0]*sx + n[:,1]*cx*sy + n[:,2]*cx*cy
+    return v
+
+def portal_number(block):
+    """ portal_number: the portal number of each block, or -1 """
+    block = block.astype(numpy.int32)
+    return numpy.where((block >= wd.BK_PORTAL[8]) & (block <= wd.BK_PORTAL[0]),
+        255 - block, -1)
+
+class ray_state(object):
+    """
+    The traversal state of a bundle of rays - the arrays here correspond
+    to the locals of the same names in the raytrace kernel. With
+    entities, the rays look for entities to hit as the raytrace kernel's
+    do (see entities), otherwise they pass through them as the raycast
+    kernel's do.
+    """
+    def __init__(self, world, u, v, skip_empty=True, entities=False):
+        self.world = world
+        self.skip_empty = skip_empty
+        self.bounds = numpy.array([world.x_size(), world.y_size(),
+            world.z_size()], dtype=numpy.int32)
+        self.portals = world.portals
+        self.brick_dist = world.brick_distances()
+        (self.exit_index, self.portal_exits) = world.portal_exit_table()
+        self.grid = world.entity_grid() if entities else None
+
+        n = len(u)
+        self.u = numpy.array(u, dtype=numpy.float32)
+        self.v = numpy.array(v, dtype=numpy.float32)
+        self.t = numpy.zeros(n, dtype=numpy.float32)
+        self.P = self.u[:,0:3].astype(numpy.int32)
+        self.outside = numpy.zeros(n, dtype=bool)
+        self.last_step = numpy.zeros((n,3), dtype=numpy.int32)
+        self.skipped = numpy.zeros(n, dtype=bool)
+        # Number of portals each ray has passed through
+        self.crossings = numpy.zeros(n, dtype=numpy.int32)
+        # Number of voxels each ray has moved through, including those
+        # skipped over and those inside portals
+        self.voxels = numpy.zeros(n, dtype=numpy.int32)
+        # The nearest entity found that each ray enters at t >= ent_t_min
+        # (since its last portal), and the normal there; the brick whose
+        # entities were looked at last, and crossings when ent_t_min was
+        # set
+        self.ent_t = numpy.empty(n, dtype=numpy.float32)
+        self.ent_t[:] = INF
+        self.ent_t_min = numpy.zeros(n, dtype=numpy.float32)
+        self.ent_normal = numpy.zeros((n,3), dtype=numpy.float32)
+        self.ent_brick = numpy.empty(n, dtype=numpy.int64)
+        self.ent_brick[:] = -1
+        self.ent_crossings = numpy.zeros(n, dtype=numpy.int32)
+
+        self.reset(numpy.arange(n))
+
+    def reset(self, i):
+        """ reset: recalculate step, tmax, dt and justOut of rays i from
+        their current u, v and P - RESET_* in the kernel """
+        (u, v, P) = (self.u[i,0:3], self.v[i,0:3], self.P[i])
+        step = numpy.sign(v).astype(numpy.int32)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            tmax = numpy.where(step != 0,
+                ((P + numpy.maximum(step, 0)).astype(numpy.float32) - u) / v,
+                INF)
+            dt = step.astype(numpy.float32) / v
+        just_out = numpy.where(step == -1, -1, self.bounds)
+
+        if len(i) == len(self.u):
+            (self.step, self.tmax, self.dt, self.just_out) = (step,
+                tmax.astype(numpy.float32), dt.astype(numpy.float32),
+                just_out.astype(numpy.int32))
+        else:
+            self.step[i] = step
+            self.tmax[i] = tmax
+            self.dt[i] = dt
+            self.just_out[i] = just_out
+
+    def compress(self, keep):
+        """ compress: drop the rays that are not in the mask keep """
+        for name in ('u', 'v', 't', 'P', 'outside', 'last_step', 'skipped',
+                     'crossings', 'voxels', 'step', 'tmax', 'dt', 'just_out', 'ent_t',
+                     'ent_t_min', 'ent_normal', 'ent_brick',
+                     'ent_crossings'):
+            setattr(self, name, getattr(self, name)[keep])
+
+    def in_grid(self, P):
+        return numpy.all((P >= 0) & (P < self.bounds), axis=1)
+
+    def block(self, i=slice(None)):
+        """ block: the block type in the current voxel of rays i (default
+        all). As in the kernel, voxels outside the grid read as BK_AIR. """
+        P = self.P[i]
+        inside = self.in_grid(P) & ~self.outside[i]
+        block = numpy.zeros(len(P), dtype=numpy.uint8)
+        block[inside] = self.world.grid_get_many(
+            P[inside,0], P[inside,1], P[inside,2])
+        return block
+
+    def dist(self):
+        """ dist: the brick distance of every ray's current voxel, or its
+        distance to the nearest entity if that is smaller, or 0 outside
+        the grid """
+        inside = self.in_grid(self.P) & ~self.outside
+        dist = numpy.zeros(len(self.P), dtype=numpy.int32)
+        P = self.P[inside]
+        b = self.world.brick_off(P[:,0], P[:,1], P[:,2])
+        dist[inside] = self.brick_dist[b]
+        if self.grid is not None:
+            dist[inside] = numpy.minimum(dist[inside], self.grid.dist[b])
+        return dist
+
+    def advance(self):
+        """ advance: one iteration of the kernel's main loop - skip rays
+        across empty space, or step them into their next voxel """
+        skip = numpy.zeros(len(self.t), dtype=bool)
+        if self.skip_empty:
+            dist = self.dist()
+            skip = ~self.skipped & (dist > 0)
+            i = numpy.nonzero(skip)[0]
+            if len(i) > 0:
+                self.skip(i, dist[i])
+        self.skipped = skip
+        self.step_voxel(numpy.nonzero(~skip)[0])
+
+    def skip(self, i, dist):
+        """ skip: move rays i to the last voxel before the far side of the
+        cube of empty bricks around them """
+        (u, v, step) = (self.u[i,0:3], self.v[i,0:3], self.step[i])
+        d = (dist - 1)[:,None]
+        B = self.P[i] >> wd.BRICK_SHIFT
+        lo = numpy.maximum((B - d) << wd.BRICK_SHIFT, 0)
+        hi = numpy.minimum(((B + d + 1) << wd.BRICK_SHIFT) - 1,
+            self.bounds - 1)
+        plane = numpy.where(step > 0, hi + 1, lo).astype(numpy.float32)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t_exit = numpy.where(step != 0, (plane - u) / v, INF)
+        t = t_exit.min(axis=1).astype(numpy.float32)
+
+        self.t[i] = t
+        P = numpy.clip(
+            numpy.floor(u + v * t[:,None]).astype(numpy.int32), lo, hi)
+        # Stepping voxel by voxel would have taken one step per voxel
+        # boundary crossed on the way
+        self.voxels[i] += numpy.abs(P - self.P[i]).sum(axis=1)
+        self.P[i] = P
+        self.reset(i)
+
+    def step_voxel(self, i):
+        """ step_voxel: step rays i into their next voxel, carrying rays
+        that enter a portal through to the other side """
+        tmax = self.tmax[i]
+        (tx, ty, tz) = (tmax[:,0], tmax[:,1], tmax[:,2])
+        dim = numpy.where(tx < ty, numpy.where(tx < tz, 0, 2),
+                                   numpy.where(ty < tz, 1, 2))
+
+        step = self.step[i, dim]
+        self.P[i, dim] += step
+        self.voxels[i] += 1
+        self.last_step[i] = 0
+        self.last_step[i, dim] = step
+        self.t[i] = tmax[numpy.arange(len(i)), dim]
+        out = self.P[i, dim] == self.just_out[i, dim]
+        self.outside[i] |= out
+        self.tmax[i[~out], dim[~out]] += self.dt[i[~out], dim[~out]]
+
+        portal = portal_number(self.block(i))
+        crossing = (portal != -1) & ~self.outside[i]
+        if crossing.any():
+            self.cross_portals(i[crossing], portal[crossing])
+
+    def cross_portals(self, i, portal):
+        last_step = self.last_step[i]
+
+        # Step to the opposite (back) face of the portal, looking up how
+        # far that is in the world's portal exit table
+        P = self.P[i]
+        axis = numpy.argmax(last_step != 0, axis=1)
+        d = 2 * axis + (last_step.sum(axis=1) > 0)
+        exits = self.exit_index[self.world.brick_off(P[:,0], P[:,1], P[:,2])]
+        steps = self.portal_exits[exits, d * wd.BRICK_SZ +
+            self.world.cell_off(P[:,0], P[:,1], P[:,2])].astype(numpy.int32)
+
+        u = self.u[i]
+        u[:,0:3] += steps[:,None] * last_step
+        self.voxels[i] += steps
+
+        # Now apply the portal transformation
+        m = self.portals[portal]
+        self.u[i] = numpy.einsum('nij,nj->ni', m, u)
+        self.v[i] = numpy.einsum('nij,nj->ni', m, self.v[i])
+        self.P[i] = (self.u[i,0:3] +
+            self.v[i,0:3] * self.t[i,None]).astype(numpy.int32)
+        self.crossings[i] += 1
+        self.reset(i)
+
+    def entities(self):
+        """ entities: ray_entities in the kernel - whether each ray has
+        entered the nearest entity found before getting to its current
+        voxel; the others look at the entities binned in their voxel's
+        brick if they have just got to it """
+        hit = self.ent_t <= self.t
+        crossed = ~hit & (self.crossings != self.ent_crossings)
+        self.ent_t[crossed] = INF
+        self.ent_t_min[crossed] = self.t[crossed]
+        self.ent_brick[crossed] = -1
+        self.ent_crossings[crossed] = self.crossings[crossed]
+
+        i = numpy.nonzero(~hit & ~self.outside & self.in_grid(self.P))[0]
+        P = self.P[i]
+        b = self.world.brick_off(P[:,0], P[:,1], P[:,2]).astype(numpy.int64)
+        new = b != self.ent_brick[i]
+        (i, b) = (i[new], b[new])
+        self.ent_brick[i] = b
+        self.find_entities(i, b)
+        return hit
+
+    def find_entities(self, i, b):
+        """ find_entities: ray_find_entities in the kernel, for rays i
+        and the bricks b they have just got to """
+        grid = self.grid
+        bins = grid.bins[grid.index[b]].astype(numpy.int64)
+        (start, count) = (bins[:,0], bins[:,1])
+        if count.sum() == 0:
+            return
+        # A row per (ray, sphere in its bin) pair
+        ray = numpy.repeat(numpy.arange(len(i)), count)
+        first = numpy.cumsum(count) - count
+        s = grid.spheres[start[ray] + numpy.arange(len(ray)) - first[ray]]
+        (u, v) = (self.u[i[ray]], self.v[i[ray]])
+
+        d = u[:,0:3] - s[:,0:3]
+        a = numpy.sum(v[:,0:3] * v[:,0:3], axis=1)
+        h = numpy.sum(d * v[:,0:3], axis=1)
+        disc = h*h - a*(numpy.sum(d * d, axis=1) - s[:,3]*s[:,3])
+        with numpy.errstate(invalid='ignore'):
+            t = (-h - numpy.sqrt(disc)) / a
+            t = numpy.where((disc >= 0) & (t >= self.ent_t_min[i[ray]]),
+                t, INF)
+
+        # The nearest of each ray's, the first of them on a tie as in the
+        # kernel
+        order = numpy.lexsort((numpy.arange(len(t)), t, ray))
+        order = order[numpy.concatenate(([True],
+            ray[order][1:] != ray[order][:-1]))]
+        order = order[t[order] < self.ent_t[i[ray[order]]]]
+        j = i[ray[order]]
+        self.ent_t[j] = t[order]
+        self.ent_normal[j] = ((d[order] + v[order,0:3] * t[order,None]) /
+            s[order,3:4])
+
+def shade_entities(r, i):
+    """ shade_entities: shade_entity in the kernel - the colours of the
+    entities rays i have hit """
+    normal = r.ent_normal[i]
+    color = numpy.empty((len(normal),4), dtype=numpy.float32)
+    color[:] = COLOR_ENTITY
+    color[:,0:3] = numpy.minimum(color[:,0:3] *
+        (f32(1.0) + normal[:,1] / f32(3.0))[:,None], 1.0)
+    diffuse = numpy.sum(normal * r.v[i,0:3], axis=1)
+    color[:,0:3] = numpy.minimum(color[:,0:3] *
+        (f32(0.5) - diffuse / (f32(0.6) * r.ent_t[i]))[:,None], 1.0)
+    return color
+
+def color_ray(r, color):
+    """ color_ray: returns the new ray colors of the rays in r, given
+    their current colors """
+    edge_type = r.world.edge_type()
+    block = r.block()
+    if edge_type == wd.ET_WALL:
+        block[r.outside] = wd.BK_WALL
+
+    color = color.copy()
+    color[block == wd.BK_WALL] = COLOR_WALL
+    color[block == wd.BK_WALLG] = COLOR_WALLG
+    color[block == wd.BK_UNKNOWN] = COLOR_UNKNOWN
+    lit = ((block == wd.BK_WALL) | (block == wd.BK_WALLG) |
+           (block == wd.BK_UNKNOWN))
+
+    # Ambient lighting on this face
+    ambient = numpy.ones(len(block), dtype=numpy.float32)
+    ambient[r.last_step[:,1] == -1] = LIGHTEN
+    ambient[r.last_step[:,1] == 1] = DARKEN
+
+    # Diffuse lighting, reusing the camera's position as light source
+    normal = -r.last_step.astype(numpy.float32)
+    diffuse = numpy.sum(normal * r.v[:,0:3], axis=1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        diffuse = numpy.where(diffuse < 0,
+            f32(0.5) - diffuse / (f32(0.6) * r.t), f32(0.0))
+
+    color[lit,0:3] = numpy.minimum(color[lit,0:3] * ambient[lit,None], 1.0)
+    color[lit,0:3] = numpy.minimum(color[lit,0:3] * diffuse[lit,None], 1.0)
+
+    if edge_type != wd.ET_WALL:
+        color[r.outside] = (0.0, 0.0, 0.0, 1.0)
+    return color
+
+def trace(world, u, v, skip_empty=True):
+    """
+    trace: colour the rays starting at points u along unit vectors v
+    (both (N,4) arrays). Returns the (N,4) ray colors, and the number of
+    traversal iterations each ray took, portals it went through and
+    voxels it moved through (see ray_state.voxels).
+    """
+    n = len(u)
+    r = ray_state(world, u, v, skip_empty, entities=True)
+    colors = numpy.zeros((n,4), dtype=numpy.float32)
+    iterations = numpy.zeros(n, dtype=numpy.int32)
+    crossings = numpy.zeros(n, dtype=numpy.int32)
+    voxels = numpy.zeros(n, dtype=numpy.int32)
+
+    # FIXME assuming camera is always inside the grid
+    color = color_ray(r, colors)
+    r.entities()
+
+    ids = numpy.arange(n)
+    for i in xrange(LOOP_LIMIT):
+        if len(ids) == 0:
+            break
+        r.advance()
+        hit = r.entities()
+        color = color_ray(r, color)
+        color[hit] = shade_entities(r, hit)
+        iterations[ids] += 1
+
+        done = color[:,3] == 1.0
+        if done.any():
+            colors[ids[done]] = color[done]
+            crossings[ids[done]] = r.crossings[done]
+            voxels[ids[done]] = r.voxels[done]
+            keep = ~done
+            r.compress(keep)
+            (ids, color) = (ids[keep], color[keep])
+    colors[ids] = color
+    crossings[ids] = r.crossings
+    voxels[ids] = r.voxels
+
+    return (colors, iterations, crossings, voxels)
+
+def raycast(world, u, v, max_dist, skip_empty=True):
+    """
+    raycast: follow the rays starting at points u along unit vectors v
+    (both (N,4) arrays) through portals until each enters a solid block or
+    gets further than max_dist - the raycast kernel in raytrace.cl.
+    Returns (hit, voxel, normal, dist): whether each ray hit a block, the
+    (N,3) coordinates of that block and the normal of the face it entered
+    by, and how far along the ray it was. Rays that missed have voxel -1
+    and dist infinity.
+    """
+    n = len(u)
+    r = ray_state(world, u, v, skip_empty)
+    hit = numpy.zeros(n, dtype=bool)
+    voxel = numpy.empty((n,3), dtype=numpy.int32)
+    voxel[:] = -1
+    normal = numpy.zeros((n,3), dtype=numpy.int32)
+    dist = numpy.empty(n, dtype=numpy.float32)
+    dist[:] = INF
+
+    ids = numpy.arange(n)
+    for i in xrange(LOOP_LIMIT):
+        if len(ids) == 0:
+            break
+        r.advance()
+
+        missed = r.outside | (r.t > max_dist)
+        block = r.block()
+        found = ~missed & ~r.skipped & (block != wd.BK_AIR) & \
+            (portal_number(block) == -1)
+        if found.any():
+            j = ids[found]
+            hit[j] = True
+            voxel[j] = r.P[found]
+            normal[j] = -r.last_step[found]
+            dist[j] = r.t[found]
+
+        done = found | missed
+        if done.any():
+            keep = ~done
+            r.compress(keep)
+            ids = ids[keep]
+
+    return (hit, voxel, normal, dist)
+
+def heat_colors(iterations, limit_hit):
+    """ heat_colors: the (N,4) traversal-cost heatmap colours for rays that
+    took iterations, or ran out of them where limit_hit - the same as
+    heat_color in raytrace.cl """
+    h = iterations.astype(numpy.float32) / f32(LOOP_LIMIT)
+    colors = numpy.empty((len(h),4), dtype=numpy.float32)
+    colors[:,0] = numpy.clip(2*h - 1, 0, 1)
+    colors[:,1] = 1 - numpy.abs(2*h - 1)
+    colors[:,2] = numpy.clip(1 - 2*h, 0, 1)
+    colors[:,3] = 1
+    colors[limit_hit] = 1
+    return colors
+
+def stats_summary(iterations, crossings, limit_hit):
+    """ stats_summary: the mean and max traversal iterations and portal
+    crossings per pixel, and the fraction of pixels whose rays hit
+    LOOP_LIMIT, from per-pixel arrays of them """
+    return {"mean_iterations": float(iterations.mean()),
+            "max_iterations": int(iterations.max()),
+            "mean_crossings": float(crossings.mean()),
+            "max_crossings": int(crossings.max()),
+            "limit_hit": float(limit_hit.mean())}
+
+def frame_diff(a, b, tolerance=2):
+    """ frame_diff: the fraction of pixels in which two (height, width, 4)
+    uint8 frames differ by more than tolerance in any channel """
+    d = numpy.abs(a.astype(numpy.int32) - b.astype(numpy.int32))
+    return numpy.mean(numpy.any(d > tolerance, axis=2))
+
+class raynp(object):
+    """
+    Renders the world's camera view with the numpy reference tracer. Has
+    the same execute/read_frame interface as raycl.raycl_offscreen.
+    """
+    def __init__(self, tex_dim, world, skip_empty=True):
+        self.tex_dim = tex_dim
+        self.render_dim = tex_dim
+        self.world = world
+        self.skip_empty = skip_empty
+
+        self.frame = numpy.zeros((tex_dim[1], tex_dim[0], 4),
+            dtype=numpy.uint8)
+        # Traversal iterations and portal crossings per pixel in the last
+        # frame, and whether each ray hit LOOP_LIMIT
+        self.iterations = numpy.zeros((tex_dim[1], tex_dim[0]),
+            dtype=numpy.int32)
+        self.crossings = numpy.zeros((tex_dim[1], tex_dim[0]),
+            dtype=numpy.int32)
+        self.limit_hit = numpy.zeros((tex_dim[1], tex_dim[0]),
+            dtype=bool)
+        # Voxels each ray moved through, however many iterations that took
+        self.voxels = numpy.zeros((tex_dim[1], tex_dim[0]),
+            dtype=numpy.int32)
+        # Render the traversal-cost heatmap rather than the view
+        self.heatmap = False
+        self.trace_time = 0.0
+        # camera_directions tables, by FOV and render size
+        self.direction_tables = {}
+        # Frames are only rendered when the view or map have changed
+        self.skip_unchanged = True
+        self.last_key = None
+        self.frames_skipped = 0
+
+    def set_render_dim(self, render_dim):
+        """ set_render_dim: render later frames at render_dim, which must
+        be no bigger than tex_dim """
+        self.render_dim = render_dim
+
+    def set_heatmap(self, heatmap):
+        """ set_heatmap: render later frames as the traversal-cost heatmap
+        (see heat_colors) rather than the view, or not """
+        if heatmap != self.heatmap:
+            self.heatmap = heatmap
+            self.last_key = None
+
+    def changed(self):
+        """ changed: whether the view or map have changed since the last
+        frame was rendered """
+        key = (self.world.view_key(), self.render_dim)
+        if self.skip_unchanged and key == self.last_key:
+            self.frames_skipped += 1
+            return False
+        self.last_key = key
+        return True
+
+    def execute(self):
+        """ execute: render a frame, unless nothing has changed since the
+        last one; returns whether it did """
+        if not self.changed():
+            return False
+        time_start = time.time()
+        cam = self.world.camera
+        (fov_from, fov_to, s) = cam.fov_transition()
+        n = mix_directions(self.direction_table(fov_from),
+            self.direction_table(fov_to), s)
+        v = rotate(n, cam.rot_x, cam.rot_y)
+        u = numpy.empty(v.shape, dtype=numpy.float32)
+        u[:] = (cam.x, cam.y, cam.z, 1.0)
+
+        (colors, iterations, crossings, voxels) = trace(self.world, u, v,
+            self.skip_empty)
+        # Rays that never hit anything are the ones still transparent
+        limit_hit = colors[:,3] != 1.0
+        if self.heatmap:
+            colors = heat_colors(iterations, limit_hit)
+
+        shape = (self.render_dim[1], self.render_dim[0])
+        colors = numpy.clip(colors, 0.0, 1.0).reshape(shape + (4,))
+        self.frame[0:shape[0],0:shape[1]] = numpy.round(colors * 255)
+        self.iterations = iterations.reshape(shape)
+        self.crossings = crossings.reshape(shape)
+        self.voxels = voxels.reshape(shape)
+        self.limit_hit = limit_hit.reshape(shape)
+        self.trace_time = time.time() - time_start
+        return True
+
+    def direction_table(self, fov):
+        key = (fov, self.render_dim)
+        if key not in self.direction_tables:
+            cam = self.world.camera
+            self.direction_tables[key] = camera_directions(cam.fov_x(fov),
+                cam.fov_y(fov), self.render_dim)
+        return self.direction_tables[key]
+
+    def kernel_time(self):
+        """ kernel_time: seconds spent tracing the last frame """
+        return self.trace_time
+
+    def stage_times(self):
+        return {"kernel": self.trace_time}
+
+    def read_frame(self):
+        """ read_frame: return the last rendered frame as a
+        (height, width, 4) uint8 numpy array """
+        (w, h) = self.render_dim
+        return self.frame[0:h,0:w]
+
+    def read_stats(self):
+        """ read_stats: (iterations, crossings, limit_hit) of each pixel
+        of the last frame, as (height, width) arrays """
+        return (self.iterations, self.crossings, self.limit_hit)
+
+    def traversal_stats(self):
+        """ traversal_stats: stats_summary of the last frame """
+        return stats_summary(*self.read_stats())
@@ -1,6 +1,21 @@
-/* Size of the texture currently hard-coded */
+/* Size of the texture, normally passed in as build options by raycl */
+#ifndef SCREEN_W
 #define SCREEN_W 640
+#endif
+#ifndef SCREEN_H
 #define SCREEN_H 480
+#endif
+
+/* How work-items map to pixels (chosen by raycl's autotuner): a 2-D
+   range over the screen, or a 1-D range over TILE_W x TILE_H tiles with
+   each tile's pixels in row order or in Morton (Z-curve) order, so that
+   the rays of a work-group are close together */
+#define ORDER_2D     0
+#define ORDER_TILED  1
+#define ORDER_MORTON 2
+#ifndef PIXEL_ORDER
+#define PIXEL_ORDER ORDER_2D
+#endif
 
 /* With the current algorithm, this is the maximum number of voxels to
    traverse */
@@ -9,6 +24,8 @@
 /* Colors for the various sides of wall blocks */
 #define COLOR_WALL  ((float4)(0.45,0.75,0.75,1.0))
 #define COLOR_WALLG  ((float4)(0.45,0.75,0.45,1.0))
+#define COLOR_UNKNOWN  ((float4)(0.4,0.4,0.45,1.0))
+#define COLOR_ENTITY  ((float4)(0.85,0.5,0.25,1.0))
 
 /* Multipliers for calculating shading on block faces */
 #define LIGHTEN (4.0/3.0)
@@ -23,26 +40,72 @@
 #define BK_AIR      0
 #define BK_WALL     1
 #define BK_WALLG    2
+#define BK_UNKNOWN  3
 #define BK_PORTAL(X)  (255-(X))
 
 /* Handy macro for computing nearest axis boundary */
 #define POSITIVE(X) ((X) > 0 ? (X) : 0)
 
-/* Offset of grid within mapdat */
-#define GRID_OFF 4
+/* Brick map layout - see world.py */
+#ifndef BRICK_SHIFT
+#define BRICK_SHIFT 3
+#endif
+#define BRICK_MASK ((1 << BRICK_SHIFT) - 1)
+
+/* Number of step directions in the portal exit table - see world.py */
+#define PORTAL_DIRS 6
+
+/* Layout of the mapinfo header */
+#define MI_X_SIZE    0
+#define MI_Y_SIZE    1
+#define MI_Z_SIZE    2
+#define MI_EDGE_TYPE 3
+#define MI_BRICKS_X  4
+#define MI_BRICKS_Y  5
+#define MI_BRICKS_Z  6
 
 typedef struct world_t {
-    uchar4 bounds;
+    int4 bounds;
+    int4 brick_bounds;
     uint edge_type;
-    __constant uchar *grid;
+    __global const uint *brick_index;
+    __global const uchar *bricks;
     __constant float *portals;
+    __global const uchar *brick_dist;
+    __global const uint *exit_index;
+    __global const uchar *portal_exits;
+#ifdef ENTITIES
+    /* Entities, binned by brick (see entitygrid.py); only the raytrace
+       kernel draws them, and for the others ent_dist is 0 */
+    __global const uint *ent_index;
+    __global const uint2 *ent_bins;
+    __global const float4 *ent_spheres;
+    __global const uchar *ent_dist;
+#endif
 } world_t;
 
 typedef struct ray_t {
-    int4 P;
+    /* Equation of the ray = u + vt */
+    float4 u, v;
+    float t;
+    int4 P;             /* Current voxel coordinates */
+    char4 step;
+    float4 tmax;
+    float4 dt;
+    int4 justOut;
     float4 ray_color;
     uint outside;
+    uint skipped;
     char4 last_step;
+    uint crossings;     /* Number of portals passed through */
+#ifdef ENTITIES
+    /* The nearest entity found that the ray enters at t >= ent_t_min
+       (since its last portal), and the normal there */
+    float ent_t, ent_t_min;
+    float4 ent_normal;
+    uint ent_brick;     /* Brick whose entities were looked at last */
+    uint ent_crossings; /* crossings when ent_t_min was set */
+#endif
 } ray_t;
 
 /* `shading' values > 1.0 brighten, < 1.0 darken. */
@@ -53,27 +116,6 @@ float4 color_mix_shade(float4 color, float shading) {
                     color.w);
 }
 
-float4 vec_add_f4_c4(float4 a, char4 b) {
-    return (float4)(a.x + b.x,
-                    a.y + b.y,
-                    a.z + b.z,
-                    a.w + b.w);
-}
-
-int4 vec_add_i4_c4(int4 a, char4 b) {
-    return (int4)(a.x + b.x,
-                  a.y + b.y,
-                  a.z + b.z,
-                  a.w + b.w);
-}
-
-char4 vec_scale_c_c4(char s, char4 v) {
-    return (char4)(s*v.x,
-                   s*v.y,
-                   s*v.z,
-                   s*v.w);
-}
-
 float dot_prod(float4 i, float4 j) {
     return i.x * j.x + i.y * j.y + i.z * j.z + i.w * j.w;
 }
@@ -90,16 +132,73 @@ float4 apply_matrix(float16 m_, float4 v) {
     #undef ELE
 }
 
+bool in_grid(world_t w, int4 P) {
+    return P.x >= 0 && P.x < w.bounds.x &&
+           P.y >= 0 && P.y < w.bounds.y &&
+           P.z >= 0 && P.z < w.bounds.z;
+}
+
+/* Offset into brick_index of the brick holding cell P */
+uint brick_off(world_t w, int4 P) {
+    return (P.x >> BRICK_SHIFT) +
+        (P.y >> BRICK_SHIFT) * w.brick_bounds.x +
+        (P.z >> BRICK_SHIFT) * w.brick_bounds.x * w.brick_bounds.y;
+}
+
+/* Offset of cell P within its brick */
+uint cell_off(int4 P) {
+    return (P.x & BRICK_MASK) +
+        ((P.y & BRICK_MASK) << BRICK_SHIFT) +
+        ((P.z & BRICK_MASK) << (2*BRICK_SHIFT));
+}
+
+/* Cells outside the grid (which rays can land in after going through a
+   portal) read as air. */
 uchar grid_get(world_t w, int4 P) {
-    return w.grid[P.x + (P.y * w.bounds.x) +
-        (P.z * w.bounds.x * w.bounds.y)];
+    if (!in_grid(w, P))
+        return BK_AIR;
+
+    uint brick = w.brick_index[brick_off(w, P)];
+    return w.bricks[(brick << (3*BRICK_SHIFT)) + cell_off(P)];
 }
 
-/* Returns the portal number if the block is a portal, or otherwise -1. */
+/* Chebyshev distance from P's brick to the nearest non-empty brick (see
+   MAX_BRICK_DIST in world.py), or to the nearest brick with entities in
+   it if that is closer, or 0 outside the grid. */
+uchar brick_dist_get(world_t w, int4 P) {
+    if (!in_grid(w, P))
+        return 0;
+    uint b = brick_off(w, P);
+#ifdef ENTITIES
+    if (w.ent_dist)
+        return min(w.brick_dist[b], w.ent_dist[b]);
+#endif
+    return w.brick_dist[b];
+}
+
+/* Returns the portal number if the block is a portal, or otherwise -1.
+   A kernel specialized for a map only looks for the N_PORTALS portal
+   numbers it uses, counting portal blocks with no matrix set
+   (world.portals_in_use), so it agrees with world.portal_block on every
+   block in the map; with none, all the portal handling compiles away. */
 char is_portal_block(uchar block_type) {
+#ifdef N_PORTALS
+    return block_type > BK_PORTAL(N_PORTALS) ? 255 - block_type : -1;
+#else
     return block_type >= BK_PORTAL(8) && block_type <= BK_PORTAL(0)
         ? 255 - block_type
         : -1;
+#endif
+}
+
+/* Number of steps along step from portal cell P to the first cell past
+   the portal volume, from the table built by world.portal_exit_table */
+uchar portal_exit_steps(world_t w, int4 P, char4 step) {
+    uint dir = (step.x != 0 ? 0 : step.y != 0 ? 2 : 4) +
+        (step.x + step.y + step.z > 0);
+    uint exits = w.exit_index[brick_off(w, P)];
+    return w.portal_exits[((exits * PORTAL_DIRS + dir) << (3*BRICK_SHIFT)) +
+        cell_off(P)];
 }
 
 float16 get_portal(world_t w, uchar i) {
@@ -112,9 +211,65 @@ float16 get_portal(world_t w, uchar i) {
     return result;
 }
 
-/* Returns new ray_color. Halts ray if alpha is 1.0f.
-   v is the unit vector of the ray; t is how far down the ray we are. */
-float4 color_ray(world_t w, ray_t r, float4 v, float t)
+/* The color of a block type, or transparent for types with none */
+float4 block_color(uchar block_type)
+{
+    switch (block_type) {
+    case BK_WALL:
+        return COLOR_WALL;
+    case BK_WALLG:
+        return COLOR_WALLG;
+    case BK_UNKNOWN:
+        return COLOR_UNKNOWN;
+    }
+    return (float4)(0.0f, 0.0f, 0.0f, 0.0f);
+}
+
+/* Shade color on the face of a block that a ray along v, having last
+   stepped along last_step, hit at distance t */
+float4 shade_face(float4 color, char4 last_step, float4 v, float t)
+{
+    /* Calculate ambient lighting on this face */
+    if (last_step.y == -1) {
+        // viewing block from above
+        color = color_mix_shade(color, LIGHTEN);
+    } else if (last_step.y == 1) {
+        // viewing block from below
+        color = color_mix_shade(color, DARKEN);
+    }
+
+    /* Calculate diffuse lighting, reusing camera's position
+       as light source. */
+    float4 normal = (float4)(-last_step.x,
+                           -last_step.y,
+                           -last_step.z,
+                           -last_step.w);
+    float diffuse_light = dot_prod(normal, v);
+    /* The dot-product gives us -1.0 for fully lit surfaces,
+       and 0.0 or < 0.0 for orthogonal and far surfaces */
+    if (diffuse_light < 0.0f)
+        /* Some magic numbers to make things look nice.
+           Technically, it should be 1/t^2, but who cares about
+           realism? */
+        diffuse_light = 0.5f - diffuse_light / (0.6f * t);
+    else
+        diffuse_light = 0.0f;
+    return color_mix_shade(color, diffuse_light);
+}
+
+#ifdef ENTITIES
+/* Shade an entity's color at the point of its sphere with the given
+   normal that a ray along v entered at distance t, lit like block faces:
+   lighter on top, darker underneath, and by the camera */
+float4 shade_entity(float4 normal, float4 v, float t)
+{
+    float4 color = color_mix_shade(COLOR_ENTITY, 1.0f + normal.y / 3.0f);
+    return color_mix_shade(color, 0.5f - dot_prod(normal, v) / (0.6f * t));
+}
+#endif
+
+/* Returns new ray_color. Halts ray if alpha is 1.0f. */
+float4 color_ray(world_t w, ray_t r)
 {
     uchar block_type = BK_AIR;
 
@@ -133,230 +288,685 @@ float4 color_ray(world_t w, ray_t r, float4 v, float t)
     float4 new_ray_color = r.ray_color;
 
     if (block_type != BK_AIR) {
-        bool set_color = false;
+        float4 color = block_color(block_type);
+        if (color.w == 1.0f)
+            new_ray_color = shade_face(color, r.last_step, r.v, r.t);
+    }
 
-        switch (block_type) {
-        case BK_WALL:
-            new_ray_color = COLOR_WALL;
-            set_color = true;
-            break;
-        case BK_WALLG:
-            new_ray_color = COLOR_WALLG;
-            set_color = true;
-            break;
+    return new_ray_color;
+}
+
+/* Voxel traversal ray-tracing algorithm based on John Amanatides' and
+   Andrew Woo's paper. The traversal is shared by the raytrace and raycast
+   kernels: ray_init sets a ray up, and each ray_advance moves it on to
+   the next voxel to look at. */
+
+/* step = (stepX, stepY, stepZ) = values are either 1, 0, or -1.
+   Components are determined from the sign of the components of v */
+void ray_reset_step(ray_t *r) {
+    r->step = (char4)((char)sign(r->v.x), (char)sign(r->v.y),
+                      (char)sign(r->v.z), 0);
+}
+
+/* tmax = (tmaxX, tmaxY, tmaxZ) = values of t at which ray next crosses a
+   voxel boundary in the respective direction. The "step.dim ?"
+   conditionalisation is because we want infinity, not NaN, when v.dim is
+   0. NaN would cause an infinite loop in portal rendering. */
+void ray_reset_tmax(ray_t *r) {
+    r->tmax = (float4)(
+        r->step.x ? (r->P.x + POSITIVE(r->step.x) - r->u.x)/r->v.x : INFINITY,
+        r->step.y ? (r->P.y + POSITIVE(r->step.y) - r->u.y)/r->v.y : INFINITY,
+        r->step.z ? (r->P.z + POSITIVE(r->step.z) - r->u.z)/r->v.z : INFINITY,
+        0.0f);
+}
+
+/* dt = (dtX, dtY, dtZ) = how far along ray (in units of t) we must move
+   for x/y/z component of move to equal width of one voxel */
+void ray_reset_dt(ray_t *r) {
+    r->dt = (float4)(r->step.x / r->v.x, r->step.y / r->v.y,
+                     r->step.z / r->v.z, 0.0f);
+}
+
+/* justOut vector - used for checking we remain within the bounds of the
+   grid */
+void ray_reset_justout(world_t w, ray_t *r) {
+    r->justOut = (int4)(r->step.x == -1 ? -1 : w.bounds.x,
+                        r->step.y == -1 ? -1 : w.bounds.y,
+                        r->step.z == -1 ? -1 : w.bounds.z,
+                        0);
+}
+
+/* u is the starting point of the ray and v the unit vector along it */
+void ray_init(world_t w, ray_t *r, float4 u, float4 v) {
+    r->u = u;
+    r->v = v;
+    r->t = 0.0f;
+
+    r->P = (int4)((int)u.x, (int)u.y, (int)u.z, 1);
+    // TODO handle P being outside bounds of grid
+
+    ray_reset_step(r);
+    ray_reset_tmax(r);
+    ray_reset_dt(r);
+    ray_reset_justout(w, r);
+
+    r->ray_color = (float4)(0.0f, 0.0f, 0.0f, 0.0f);
+    r->outside = false;
+    r->skipped = false;
+    r->last_step = (char4)(0,0,0,0);
+    r->crossings = 0;
+#ifdef ENTITIES
+    r->ent_t = INFINITY;
+    r->ent_t_min = 0.0f;
+    r->ent_brick = UINT_MAX;
+    r->ent_crossings = 0;
+#endif
+}
+
+/* Empty-space skipping: in an empty brick whose neighbours out to distance
+   d-1 are all empty too, jump straight to the last voxel before the far
+   side of that cube of bricks, and carry on one voxel at a time from
+   there. Never skip twice in a row, or a ray sitting on the face of the
+   cube would jump to where it already is. Returns whether it skipped. */
+bool ray_skip(world_t w, ray_t *r) {
+    int d = (r->outside || r->skipped) ? 0 : brick_dist_get(w, r->P);
+    if (d == 0) {
+        r->skipped = false;
+        return false;
+    }
+
+    int4 B = r->P >> BRICK_SHIFT;
+    int4 lo = max((B - (d - 1)) << BRICK_SHIFT, (int4)(0));
+    int4 hi = min(((B + d) << BRICK_SHIFT) - 1, w.bounds - 1);
+    float4 t_exit = (float4)(
+        r->step.x ? ((r->step.x > 0 ? hi.x + 1 : lo.x) - r->u.x)/r->v.x
+                  : INFINITY,
+        r->step.y ? ((r->step.y > 0 ? hi.y + 1 : lo.y) - r->u.y)/r->v.y
+                  : INFINITY,
+        r->step.z ? ((r->step.z > 0 ? hi.z + 1 : lo.z) - r->u.z)/r->v.z
+                  : INFINITY,
+        0.0f);
+    r->t = fmin(t_exit.x, fmin(t_exit.y, t_exit.z));
+    lo.w = hi.w = 1;
+    r->P = clamp(convert_int4(floor(r->u + r->v*r->t)), lo, hi);
+    ray_reset_tmax(r);
+    r->skipped = true;
+    return true;
+}
+
+/* Step into whichever neighbouring voxel the ray crosses into first */
+void ray_step(ray_t *r) {
+    #define STEP(dim) do { \
+                        r->P.dim += r->step.dim; \
+                        r->last_step = (char4)(0,0,0,0); \
+                        r->last_step.dim = r->step.dim; \
+                        r->t = r->tmax.dim; \
+                        if (r->P.dim == r->justOut.dim) { \
+                            r->outside = true; \
+                        } else \
+                        r->tmax.dim += r->dt.dim; \
+                      } while (0)
+
+    if (r->tmax.x < r->tmax.y) {
+        if (r->tmax.x < r->tmax.z) {
+            STEP(x);
+        } else {
+            STEP(z);
         }
+    } else {
+        if (r->tmax.y < r->tmax.z) {
+            STEP(y);
+        } else {
+            STEP(z);
+        }
+    }
+    #undef STEP
+}
+
+/* If the ray has just stepped into a portal, carry it through to the
+   voxel on the other side */
+void ray_cross_portal(world_t w, ray_t *r) {
+    char portal_num;
+    if (r->outside ||
+        (portal_num = is_portal_block(grid_get(w, r->P))) == -1)
+        return;
+
+    float16 portal = get_portal(w, portal_num);
+    r->crossings++;
+
+    // Step to the opposite (back) face of the portal
+    float steps = portal_exit_steps(w, r->P, r->last_step);
+    r->u += convert_float4(r->last_step) * steps;
+
+    // Now apply the portal transformation
+    r->u = apply_matrix(portal, r->u);
+    r->v = apply_matrix(portal, r->v);
+    r->P = (int4)((int)(r->u.x + r->v.x*r->t),
+                  (int)(r->u.y + r->v.y*r->t),
+                  (int)(r->u.z + r->v.z*r->t),
+                  1);
+    ray_reset_step(r);
+    ray_reset_dt(r);
+    ray_reset_tmax(r);
+    ray_reset_justout(w, r);
+}
+
+/* Move the ray on. Returns false if it only skipped empty space, in which
+   case the voxel it is now in is known to be air. */
+bool ray_advance(world_t w, ray_t *r) {
+#ifdef SKIP_EMPTY
+    if (ray_skip(w, r))
+        return false;
+#endif
+    ray_step(r);
+    ray_cross_portal(w, r);
+    return true;
+}
 
-        if (set_color) {
-            /* Calculate ambient lighting on this face */
-            if (r.last_step.y == -1) {
-                // viewing block from above
-                new_ray_color = color_mix_shade(new_ray_color, LIGHTEN);
-            } else if (r.last_step.y == 1) {
-                // viewing block from below
-                new_ray_color = color_mix_shade(new_ray_color, DARKEN);
-            }
-
-            /* Calculate diffuse lighting, reusing camera's position
-               as light source. */
-            float4 normal = (float4)(-r.last_step.x,
-                                   -r.last_step.y,
-                                   -r.last_step.z,
-                                   -r.last_step.w);
-            float diffuse_light = dot_prod(normal, v);
-            /* The dot-product gives us -1.0 for fully lit surfaces,
-               and 0.0 or < 0.0 for orthogonal and far surfaces */
-            if (diffuse_light < 0.0f)
-                /* Some magic numbers to make things look nice.
-                   Technically, it should be 1/t^2, but who cares about
-                   realism? */
-                diffuse_light = 0.5f - diffuse_light / (0.6f * t);
-            else
-                diffuse_light = 0.0f;
-            new_ray_color = color_mix_shade(new_ray_color, diffuse_light);
+#ifdef ENTITIES
+/* Look through the entity spheres binned in brick b for one the ray
+   enters nearer than ent_t. Only where it enters counts, so the sphere
+   the camera is in (the player's) is not seen from inside. */
+void ray_find_entities(world_t w, ray_t *r, uint b) {
+    uint2 bin = w.ent_bins[w.ent_index[b]];
+    for (uint i = bin.x; i < bin.x + bin.y; i++) {
+        float4 s = w.ent_spheres[i];
+        float4 d = r->u - (float4)(s.x, s.y, s.z, 1.0f);
+        float a = dot_prod(r->v, r->v);
+        float h = dot_prod(d, r->v);
+        float disc = h*h - a*(dot_prod(d, d) - s.w*s.w);
+        if (disc < 0.0f)
+            continue;
+        float t = (-h - sqrt(disc)) / a;
+        if (t >= r->ent_t_min && t < r->ent_t) {
+            r->ent_t = t;
+            r->ent_normal = (d + r->v*t) / s.w;
         }
     }
+}
 
-    return new_ray_color;
+/* Called each time the ray moves on: returns whether it entered the
+   nearest entity found before getting to the voxel it is now in, and if
+   not, looks at the entities binned in the voxel's brick when the ray
+   has just got to it. The hit point of an entity is in a brick it is
+   binned in, which the ray visits before passing it, and empty-space
+   skipping never jumps over those bricks. */
+bool ray_entities(world_t w, ray_t *r) {
+    if (r->ent_t <= r->t)
+        return true;
+    if (r->crossings != r->ent_crossings) {
+        /* Anything found beyond the portal the ray has just gone through
+           was in the space it has left */
+        r->ent_t = INFINITY;
+        r->ent_t_min = r->t;
+        r->ent_brick = UINT_MAX;
+        r->ent_crossings = r->crossings;
+    }
+    if (r->outside || !in_grid(w, r->P))
+        return false;
+    uint b = brick_off(w, r->P);
+    if (b != r->ent_brick) {
+        r->ent_brick = b;
+        ray_find_entities(w, r, b);
+    }
+    return false;
+}
+#endif
+
+/* Gathers the even bits of x into the low half, to decode Morton order */
+uint morton_compact(uint x) {
+    x &= 0x55555555;
+    x = (x ^ (x >> 1)) & 0x33333333;
+    x = (x ^ (x >> 2)) & 0x0f0f0f0f;
+    x = (x ^ (x >> 4)) & 0x00ff00ff;
+    x = (x ^ (x >> 8)) & 0x0000ffff;
+    return x;
+}
+
+/* The screen pixel this work-item renders, for a launch over the band of
+   rows from band_y down. The launch may be rounded up to a whole number
+   of work-groups, so it can be off the screen or below the band. */
+int2 pixel_pos(int band_y) {
+#if PIXEL_ORDER == ORDER_2D
+    return (int2)(get_global_id(0), get_global_id(1) + band_y);
+#else
+    uint i = get_global_id(0);
+    uint tile = i / (TILE_W * TILE_H), j = i % (TILE_W * TILE_H);
+    uint tiles_x = (SCREEN_W + TILE_W - 1) / TILE_W;
+#if PIXEL_ORDER == ORDER_MORTON
+    int2 in_tile = (int2)(morton_compact(j), morton_compact(j >> 1));
+#else
+    int2 in_tile = (int2)(j % TILE_W, j / TILE_W);
+#endif
+    return (int2)((tile % tiles_x) * TILE_W,
+                  (tile / tiles_x) * TILE_H + band_y) + in_tile;
+#endif
 }
 
-__kernel void raytrace(__write_only __global image2d_t bmp,
-    float rot_x, float rot_y, float cam_x, float cam_y, float cam_z,
-    float fov_x, float fov_y, __constant uchar *mapdat)
+/* Turn the camera-space vector n into world coords, for a camera rotated
+   by the angles with the given sines and cosines */
+float4 rotate_dir(float4 n, float sin_x, float cos_x, float sin_y,
+                  float cos_y)
 {
-    world_t w;
-    w.bounds = (uchar4)(mapdat[0], mapdat[1], mapdat[2], 0); /* Grid dimensions */
-    w.edge_type = mapdat[3];
-    w.grid = &mapdat[GRID_OFF];
-    w.portals = (__constant float *)&mapdat[GRID_OFF +
-        w.bounds.x*w.bounds.y*w.bounds.z];
+    return (float4)(
+      n.x*cos_x + n.y*sin_x*sin_y + n.z*sin_x*cos_y,
+      n.y*cos_y - n.z*sin_y,
+      -n.x*sin_x + n.y*cos_x*sin_y + n.z*cos_x*cos_y,
+      0.0f);
+}
 
-    /* Screen pixel position: */
-    int2 p_pos = (int2)(get_global_id(0), get_global_id(1));
+/* The reverse of rotate_dir */
+float4 unrotate_dir(float4 v, float sin_x, float cos_x, float sin_y,
+                    float cos_y)
+{
+    return (float4)(
+      v.x*cos_x - v.z*sin_x,
+      v.x*sin_x*sin_y + v.y*cos_y + v.z*cos_x*sin_y,
+      v.x*sin_x*cos_y - v.y*sin_y + v.z*cos_x*cos_y,
+      0.0f);
+}
 
+#ifdef HEATMAP
+/* The traversal-cost heatmap (see raycl.set_heatmap) colours each pixel by
+   the number of iterations its ray took: blue for none, through green at
+   LOOP_LIMIT/2, to red at LOOP_LIMIT. Rays that ran out of iterations
+   without hitting anything are white. */
+float4 heat_color(uint iterations, bool limit_hit)
+{
+    if (limit_hit)
+        return (float4)(1.0f, 1.0f, 1.0f, 1.0f);
+    float h = (float)iterations / LOOP_LIMIT;
+    return (float4)(clamp(2.0f*h - 1.0f, 0.0f, 1.0f),
+                    1.0f - fabs(2.0f*h - 1.0f),
+                    clamp(1.0f - 2.0f*h, 0.0f, 1.0f), 1.0f);
+}
+#endif
+
+#ifdef REPROJECT
+/* Reprojection (see raycl.prepare_reprojection): the hit points of the
+   last frame are carried into the current view, and only the pixels none
+   of them lands on are traced again. The cams buffer holds both cameras,
+   each as a position (x, y, z, -) followed by the sines and cosines of
+   its rotation (sin x, cos x, sin y, cos y), and then the FOV: */
+#define CAM_LAST  0
+#define CAM_NOW   8
+#define CAM_FOV_X 16
+#define CAM_FOV_Y 17
+
+/* How far the depth of a reprojected pixel may be from what its
+   neighbours' depths predict, as a fraction of it (see
+   reproject_disoccluded) */
+#define REPROJECT_DEPTH_TOL 0.1f
+
+/* What a ray hit is kept as the block type and the step into it, so that
+   the face can be shaded again for the new view */
+uint pack_hit(uchar block_type, char4 last_step) {
+    return as_uint((char4)(block_type, last_step.x, last_step.y,
+                           last_step.z));
+}
+
+/* The pixel of the current view that the hit point of pixel p_off of the
+   last frame falls in, or -1 if there is no hit point or it is off the
+   screen; *dist is set to the hit point's distance from the camera */
+int reproject_pixel(uint p_off, __global const float *depth,
+    __global const float4 *dirs, __constant float *cams, float *dist)
+{
+    float t = depth[p_off];
+    if (t < 0.0f)
+        return -1;
+
+    __constant float *last = cams + CAM_LAST, *now = cams + CAM_NOW;
+    float4 v = rotate_dir(dirs[p_off], last[4], last[5], last[6], last[7]);
+    float4 d = (float4)(last[0] - now[0], last[1] - now[1],
+                        last[2] - now[2], 0.0f) + v * t;
+    *dist = sqrt(dot_prod(d, d));
+    if (*dist < 1e-6f)
+        return -1;
+
+    /* Work back from the camera-space direction to the pixel, inverting
+       raynp.camera_directions */
+    float4 n = unrotate_dir(d, now[4], now[5], now[6], now[7]) / *dist;
+    float fov_x = cams[CAM_FOV_X], fov_y = cams[CAM_FOV_Y];
+    float rz = atan2(n.x, n.z), rw = asin(clamp(-n.y, -1.0f, 1.0f));
+    int x = (int)rint((rz + fov_x / 2) * SCREEN_W / fov_x);
+    int y = (int)rint((rw + fov_y / 2) * SCREEN_H / fov_y);
+    if (fov_x >= 2 * M_PI_F)
+        x = (x + SCREEN_W) % SCREEN_W; /* The 360 degree view wraps round */
+    if (x < 0 || x >= SCREEN_W || y < 0 || y >= SCREEN_H)
+        return -1;
+    return y * SCREEN_W + x;
+}
 
-    float4 ray_rot = (float4)(rot_x, rot_y,
-                              (p_pos.x * fov_x) / SCREEN_W - fov_x/2,
-                              (p_pos.y * fov_y) / SCREEN_H - fov_y/2);
-    float4 rot_sin = sin(ray_rot),
-           rot_cos = cos(ray_rot);
+/* Whether the pixel at p, which a hit point of the last frame landed in,
+   may show something the last frame didn't see: a surface that has just
+   come into view is hidden by what was behind it, so its hit points are
+   missing and those from behind it land in its place. That leaves an edge
+   in the depths: hit points landing in the same pixel from depths more
+   than REPROJECT_DEPTH_TOL apart, or a depth that doesn't fit those of the
+   pixels either side of it (across or down), which on any surface lie on
+   a line through it in 1/depth, or a pixel beside it that nothing landed
+   in. Such pixels are traced. */
+bool reproject_disoccluded(int2 p, __global const int *zbuf,
+    __global const int *zmax)
+{
+    uint p_off = p.y * SCREEN_W + p.x;
+    float d = as_float(zbuf[p_off]);
+    if (as_float(zmax[p_off]) > d * (1.0f + REPROJECT_DEPTH_TOL))
+        return true;
+
+    for (int axis = 0; axis < 2; axis++) {
+        int2 step = axis == 0 ? (int2)(1, 0) : (int2)(0, 1);
+        int2 a = p - step, b = p + step;
+        if (a.x < 0 || a.y < 0 || b.x >= SCREEN_W || b.y >= SCREEN_H)
+            continue;
+        int za = zbuf[a.y * SCREEN_W + a.x], zb = zbuf[b.y * SCREEN_W + b.x];
+        if (za == INT_MAX || zb == INT_MAX)
+            return true;
+        float inv = 0.5f / as_float(za) + 0.5f / as_float(zb);
+        if (fabs(inv * d - 1.0f) > REPROJECT_DEPTH_TOL)
+            return true;
+    }
+    return false;
+}
+
+/* Where the ray along v from u meets the plane of the face that pixel
+   src of the last frame hit (as packed by pack_hit), if that is still a
+   face of the same block type, facing the ray: the hit point is only
+   carried over to the nearest pixel, so rather than its distance, the
+   ray's own is used, and a ray passing the edge of the face (onto
+   another block, or into the air past it) is traced instead. Returns
+   the distance along the ray, or -1. */
+float reproject_face(world_t w, float4 u, float4 v, int src, char4 packed,
+    __global const float *depth, __global const float4 *dirs,
+    __constant float *cams)
+{
+    __constant float *last = cams + CAM_LAST;
+    float4 q = (float4)(last[0], last[1], last[2], 0.0f) +
+        rotate_dir(dirs[src], last[4], last[5], last[6], last[7]) *
+        depth[src];
+    float4 normal = -convert_float4((char4)(packed.yzw, 0));
+    float along = dot_prod(v, normal);
+    if (along >= 0.0f)
+        return -1.0f;
+    float t = dot_prod(q - (float4)(u.xyz, 0.0f), normal) / along;
+    if (t <= 0.0f)
+        return -1.0f;
+
+    /* The cells either side of the face where the ray meets it: the one
+       in front, which the ray was in, must be in the grid */
+    float4 p = (float4)(u.xyz, 0.0f) + v * t;
+    int4 inside = convert_int4_rtn(p - normal * 0.5f);
+    int4 front = convert_int4_rtn(p + normal * 0.5f);
+    uchar block_type = in_grid(w, inside) ? grid_get(w, inside) :
+        w.edge_type == ET_WALL ? BK_WALL : BK_AIR;
+    if (block_type != (uchar)packed.x || !in_grid(w, front) ||
+        grid_get(w, front) != BK_AIR)
+        return -1.0f;
+    return t;
+}
+#endif
+
+world_t world_init(__constant int *mapinfo,
+    __global const uint *brick_index, __global const uchar *bricks,
+    __constant float *portals, __global const uchar *brick_dist,
+    __global const uint *exit_index, __global const uchar *portal_exits)
+{
+    world_t w;
+#ifdef MAP_X
+    /* Specialized for one map size and edge type (see raycl), so these
+       are compile-time constants */
+    w.bounds = (int4)(MAP_X, MAP_Y, MAP_Z, 0);
+    w.brick_bounds = (int4)((MAP_X + BRICK_MASK) >> BRICK_SHIFT,
+                            (MAP_Y + BRICK_MASK) >> BRICK_SHIFT,
+                            (MAP_Z + BRICK_MASK) >> BRICK_SHIFT, 0);
+    w.edge_type = MAP_EDGE_TYPE;
+#else
+    w.bounds = (int4)(mapinfo[MI_X_SIZE], mapinfo[MI_Y_SIZE],
+                      mapinfo[MI_Z_SIZE], 0); /* Grid dimensions */
+    w.brick_bounds = (int4)(mapinfo[MI_BRICKS_X], mapinfo[MI_BRICKS_Y],
+                            mapinfo[MI_BRICKS_Z], 0);
+    w.edge_type = mapinfo[MI_EDGE_TYPE];
+#endif
+    w.brick_index = brick_index;
+    w.bricks = bricks;
+    w.portals = portals;
+    w.brick_dist = brick_dist;
+    w.exit_index = exit_index;
+    w.portal_exits = portal_exits;
+#ifdef ENTITIES
+    w.ent_index = 0;
+    w.ent_bins = 0;
+    w.ent_spheres = 0;
+    w.ent_dist = 0;
+#endif
+    return w;
+}
+
+/* Renders the band_h rows of the screen from band_y down (all of them,
+   unless the frame is split between devices - see raycl.raycl_multi) */
+__kernel void raytrace(__write_only image2d_t bmp, int band_y, int band_h,
+    float rot_sin_x, float rot_cos_x, float rot_sin_y, float rot_cos_y,
+    float cam_x, float cam_y, float cam_z,
+    __global const float4 *dirs_from, __global const float4 *dirs_to,
+    float dir_mix, __constant int *mapinfo,
+    __global const uint *brick_index, __global const uchar *bricks,
+    __constant float *portals, __global const uchar *brick_dist,
+    __global const uint *exit_index, __global const uchar *portal_exits
+#ifdef ENTITIES
+    , __global const uint *ent_index, __global const uint2 *ent_bins,
+    __global const float4 *ent_spheres, __global const uchar *ent_dist
+#endif
+#ifdef REPROJECT
+    , __global float *depth_out, __global uint *hits_out,
+    __global const uint *hits_in, __global const int *source,
+    __global const int *zbuf, __global const int *zmax,
+    __global const float *depth_in, __constant float *cams, int reuse
+#endif
+#ifdef HEATMAP
+    /* Per pixel: (iterations, portal crossings, whether LOOP_LIMIT was
+       hit, -) */
+    , __global uint4 *stats
+#endif
+    )
+{
+    world_t w = world_init(mapinfo, brick_index, bricks, portals,
+                           brick_dist, exit_index, portal_exits);
+#ifdef ENTITIES
+    w.ent_index = ent_index;
+    w.ent_bins = ent_bins;
+    w.ent_spheres = ent_spheres;
+    w.ent_dist = ent_dist;
+#endif
+
+    /* Screen pixel position: */
+    int2 p_pos = pixel_pos(band_y);
+    if (p_pos.x >= SCREEN_W || p_pos.y >= band_y + band_h)
+        return;
+    uint p_off = p_pos.y * SCREEN_W + p_pos.x;
 
-    /* Voxel traversal ray-tracing algorithm based on John Amanatides'
-       and Andrew Woo's paper. */
-    
     /* n is the vector of the ray as if the camera was looking directly
-       down the z-axis without any rotation around it.
+       down the z-axis without any rotation around it. It depends only on
+       the FOV, so it comes from a table raycl works out once per FOV;
+       during a FOV transition, it is dir_mix of the way between the
+       tables for the FOVs before and after.
        Multiply it by rotation matrices to get v (below) */
-    float4 n = (float4)(rot_cos.w * rot_sin.z,
-                        -rot_sin.w,
-                        rot_cos.w * rot_cos.z,
-                        0.0f);
-    
-    ray_t r;
+    float4 n = dirs_from[p_off];
+    if (dir_mix != 0.0f) {
+        n = mix(n, dirs_to[p_off], dir_mix);
+        n /= sqrt(dot_prod(n, n));
+    }
 
     // v is the unit vector along the ray in actual world coords
-    float4 v = (float4)(
-      n.x*rot_cos.x + n.y*rot_sin.x*rot_sin.y + n.z*rot_sin.x*rot_cos.y,
-      n.y*rot_cos.y - n.z*rot_sin.y,
-      -n.x*rot_sin.x + n.y*rot_cos.x*rot_sin.y + n.z*rot_cos.x*rot_cos.y,
-      0.0f);
+    float4 v = rotate_dir(n, rot_sin_x, rot_cos_x, rot_sin_y, rot_cos_y);
 
     /* u is the starting point of the ray */
     float4 u = (float4)(cam_x, cam_y, cam_z, 1.0f);
-    // Thus equation of the ray = u + vt
-
-    float t = 0.0f;
-
-    // P = (X,Y,Z) = current voxel coordinates
-    r.P = (int4)((int)u.x, (int)u.y, (int)u.z, 1);
-    // TODO handle P being outside bounds of grid
-
-    /* step = (stepX, stepY, stepZ) = values are either 1, 0, or -1.
-       Components are determined from the sign of the components of v */
-    char4 step;
-    #define RESET_STEP do { \
-        step = (char4)((char)sign(v.x), (char)sign(v.y), \
-                       (char)sign(v.z), 0); \
-    } while (0)
-    RESET_STEP;
-
-    /* tmax = (tmaxX, tmaxY, tmaxZ) = values of t at which ray next
-       crosses a voxel boundary in the respective direction.
-       In RESET_TMAX, the "step.dim ?" conditionalisation is because we want
-       infinity, not NaN, when v.dim is 0. NaN would cause an infinite
-       loop in portal rendering. */
-    float4 tmax;
-    #define RESET_TMAX do { \
-        tmax = (float4)( \
-            step.x ? (r.P.x + POSITIVE(step.x) - u.x)/v.x : 1.0/0.0, \
-            step.y ? (r.P.y + POSITIVE(step.y) - u.y)/v.y : 1.0/0.0, \
-            step.z ? (r.P.z + POSITIVE(step.z) - u.z)/v.z : 1.0/0.0, \
-            0.0f); \
-    } while (0)
-    RESET_TMAX;
-
-    /* dt = (dtX, dtY, dtZ) = how far along ray (in units of t) we must
-       move for x/y/z component of move to equal width of one voxel */
-    float4 dt;
-    #define RESET_DT do { \
-        dt = (float4)(step.x / v.x, step.y / v.y, step.z / v.z, 0.0f); \
-    } while (0);
-    RESET_DT;
-
-    /* justOut vector - used for checking we remain within the bounds
-       of the grid */
-    int4 justOut;
-    #define RESET_JUSTOUT do { \
-        justOut = (int4)(step.x == -1 ? -1 : w.bounds.x, \
-                         step.y == -1 ? -1 : w.bounds.y, \
-                         step.z == -1 ? -1 : w.bounds.z, \
-                         0); \
-    } while (0)
-    RESET_JUSTOUT;
 
+#ifdef REPROJECT
+    /* If one of the last frame's hit points landed in this pixel (see
+       reproject_claim), shade the face it hit rather than tracing the ray
+       - unless it was an entity's, something else may have come into view
+       in front of it, or the ray misses that face */
+    int src = reuse ? source[p_off] : -1;
+    uint hit = src >= 0 && !reproject_disoccluded(p_pos, zbuf, zmax) ?
+        hits_in[src] : 0;
+    char4 packed = as_char4(hit);
+    float face_t = (uchar)packed.x != BK_AIR ?
+        reproject_face(w, u, v, src, packed, depth_in, dirs_from, cams) :
+        -1.0f;
+    if (face_t > 0.0f) {
+        hits_out[p_off] = hit;
+        depth_out[p_off] = face_t;
+#ifdef HEATMAP
+        stats[p_off] = (uint4)(0, 0, 0, 0);
+        write_imagef(bmp, p_pos, heat_color(0, false));
+#else
+        write_imagef(bmp, p_pos, shade_face(block_color((uchar)packed.x),
+            (char4)(packed.yzw, 0), v, face_t));
+#endif
+        return;
+    }
+#endif
 
-    r.ray_color = (float4)(0.0f, 0.0f, 0.0f, 0.0f);
-    r.outside = false;
-    r.last_step = (char4)(0,0,0,0);
+    ray_t r;
+    ray_init(w, &r, u, v);
 
     // FIXME assuming camera is always inside the grid
-    r.ray_color = color_ray(w, r, v, t);
+    r.ray_color = color_ray(w, r);
+#ifdef ENTITIES
+    ray_entities(w, &r);
+#endif
 
-    #define STEP(dim) do { \
-                        r.P.dim += step.dim; \
-                        r.last_step = (char4)(0,0,0,0); \
-                        r.last_step.dim = step.dim; \
-                        t = tmax.dim; \
-                        if (r.P.dim == justOut.dim) { \
-                            r.outside = true; \
-                        } else \
-                        tmax.dim += dt.dim; \
-                      } while (0)
-
-    for (uint iter_count = 0; iter_count < LOOP_LIMIT;
+    uint iter_count;
+    for (iter_count = 0; iter_count < LOOP_LIMIT;
          iter_count++)
     {
-
-        if (tmax.x < tmax.y) {
-            if (tmax.x < tmax.z) {
-                STEP(x);
-            } else {
-                STEP(z);
-            }
-        } else {
-            if (tmax.y < tmax.z) {
-                STEP(y);
-            } else {
-                STEP(z);
-            }
-        }
-
-        char portal_num = -1;
-        if (!r.outside &&
-            (portal_num = is_portal_block(grid_get(w, r.P))) != -1)
-        {
-            float16 portal = get_portal(w, portal_num);
-
-            // Step to the opposite (back) face of the portal
-            char steps = 1;
-            r.P = vec_add_i4_c4(r.P, r.last_step);
-            while (r.P.x != justOut.x &&
-                r.P.y != justOut.y &&
-                r.P.z != justOut.z &&
-                is_portal_block(grid_get(w, r.P)) != -1)
-            {
-                r.P = vec_add_i4_c4(r.P, r.last_step);
-                steps ++;
-            }
-            u = vec_add_f4_c4(u, vec_scale_c_c4(steps, r.last_step));
-
-            // Now apply the portal transformation
-            u = apply_matrix(portal, u);
-            v = apply_matrix(portal, v);
-            r.P = (int4)((int)(u.x + v.x*t),
-                         (int)(u.y + v.y*t),
-                         (int)(u.z + v.z*t),
-                         1);
-            RESET_STEP;
-            RESET_DT;
-            RESET_TMAX;
-
-            RESET_JUSTOUT;
-
-            /*if (r.P.x < 0 || r.P.x >= w.bounds.x ||
-                r.P.y < 0 || r.P.y >= w.bounds.y ||
-                r.P.z < 0 || r.P.z >= w.bounds.z)
-            {
-                r.ray_color = (float4)(0.0,1.0,0.0,1.0);
-            }*/
-
+        bool moved = ray_advance(w, &r);
+#ifdef ENTITIES
+        if (ray_entities(w, &r)) {
+            r.ray_color = shade_entity(r.ent_normal, r.v, r.ent_t);
+            break;
         }
+#endif
+        if (!moved)
+            continue;
 
-        r.ray_color = color_ray(w, r, v, t);
+        r.ray_color = color_ray(w, r);
 
         if (r.ray_color.w == 1.0f)
             break;
 
     }
 
+#ifdef HEATMAP
+    /* The loop only runs to the end if the ray never hit anything;
+       otherwise it broke out during iteration iter_count + 1, as counted
+       by raynp.trace */
+    bool limit_hit = iter_count == LOOP_LIMIT;
+    uint iterations = limit_hit ? LOOP_LIMIT : iter_count + 1;
+    stats[p_off] = (uint4)(iterations, r.crossings, limit_hit, 0);
+    write_imagef(bmp, p_pos, heat_color(iterations, limit_hit));
+#else
     write_imagef(bmp, p_pos, r.ray_color);
+#endif
+#ifdef REPROJECT
+    /* Only blocks seen without going through a portal can be reprojected,
+       not the black past the edge of the grid. Entities may have moved by
+       the next frame, so their hits are kept as BK_AIR: they still hide
+       what is behind them, but the pixels they land in are traced. */
+    uchar block_type = r.outside ? BK_WALL : grid_get(w, r.P);
+    float t = r.t;
+#ifdef ENTITIES
+    if (r.ent_t <= r.t) {
+        block_type = BK_AIR;
+        t = r.ent_t;
+    }
+#endif
+    hits_out[p_off] = pack_hit(block_type, r.last_step);
+    depth_out[p_off] = r.ray_color.w == 1.0f && r.crossings == 0 &&
+        (!r.outside || w.edge_type == ET_WALL) ? t : -1.0f;
+#endif
+}
+
+#ifdef REPROJECT
+/* The passes that work out which pixels raytrace can copy, each over the
+   pixels of the last frame: clear, then find the nearest hit point landing
+   in each pixel of the current view (and the furthest, for
+   reproject_disoccluded), then note which pixel it came from. The
+   distances are positive floats, so they compare the same as ints. */
+__kernel void reproject_clear(__global int *zbuf, __global int *zmax,
+    __global int *source)
+{
+    size_t i = get_global_id(0);
+    zbuf[i] = INT_MAX;
+    zmax[i] = 0;
+    source[i] = -1;
+}
+
+__kernel void reproject_depth(__global const float *depth,
+    __global const float4 *dirs, __constant float *cams,
+    __global int *zbuf, __global int *zmax)
+{
+    uint i = get_global_id(0);
+    float dist;
+    int q = reproject_pixel(i, depth, dirs, cams, &dist);
+    if (q >= 0) {
+        atomic_min(&zbuf[q], as_int(dist));
+        atomic_max(&zmax[q], as_int(dist));
+    }
+}
+
+__kernel void reproject_claim(__global const float *depth,
+    __global const float4 *dirs, __constant float *cams,
+    __global const int *zbuf, __global int *source)
+{
+    uint i = get_global_id(0);
+    float dist;
+    int q = reproject_pixel(i, depth, dirs, cams, &dist);
+    if (q >= 0 && zbuf[q] == as_int(dist))
+        source[q] = i;
+}
+#endif
+
+/* Batched ray casts for world.raycast_many. Ray i starts at origins[i]
+   (w = 1) and heads along the unit vector directions[i] (w = 0), through
+   portals, until it enters a solid block or gets further than max_dist.
+   For a hit, voxels[i] is the block's coordinates with w = 1 and
+   normals[i] the face normal with w = the distance along the ray;
+   for a miss voxels[i].w is 0. */
+__kernel void raycast(__global const float4 *origins,
+    __global const float4 *directions, float max_dist,
+    __global int4 *voxels, __global float4 *normals,
+    __constant int *mapinfo,
+    __global const uint *brick_index, __global const uchar *bricks,
+    __constant float *portals, __global const uchar *brick_dist,
+    __global const uint *exit_index, __global const uchar *portal_exits)
+{
+    world_t w = world_init(mapinfo, brick_index, bricks, portals,
+                           brick_dist, exit_index, portal_exits);
+    size_t i = get_global_id(0);
+
+    ray_t r;
+    ray_init(w, &r, origins[i], directions[i]);
+
+    voxels[i] = (int4)(-1, -1, -1, 0);
+    normals[i] = (float4)(0.0f, 0.0f, 0.0f, INFINITY);
+
+    for (uint iter_count = 0; iter_count < LOOP_LIMIT;
+         iter_count++)
+    {
+        bool moved = ray_advance(w, &r);
+        if (r.outside || r.t > max_dist)
+            return;
+        if (!moved)
+            continue;
+
+        uchar block_type = grid_get(w, r.P);
+        if (block_type != BK_AIR && is_portal_block(block_type) == -1) {
+            voxels[i] = (int4)(r.P.x, r.P.y, r.P.z, 1);
+            normals[i] = (float4)(-r.last_step.x, -r.last_step.y,
+                                  -r.last_step.z, r.t);
+            return;
+        }
+    }
 }
@@ -0,0 +1,74 @@
+"""
+Input recording and replay. A recording is everything the window sent to
+the world - key presses, clicks and mouse motion, and each advance() with
+the time step it was given - so replaying it into a fresh copy of the
+same world plays the session out exactly as it went, whatever the
+framerate of the replay, e.g. to reproduce a session with frame drops in
+a --headless benchmark run.
+
+A log file is a line of JSON describing the world it was recorded in,
+followed by a line of JSON per event: [seconds since the start, event,
+arguments...].
+"""
+import json
+import time
+
+# Events, and the world method each is passed on to
+EVENTS = {"key_down": "send_key_down",
+          "key_up": "send_key_up",
+          "click": "send_click",
+          "motion": "send_mouse_motion",
+          "advance": "advance"}
+
+def send(world, event, args):
+    """ send: pass an event on to the world """
+    getattr(world, EVENTS[event])(*args)
+
+class recorder(object):
+    """
+    Writes the events sent to a world to a log file. setup is a dict of
+    whatever it takes to make the same world again (map, crowd size...),
+    which load() hands back.
+    """
+    def __init__(self, fname, setup):
+        self.f = open(fname, "w")
+        self.f.write(json.dumps(setup) + "\n")
+        self.start = time.time()
+
+    def record(self, event, *args):
+        self.f.write(json.dumps([round(time.time() - self.start, 4),
+            event] + list(args)) + "\n")
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+def load(fname):
+    """ load: read a log file, returning the setup it was recorded with
+    and its frames: for each advance, the events sent before it and its
+    time step, as ([(event, args), ...], dt) """
+    f = open(fname, "r")
+    setup = json.loads(f.readline())
+    frames = []
+    events = []
+    for line in f:
+        entry = json.loads(line)
+        (event, args) = (entry[1], entry[2:])
+        if event == "advance":
+            frames.append((events, args[0]))
+            events = []
+        else:
+            # Keys come back from JSON as unicode
+            events.append((event, [str(a) if isinstance(a, basestring)
+                else a for a in args]))
+    f.close()
+    return (setup, frames)
+
+def play_frame(world, frame, dt=None):
+    """ play_frame: send a frame's events to the world and advance it by
+    its recorded time step, or by dt ms if given """
+    (events, recorded_dt) = frame
+    for (event, args) in events:
+        send(world, event, args)
+    world.advance(recorded_dt if dt is None else dt)
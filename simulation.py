@@ -0,0 +1,91 @@
+"""
+Fixed-timestep simulation: the world is advanced in steps of SIM_DT,
+however long frames take to render, so physics behaves the same at any
+framerate and a slow frame is caught up on in several ordinary steps
+rather than one huge one. Frames usually fall between two steps, so the
+camera is drawn where it would be that far through the step in progress,
+interpolated between where the last step started and ended.
+"""
+import math
+import contextlib
+
+SIM_RATE = 120 # Hz
+SIM_DT = 1000.0 / SIM_RATE # ms
+# Most steps to catch up on in one frame; time beyond that is dropped, so
+# that the simulation slows down rather than falling further and further
+# behind
+MAX_STEPS = 8
+# Camera moves longer than this in one step are jumps (through portals),
+# and are not interpolated
+JUMP_DIST = 1.0 # m
+
+class fixed_timestep(object):
+    """
+    Advances a world by whole steps of SIM_DT ms as real time passes.
+    Steps are taken with advance (world.advance unless given, e.g. to
+    record them).
+    """
+    def __init__(self, world, advance=None, step=SIM_DT,
+                 max_steps=MAX_STEPS):
+        self.world = world
+        self.step = step
+        self.max_steps = max_steps
+        self.advance_world = world.advance if advance is None else advance
+        # ms of real time not yet simulated, always less than a step
+        self.accumulator = 0.0
+        # Camera position at the start and end of the last step
+        self.last_pos = self.camera_pos()
+        self.pos = self.last_pos
+        # Steps taken, and ms of real time dropped by the catch-up cap
+        self.steps = 0
+        self.dropped = 0.0
+
+    def camera_pos(self):
+        cam = self.world.camera
+        return (cam.x, cam.y, cam.z)
+
+    def advance(self, dt):
+        """ advance: take as many steps as fit into dt ms more of real
+        time, up to max_steps; returns how many were taken """
+        self.accumulator += dt
+        n = 0
+        while self.accumulator >= self.step:
+            if n == self.max_steps:
+                self.dropped += self.accumulator
+                self.accumulator = 0.0
+                break
+            self.last_pos = self.camera_pos()
+            self.advance_world(self.step)
+            self.pos = self.camera_pos()
+            self.accumulator -= self.step
+            n += 1
+        self.steps += n
+        return n
+
+    def alpha(self):
+        """ alpha: how far through the step in progress real time is,
+        from 0 to 1 """
+        return self.accumulator / self.step
+
+    @contextlib.contextmanager
+    def interpolated(self):
+        """
+        `with sim.interpolated():' puts the camera alpha() of the way
+        from where the last step started to where it ended for the
+        block, e.g. while a frame is set up for rendering. Only its
+        position is interpolated: the mouse turns the camera between
+        steps, and should do so straight away.
+        """
+        cam = self.world.camera
+        pos = (cam.x, cam.y, cam.z)
+        # Anything that moved the camera since the last step (e.g. a
+        # teleport) is shown as it is
+        if pos == self.pos and math.sqrt(sum((a - b) ** 2 for (a, b)
+                in zip(self.last_pos, pos))) < JUMP_DIST:
+            s = self.alpha() - 1.0
+            (cam.x, cam.y, cam.z) = [b + s * (b - a) for (a, b)
+                in zip(self.last_pos, pos)]
+        try:
+            yield
+        finally:
+            (cam.x, cam.y, cam.z) = pos
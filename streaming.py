@@ -0,0 +1,371 @@
+"""
+Streaming worlds: maps too big to build or hold at once, whose bricks are
+loaded from a source (a procedural generator, or a map file) as the
+camera moves around.
+
+Only the bricks within STREAM_RADIUS of the camera are kept, in a brick
+pool of a fixed number of bricks, so the device buffer the renderer keeps
+of it never grows; when it is full, the least recently wanted brick is
+evicted to make room. Everything not loaded points at UNKNOWN_BRICK, so
+rays and physics see it as solid BK_UNKNOWN blocks until it arrives. A
+background thread loads the bricks the camera will want next - around
+it, and around where it is heading - and the world takes whatever has
+arrived at each advance(). Only the bricks right around the camera, which
+physics needs now, are ever loaded on the spot; the time spent doing that
+is reported as stall time.
+
+Loading and evicting bricks isn't an edit of the map: it bumps the world's
+residency_version rather than its map_version. It still changes the
+picture, so the next frame is traced in full rather than reprojected from
+one drawn before the bricks arrived. Without the background loader
+(background=False), every brick wanted is loaded on the spot, so what is
+loaded depends only on where the camera has been, and a recorded session
+replays the same frames.
+"""
+import math
+import time
+import Queue
+import threading
+import collections
+import numpy
+
+import world as wd
+
+# Bricks kept loaded around the camera, in each direction
+STREAM_RADIUS = 6
+# Bricks around the camera that are loaded on the spot if they haven't
+# arrived yet
+STALL_RADIUS = 1
+# Prefetch around where the camera will be this many seconds from now
+PREFETCH_AHEAD = 1.0 # s
+# Size of the brick pool. It needs to hold the non-empty bricks within
+# STREAM_RADIUS of the camera, or bricks that are still wanted get evicted
+POOL_BRICKS = 4096
+# Size of terrain_world, in cells
+TERRAIN_SIZE = (1024, 64, 1024)
+
+class terrain_source(object):
+    """
+    Rolling hills, made up as they are asked for: the ground height at
+    each column is a sum of sine waves with random directions and phases,
+    so any brick can be made on its own and always comes out the same.
+    """
+    def __init__(self, seed=0, height=24, waves=6):
+        rand = numpy.random.RandomState(seed)
+        self.base = height
+        angles = rand.uniform(0, 2 * math.pi, waves)
+        # Longer waves get bigger hills
+        lengths = rand.uniform(20, 200, waves)
+        self.kx = numpy.cos(angles) * 2 * math.pi / lengths
+        self.kz = numpy.sin(angles) * 2 * math.pi / lengths
+        self.amplitude = lengths / 20
+        self.phase = rand.uniform(0, 2 * math.pi, waves)
+
+    def height(self, x, z):
+        """ height: the ground height at (arrays of) x, z """
+        x = numpy.asarray(x, dtype=numpy.float64)[...,None]
+        z = numpy.asarray(z, dtype=numpy.float64)[...,None]
+        return self.base + numpy.sum(self.amplitude *
+            numpy.sin(x * self.kx + z * self.kz + self.phase), axis=-1)
+
+    def load(self, bx, by, bz):
+        """ load: the block types of the brick at brick position bx, by,
+        bz as an [x,y,z] array, or None if it is all air """
+        cells = numpy.arange(wd.BRICK_DIM)
+        (x, z) = numpy.meshgrid(bx * wd.BRICK_DIM + cells,
+            bz * wd.BRICK_DIM + cells, indexing="ij")
+        ground = numpy.floor(self.height(x, z)).astype(numpy.int64)
+        y = by * wd.BRICK_DIM + cells
+        if y[0] >= ground.max():
+            return None
+        # Grass on top of the hills, rock under it
+        blocks = numpy.where(y[None,:,None] < ground[:,None,:] - 1,
+            wd.BK_WALL, wd.BK_WALLG).astype(numpy.uint8)
+        blocks[y[None,:,None] >= ground[:,None,:]] = wd.BK_AIR
+        return blocks
+
+class world_source(object):
+    """ The bricks of another world, e.g. a testmaps.filemap """
+    def __init__(self, world):
+        self.world = world
+
+    def load(self, bx, by, bz):
+        corner = numpy.array((bx, by, bz)) << wd.BRICK_SHIFT
+        if self.world.brick_index[self.world.brick_off(*corner)] == \
+                wd.EMPTY_BRICK:
+            return None
+        return self.world.grid_read(corner, corner + wd.BRICK_DIM)
+
+class streaming_world(wd.world):
+    """
+    A world of the given size, in cells, whose bricks are loaded from
+    source (see terrain_source) around the camera as it moves. The
+    player starts at start, if given. Unless background, bricks are
+    loaded on the spot as soon as they are wanted.
+    """
+    def __init__(self, source, size, edge_type=wd.ET_WALL, start=None,
+                 pool_bricks=POOL_BRICKS, background=True):
+        self.source = source
+        self.size = size
+        self.map_edge_type = edge_type
+        self.pool_bricks = pool_bricks
+        wd.world.__init__(self)
+        if start is not None:
+            (self.player.x, self.player.y, self.player.z) = start
+
+        # Loaded bricks that take up a slot in the pool, least recently
+        # wanted first, as {brick_index offset: brick}
+        self.resident = collections.OrderedDict()
+        # Offsets of the loaded bricks that have been edited since, and
+        # the contents of edited bricks that have been evicted
+        self.modified = set()
+        self.edited = {}
+        # Offsets of the bricks that have changed between empty and not
+        # since brick_dist was last brought up to date
+        self.dist_changes = []
+        self.last_pos = None
+
+        # Bricks are loaded in the background from requests, nearest
+        # first, and come back through loaded; pending holds the offsets
+        # still wanted, so that requests the camera has since moved away
+        # from are dropped
+        self.requests = Queue.PriorityQueue()
+        self.loaded = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.loader = None
+        if background:
+            self.loader = threading.Thread(target=self.load_bricks)
+            self.loader.daemon = True
+            self.loader.start()
+
+        # Start off with the bricks right around the player, which
+        # doesn't count as stalling
+        self.reset_stream_stats()
+        self.update_stream(0)
+        self.reset_stream_stats()
+
+    def setup_map(self):
+        self.alloc_map(self.size[0], self.size[1], self.size[2],
+            self.map_edge_type)
+        self.brick_index[:] = wd.UNKNOWN_BRICK
+        # The whole pool up front, so that the device buffer never grows
+        self.bricks = numpy.zeros((self.pool_bricks, wd.BRICK_SZ),
+            dtype=numpy.uint8)
+        self.bricks[wd.UNKNOWN_BRICK] = wd.BK_UNKNOWN
+        self.free_bricks = range(self.pool_bricks - 1, self.n_bricks - 1, -1)
+        self.n_bricks = self.pool_bricks
+
+    def brick_pos(self, off):
+        """ brick_pos: the brick position of a brick_index offset """
+        (bx, by) = (self.mapinfo[wd.MI_BRICKS_X],
+                    self.mapinfo[wd.MI_BRICKS_Y])
+        return (off % bx, off // bx % by, off // (bx * by))
+
+    def bricks_around(self, x, y, z, radius):
+        """ bricks_around: brick_index offsets of the bricks within radius
+        bricks of the cell x, y, z, nearest first """
+        centre = numpy.floor((x, y, z)).astype(numpy.int64) >> wd.BRICK_SHIFT
+        bricks = self.mapinfo[wd.MI_BRICKS_X:wd.MI_BRICKS_Z+1]
+        (lo, hi) = (numpy.maximum(centre - radius, 0),
+                    numpy.minimum(centre + radius + 1, bricks))
+        if numpy.any(lo >= hi):
+            return numpy.zeros(0, dtype=numpy.int64)
+        (bx, by, bz) = [a.ravel() for a in numpy.meshgrid(
+            *[numpy.arange(l, h) for (l, h) in zip(lo, hi)], indexing="ij")]
+        order = numpy.argsort(numpy.maximum(numpy.maximum(
+            abs(bx - centre[0]), abs(by - centre[1])), abs(bz - centre[2])),
+            kind="mergesort")
+        return (bx + by * bricks[0] + bz * bricks[0] * bricks[1])[order]
+
+    def load_bricks(self):
+        """ load_bricks: the background loader's loop """
+        while True:
+            (dist, off) = self.requests.get()
+            if off is None:
+                return
+            with self.lock:
+                if off not in self.pending:
+                    continue
+            self.loaded.put((off, self.source.load(*self.brick_pos(off))))
+
+    def update_stream(self, t):
+        """
+        update_stream: take in the bricks the loader has finished, note
+        which of those around the camera were already loaded, ask for the
+        missing ones and those around where the camera is heading, and
+        load any right around the camera that still aren't there
+        """
+        cam = self.camera
+        pos = numpy.array((cam.x, cam.y, cam.z))
+        velocity = numpy.zeros(3)
+        if self.last_pos is not None and t > 0:
+            velocity = (pos - self.last_pos) / (t / 1000.0)
+        self.last_pos = pos
+
+        while True:
+            try:
+                (off, blocks) = self.loaded.get_nowait()
+            except Queue.Empty:
+                break
+            self.install(off, blocks)
+
+        wanted = self.bricks_around(cam.x, cam.y, cam.z, STREAM_RADIUS)
+        unknown = self.brick_index[wanted] == wd.UNKNOWN_BRICK
+        self.stream_hits += int(numpy.count_nonzero(~unknown))
+        self.stream_misses += int(numpy.count_nonzero(unknown))
+        for off in wanted[self.brick_index[wanted] > wd.UNKNOWN_BRICK]:
+            self.touch(off)
+        missing = list(wanted[unknown])
+        if velocity.any():
+            ahead = self.bricks_around(*(pos + velocity * PREFETCH_AHEAD),
+                radius=STREAM_RADIUS)
+            missing += list(ahead[self.brick_index[ahead] ==
+                wd.UNKNOWN_BRICK])
+
+        if self.loader is None:
+            self.load_now(missing)
+            return
+        with self.lock:
+            new = [off for off in missing if off not in self.pending]
+            self.pending = set(missing)
+        for (dist, off) in enumerate(new):
+            self.requests.put((dist, off))
+
+        self.load_now(self.bricks_around(cam.x, cam.y, cam.z, STALL_RADIUS))
+
+    def load_now(self, offs):
+        """ load_now: load any of the bricks at brick_index offsets offs
+        that aren't loaded, without waiting for the loader """
+        for off in offs:
+            if self.brick_index[off] == wd.UNKNOWN_BRICK:
+                start = time.time()
+                self.install(off, self.source.load(*self.brick_pos(off)))
+                self.stall_time += time.time() - start
+                self.stream_stalls += 1
+
+    def touch(self, off):
+        """ touch: make a loaded brick the most recently wanted """
+        if off in self.resident:
+            self.resident[off] = self.resident.pop(off)
+
+    def install(self, off, blocks):
+        """ install: put a loaded brick into the map at brick_index offset
+        off, unless it is there already """
+        if self.brick_index[off] != wd.UNKNOWN_BRICK:
+            return
+        if off in self.edited:
+            blocks = self.edited.pop(off)
+            self.modified.add(off)
+        if blocks is None or not blocks.any():
+            # Bricks not loaded count as filled, so this is the only
+            # change to brick_dist loading or evicting makes
+            brick = wd.EMPTY_BRICK
+            self.dist_changes.append(off)
+        else:
+            brick = self.alloc_brick()
+            self.brick_cells(brick)[:] = blocks
+            self.mark_resident('bricks', brick)
+            self.resident[off] = brick
+            if wd.portal_block(blocks).any():
+                self.portal_exits = None
+        self.brick_index[off] = brick
+        self.mark_resident('brick_index', off)
+        self.stream_loads += 1
+
+    def alloc_brick(self):
+        """ alloc_brick: take a free brick from the pool, evicting the
+        least recently wanted brick if there are none """
+        if not self.free_bricks:
+            (off, brick) = self.resident.popitem(last=False)
+            if off in self.modified:
+                self.edited[off] = self.brick_cells(brick).copy()
+                self.modified.discard(off)
+            if wd.portal_block(self.bricks[brick]).any():
+                self.portal_exits = None
+            self.brick_index[off] = wd.UNKNOWN_BRICK
+            self.mark_resident('brick_index', off)
+            self.free_bricks.append(brick)
+            self.stream_evictions += 1
+        brick = self.free_bricks.pop()
+        # Bricks come back from eviction still holding their old blocks,
+        # but edits of empty bricks expect an all air one
+        self.bricks[brick] = wd.BK_AIR
+        return brick
+
+    def track_edit(self, lo, hi):
+        """ track_edit: load the bricks overlapping the box of cells from
+        lo to hi before they are edited, and remember that they were, so
+        that the edits outlive the bricks being evicted """
+        offs = [off for (off, box, cells) in self.bricks_in_box(lo, hi)]
+        self.load_now(offs)
+        for off in offs:
+            self.touch(off)
+            self.modified.add(off)
+        return offs
+
+    def note_resident(self, offs):
+        """ note_resident: add any bricks an edit has just allocated to
+        the resident set """
+        for off in offs:
+            brick = self.brick_index[off]
+            if brick != wd.EMPTY_BRICK and off not in self.resident:
+                self.resident[off] = brick
+                self.dist_changes.append(off)
+
+    def brick_distances(self):
+        # Updated once for all the bricks loaded since it was last asked
+        # for, and only around them
+        self.update_brick_distances(self.dist_changes)
+        self.dist_changes = []
+        return wd.world.brick_distances(self)
+
+    def grid_set(self, x, y, z, v):
+        (x, y, z) = (wd.floor(x), wd.floor(y), wd.floor(z))
+        offs = self.track_edit((x, y, z), (x + 1, y + 1, z + 1))
+        wd.world.grid_set(self, x, y, z, v)
+        self.note_resident(offs)
+
+    def grid_write(self, lo, blocks, mask=None):
+        offs = self.track_edit(lo, numpy.add(lo, numpy.shape(blocks)))
+        wd.world.grid_write(self, lo, blocks, mask)
+        self.note_resident(offs)
+
+    def advance(self, t):
+        self.update_stream(t)
+        wd.world.advance(self, t)
+
+    def close(self):
+        """ close: stop the background loader """
+        if self.loader is not None:
+            self.requests.put((-1, None))
+            self.loader.join()
+
+    def reset_stream_stats(self):
+        self.stream_hits = 0
+        self.stream_misses = 0
+        self.stream_stalls = 0
+        self.stream_loads = 0
+        self.stream_evictions = 0
+        self.stall_time = 0.0
+
+    def stream_stats(self):
+        """ stream_stats: how streaming has gone since the stats were last
+        reset: the fraction of the bricks wanted around the camera that
+        were already loaded, seconds spent loading bricks on the spot, and
+        counts of bricks loaded and evicted """
+        wanted = self.stream_hits + self.stream_misses
+        return {"hit_rate": float(self.stream_hits) / max(wanted, 1),
+                "stall_time": self.stall_time,
+                "stalls": self.stream_stalls,
+                "loads": self.stream_loads,
+                "evictions": self.stream_evictions,
+                "resident": len(self.resident)}
+
+def terrain_world(seed=0, background=True):
+    """ terrain_world: a streaming world of terrain_source hills, with the
+    player standing in the middle """
+    source = terrain_source(seed)
+    (x, z) = (TERRAIN_SIZE[0] / 2 + 0.5, TERRAIN_SIZE[2] / 2 + 0.5)
+    return streaming_world(source, TERRAIN_SIZE,
+        start=(x, float(source.height(x, z)) + 2, z), background=background)
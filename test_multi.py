@@ -0,0 +1,41 @@
+"""
+Tests for balance.split_rows, which divides frames between devices for
+--multi-device.
+
+    python -m unittest discover -p "test_*.py"
+"""
+import unittest
+
+import balance
+
+class split_rows_test(unittest.TestCase):
+    def check_bands(self, rows, bands):
+        """ The bands are consecutive and cover all the rows """
+        y = 0
+        for (start, n) in bands:
+            self.assertEqual(start, y)
+            y += n
+        self.assertEqual(y, rows)
+
+    def test_proportional(self):
+        bands = balance.split_rows(480, [1.0, 2.0, 1.0])
+        self.check_bands(480, bands)
+        self.assertEqual([n for (y, n) in bands], [120, 240, 120])
+
+    def test_unequal_weights(self):
+        # A device thousands of times slower than the others still gets a
+        # row, wherever it is in the list
+        for weights in ([1e-4, 1.0, 1.0], [1.0, 1e-4, 1.0],
+                        [1.0, 1.0, 1e-4], [1e-6, 1e-6, 1.0, 1e-6],
+                        [5000.0, 1.0, 3.0, 0.01]):
+            bands = balance.split_rows(240, weights)
+            self.check_bands(240, bands)
+            self.assertTrue(all(n >= 1 for (y, n) in bands), bands)
+
+    def test_more_devices_than_rows(self):
+        bands = balance.split_rows(2, [1.0, 1e-3, 1e-3, 1.0])
+        self.check_bands(2, bands)
+        self.assertTrue(all(n >= 0 for (y, n) in bands), bands)
+
+if __name__ == "__main__":
+    unittest.main()
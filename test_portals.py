@@ -0,0 +1,59 @@
+"""
+Tests for portal blocks: the blocks of a portal with no matrix set are
+still portals, to the specialized OpenCL kernels as to everything else.
+
+    python -m unittest discover -p "test_*.py"
+"""
+import shutil
+import tempfile
+import unittest
+
+try:
+    import raycl
+except ImportError:
+    raycl = None
+import raynp
+import testmaps
+import world as wd
+
+# Blocks of a portal testmap1 doesn't set a matrix for
+UNSET_BOX = ((4, 0, 10), (8, 2, 14))
+
+class portal_block_test(unittest.TestCase):
+    def test_portals_in_use(self):
+        world = testmaps.testmap1()
+        self.assertEqual(world.portals_in_use(), world.portal_count())
+        world.fill_box(UNSET_BOX[0], UNSET_BOX[1], wd.BK_PORTAL[5])
+        self.assertEqual(world.portal_count(), 3)
+        self.assertEqual(world.portals_in_use(), 6)
+        world.fill_box(UNSET_BOX[0], UNSET_BOX[1], wd.BK_AIR)
+        self.assertEqual(world.portals_in_use(), 3)
+
+@unittest.skipIf(raycl is None, "pyopencl is not installed")
+class cl_portal_block_test(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = raycl.CACHE_DIR
+        raycl.CACHE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(raycl.CACHE_DIR)
+        raycl.CACHE_DIR = self.cache_dir
+
+    def test_specialized_matches_generic(self):
+        world = testmaps.testmap1()
+        world.fill_box(UNSET_BOX[0], UNSET_BOX[1], wd.BK_PORTAL[5])
+        world.physics_on = False
+        cam = world.camera
+        (cam.fov, cam.prev_fov, cam.target_fov) = (wd.FOV_360,) * 3
+        (cam.x, cam.y, cam.z) = (6.5, 3.5, 6.5)
+
+        frames = []
+        for specialize in (True, False):
+            renderer = raycl.raycl_offscreen((160, 120), world,
+                autotune=False, specialize=specialize)
+            renderer.execute()
+            frames.append(renderer.read_frame())
+        self.assertEqual(raynp.frame_diff(*frames), 0.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Tests for world.raycast_many, on the CPU and (with pyopencl) on the
+first OpenCL device.
+
+    python -m unittest discover -p "test_*.py"
+"""
+import shutil
+import tempfile
+import unittest
+import numpy
+
+try:
+    import raycl
+except ImportError:
+    raycl = None
+import testmaps
+
+def random_rays(world, n, seed=0):
+    rng = numpy.random.RandomState(seed)
+    size = numpy.array([world.x_size(), world.y_size(), world.z_size()])
+    origins = rng.uniform(0.1, 0.9, (n,3)) * size
+    directions = rng.normal(size=(n,3))
+    return (origins, directions)
+
+class raycast_test(object):
+    """ Cases run against both raycasters (see make_world) """
+    def make_world(self):
+        raise NotImplementedError
+
+    def test_degenerate_directions_miss(self):
+        world = self.make_world()
+        (origins, directions) = random_rays(world, 200)
+        bad = numpy.zeros(len(directions), dtype=bool)
+        bad[::7] = True
+        directions[0::7] = 0.0
+        directions[3::14] = numpy.nan
+        bad[3::14] = True
+
+        (hit, voxel, normal, dist) = world.raycast_many(origins, directions,
+            40.0)
+        self.assertFalse(hit[bad].any())
+        self.assertTrue((voxel[bad] == -1).all())
+        self.assertTrue((normal[bad] == 0).all())
+        self.assertTrue(numpy.isinf(dist[bad]).all())
+
+        # The other rays are cast as if the bad ones weren't there
+        expected = world.raycast_many(origins[~bad], directions[~bad], 40.0)
+        for (got, want) in zip((hit, voxel, normal, dist), expected):
+            self.assertTrue(numpy.array_equal(got[~bad], want))
+        self.assertTrue(hit[~bad].any())
+
+    def test_all_degenerate(self):
+        world = self.make_world()
+        (hit, voxel, normal, dist) = world.raycast_many(
+            [(5.5, 1.5, 5.5)] * 3, numpy.zeros((3,3)), 40.0)
+        self.assertEqual(hit.shape, (3,))
+        self.assertFalse(hit.any())
+        self.assertTrue(numpy.isinf(dist).all())
+
+class cpu_raycast_test(raycast_test, unittest.TestCase):
+    def make_world(self):
+        return testmaps.testmap1()
+
+@unittest.skipIf(raycl is None, "pyopencl is not installed")
+class cl_raycast_test(raycast_test, unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = raycl.CACHE_DIR
+        raycl.CACHE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(raycl.CACHE_DIR)
+        raycl.CACHE_DIR = self.cache_dir
+
+    def make_world(self):
+        world = testmaps.testmap1()
+        self.renderer = raycl.raycl_offscreen((64,48), world,
+            autotune=False)
+        return world
+
+if __name__ == "__main__":
+    unittest.main()
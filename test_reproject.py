@@ -0,0 +1,73 @@
+"""
+Tests for raycl's reprojection (--reproject): frames reusing the last one
+after small camera moves should look the same as frames traced in full.
+
+    python -m unittest discover -p "test_*.py"
+"""
+import shutil
+import tempfile
+import unittest
+
+try:
+    import raycl
+except ImportError:
+    raycl = None
+import raynp
+import testmaps
+import world as wd
+
+TEX_DIM = (160, 120)
+# Fraction of pixels a reprojected frame may differ from a full trace in
+MAX_DIFF = 0.01
+
+@unittest.skipIf(raycl is None, "pyopencl is not installed")
+class reproject_test(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = raycl.CACHE_DIR
+        raycl.CACHE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(raycl.CACHE_DIR)
+        raycl.CACHE_DIR = self.cache_dir
+
+    def walk(self, world, fov):
+        """ Walk and turn a little each frame for REPROJECT_FRAMES frames
+        after a full one, checking every frame against a full trace """
+        world.physics_on = False
+        cam = world.camera
+        (cam.fov, cam.prev_fov, cam.target_fov) = (fov, fov, fov)
+        (cam.x, cam.y, cam.z) = (0.3 * world.x_size() + 0.5, 1.5,
+            0.3 * world.z_size() + 0.5)
+        (cam.rot_x, cam.rot_y) = (0.8, 0.1)
+
+        reprojected = raycl.raycl_offscreen(TEX_DIM, world, autotune=False,
+            reproject=True)
+        traced = raycl.raycl_offscreen(TEX_DIM, world, autotune=False)
+        reprojected.execute()
+        for i in xrange(raycl.REPROJECT_FRAMES):
+            cam.x += 0.05
+            cam.z += 0.04
+            cam.rot_x += 0.01
+            cam.rot_y += 0.004
+            reprojected.execute()
+            traced.execute()
+            self.assertTrue(reprojected.reuse)
+            diff = raynp.frame_diff(reprojected.read_frame(),
+                traced.read_frame())
+            self.assertLess(diff, MAX_DIFF, "frame %d: %.2f%% of pixels "
+                "differ" % (i + 1, 100 * diff))
+
+    def test_testmap1(self):
+        self.walk(testmaps.testmap1(), wd.FOV_DEFAULT)
+
+    def test_testmap1_360(self):
+        self.walk(testmaps.testmap1(), wd.FOV_360)
+
+    def test_citymap(self):
+        self.walk(testmaps.citymap(), wd.FOV_DEFAULT)
+
+    def test_citymap_360(self):
+        self.walk(testmaps.citymap(), wd.FOV_360)
+
+if __name__ == "__main__":
+    unittest.main()
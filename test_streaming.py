@@ -0,0 +1,134 @@
+"""
+Tests for streaming worlds: loading bricks isn't an edit of the map, and
+without the background loader the same input loads the same bricks.
+
+    python -m unittest discover -p "test_*.py"
+"""
+import unittest
+import numpy
+
+import streaming
+import testmaps
+import world as wd
+
+STEP = 20.0 # ms
+
+def walk(world, steps):
+    """ Walk forward, turning now and then, for steps advances """
+    world.send_key_down('w', 0, 0)
+    for i in xrange(steps):
+        if i % 25 == 0:
+            world.send_mouse_motion(40, 0)
+        world.advance(STEP)
+    world.send_key_up('w', 0, 0)
+
+def small_terrain_world(pool_bricks):
+    """ A terrain_world whose brick pool holds only pool_bricks bricks,
+    too few for those around the camera """
+    source = streaming.terrain_source()
+    (x, z) = (streaming.TERRAIN_SIZE[0] / 2 + 0.5,
+              streaming.TERRAIN_SIZE[2] / 2 + 0.5)
+    return streaming.streaming_world(source, streaming.TERRAIN_SIZE,
+        start=(x, float(source.height(x, z)) + 2, z),
+        pool_bricks=pool_bricks, background=False)
+
+class streaming_test(unittest.TestCase):
+    def test_loading_is_not_an_edit(self):
+        world = streaming.terrain_world(background=False)
+        (map_version, residency_version) = (world.map_version,
+            world.residency_version)
+        view_key = world.view_key()
+        walk(world, 50)
+        self.assertEqual(world.map_version, map_version)
+        self.assertGreater(world.residency_version, residency_version)
+        self.assertNotEqual(world.view_key(), view_key)
+
+        # Once nothing more is loaded, nothing changes
+        view_key = world.view_key()
+        dist = world.entity_grid().dist
+        world.advance(STEP)
+        self.assertEqual(world.view_key(), view_key)
+        self.assertIs(world.entity_grid().dist, dist)
+
+        p = world.player
+        world.grid_set(p.x, p.y + 3, p.z, wd.BK_WALL)
+        self.assertGreater(world.map_version, map_version)
+
+    def test_foreground_loading_is_repeatable(self):
+        worlds = [streaming.terrain_world(background=False)
+            for i in xrange(2)]
+        for world in worlds:
+            walk(world, 200)
+            self.assertGreater(world.stream_stats()["loads"], 0)
+        (a, b) = worlds
+        self.assertEqual((a.player.x, a.player.y, a.player.z),
+            (b.player.x, b.player.y, b.player.z))
+        self.assertTrue(numpy.array_equal(a.brick_index, b.brick_index))
+        self.assertEqual(a.resident.keys(), b.resident.keys())
+        # Everything around the camera is loaded
+        wanted = a.bricks_around(a.camera.x, a.camera.y, a.camera.z,
+            streaming.STREAM_RADIUS)
+        self.assertFalse((a.brick_index[wanted] == wd.UNKNOWN_BRICK).any())
+    def test_edit_after_eviction(self):
+        world = small_terrain_world(256)
+        walk(world, 50)
+        self.assertGreater(world.stream_stats()["evictions"], 0)
+
+        # An empty brick right by the camera, which an edit allocates a
+        # recycled brick for
+        cam = world.camera
+        near = world.bricks_around(cam.x, cam.y, cam.z, 1)
+        off = near[world.brick_index[near] == wd.EMPTY_BRICK][0]
+        (x, y, z) = numpy.array(world.brick_pos(off)) << wd.BRICK_SHIFT
+        world.grid_set(x, y, z, wd.BK_WALL)
+        brick = world.brick_index[off]
+        self.assertNotEqual(brick, wd.EMPTY_BRICK)
+        self.assertEqual(numpy.count_nonzero(world.bricks[brick]), 1)
+        self.assertEqual(world.grid_get(x, y, z), wd.BK_WALL)
+
+    def test_brick_distances(self):
+        world = streaming.terrain_world(background=False)
+        for i in xrange(4):
+            walk(world, 50)
+            updated = world.brick_distances().copy()
+            world.brick_dist = None
+            self.assertTrue(numpy.array_equal(world.brick_distances(),
+                updated))
+
+class sparse_world(wd.world):
+    """ A big world with nothing in it, so that bricks are far apart """
+    def setup_map(self):
+        self.alloc_map(256, 64, 256, wd.ET_WALL)
+
+class brick_distance_test(unittest.TestCase):
+    def check_updates(self, world, steps):
+        """ Empty and fill random bricks, and boxes of them, checking
+        update_brick_distances against brick_distances worked out from
+        scratch each time """
+        rng = numpy.random.RandomState(0)
+        n = len(world.brick_index)
+        for i in xrange(steps):
+            world.brick_distances()
+            offs = rng.randint(0, n, rng.randint(1, 4))
+            filled = numpy.flatnonzero(world.brick_index != wd.EMPTY_BRICK)
+            if i % 2 == 1 and len(filled):
+                offs = rng.choice(filled, min(len(filled), 3), replace=False)
+            elif i % 3 == 0:
+                offs = numpy.arange(offs[0], min(offs[0] + 5, n))
+            full = world.brick_index[offs] != wd.EMPTY_BRICK
+            world.brick_index[offs] = numpy.where(full, wd.EMPTY_BRICK,
+                wd.UNKNOWN_BRICK)
+            world.update_brick_distances(offs)
+            updated = world.brick_dist.copy()
+            world.brick_dist = None
+            self.assertTrue(numpy.array_equal(world.brick_distances(),
+                updated), "step %d" % i)
+
+    def test_citymap(self):
+        self.check_updates(testmaps.citymap(), 30)
+
+    def test_sparse(self):
+        self.check_updates(sparse_world(), 60)
+
+if __name__ == "__main__":
+    unittest.main()
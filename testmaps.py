@@ -1,5 +1,6 @@
 from world import *
 import numpy
+import mapfile
 
 class testmap1(world):
     def setup_map(self):
@@ -17,21 +18,15 @@ class testmap1(world):
 
         ## Build a house in the x=32,z=0 corner
         # Wall facing +z
-        for x in xrange(24,31):
-            for y in xrange(0,5):
-                # with a window:
-                if x != 26 or y != 1:
-                    self.grid_set(x,y,5, BK_WALL)
+        self.fill_box((24,0,5), (31,5,6), BK_WALL)
+        # with a window:
+        self.grid_set(26,1,5, BK_AIR)
         # Ceiling
-        for x in xrange(24,31):
-            for z in xrange(0,5):
-                self.grid_set(x,5,z, BK_WALL)
+        self.fill_box((24,5,0), (31,6,5), BK_WALL)
         # Front:
-        for z in xrange(0,6):
-            for y in xrange(0,5):
-                # with a door:
-                if z != 2 or y > 1:
-                    self.grid_set(23,y,z, BK_WALL)
+        self.fill_box((23,0,0), (24,5,6), BK_WALL)
+        # with a door:
+        self.fill_box((23,0,2), (24,2,3), BK_AIR)
 
         # Set up a demonstration portal into a reflected universe on floor:
         self.set_portal(0, numpy.matrix([
@@ -39,39 +34,102 @@ class testmap1(world):
             [0, 1, 0, 10],
             [0, 0, 1, 0],
             [0, 0, 0, 1]]))
-        for x in xrange(8, 12):
-            for z in xrange(8, 12):
-                self.grid_set(x, 0, z, BK_PORTAL[0])
+        self.fill_box((8,0,8), (12,1,12), BK_PORTAL[0])
         
         ## Set up a pair of linked portals:
-        for x in xrange(20,22):
-            for z in xrange(20,22):
-                for y in xrange(0,3):
-                    self.grid_set(x, y, z, BK_PORTAL[1])
+        self.fill_box((20,0,20), (22,3,22), BK_PORTAL[1])
         # Put pillars around this portal:
         for y in xrange(0, 3):
             for (x,z) in [(19,19),(19,22),(22,19),(22,22)]:
                 self.grid_set(x, y, z, BK_WALL)
         # ... and a roof over it:
-        for x in xrange(19,23):
-            for z in xrange(19,23):
-                self.grid_set(x, 3, z, BK_WALL)
+        self.fill_box((19,3,19), (23,4,23), BK_WALL)
         self.set_portal(1, numpy.matrix([
             [1, 0, 0, -10],
             [0, 1, 0, 0],
             [0, 0, 1, 0],
             [0, 0, 0, 1]]))
 
-        for x in xrange(10, 12):
-            for z in xrange(20,22):
-                for y in xrange(0,3):
-                    self.grid_set(x, y, z, BK_PORTAL[2])
+        self.fill_box((10,0,20), (12,3,22), BK_PORTAL[2])
         # Put a wall behind this portal
-        for z in xrange(19,23):
-            for y in xrange(0,4):
-                self.grid_set(9, y, z, BK_WALLG)
+        self.fill_box((9,0,19), (10,4,23), BK_WALLG)
         self.set_portal(2, numpy.matrix([
             [1, 0, 0, 10],
             [0, 1, 0, 0],
             [0, 0, 1, 0],
             [0, 0, 0, 1]]))
+
+class openmap(world):
+    """ An empty map: every ray runs to the edge of the grid """
+    def setup_map(self):
+        world.setup_map(self)
+
+class pillarmap(world):
+    """ Randomly placed pillars of random height, always the same ones """
+    def setup_map(self):
+        world.setup_map(self)
+
+        rand = numpy.random.RandomState(1)
+        for i in xrange(60):
+            (x, z) = (rand.randint(2, self.x_size()),
+                      rand.randint(2, self.z_size()))
+            block = BK_WALL if rand.randint(2) else BK_WALLG
+            self.fill_box((x, 0, z),
+                (x + 1, rand.randint(1, self.y_size()), z + 1), block)
+
+class citymap(world):
+    """ A large map of tower blocks, far beyond what fitted in the old
+    16kb map buffer """
+    def setup_map(self):
+        self.alloc_map(256, 64, 256, ET_WALL)
+
+        rand = numpy.random.RandomState(2)
+        for bx in xrange(8, 256 - 16, 16):
+            for bz in xrange(8, 256 - 16, 16):
+                (w, d) = (rand.randint(3, 10), rand.randint(3, 10))
+                height = rand.randint(4, 60)
+                block = BK_WALL if rand.randint(2) else BK_WALLG
+                # A hollow box: walls and a roof
+                shell = numpy.ones((w, height, d), dtype=bool)
+                shell[1:-1,0:-1,1:-1] = False
+                self.set_mask((bx, 0, bz), shell, block)
+
+class portalmap(world):
+    """ An endless corridor: thick portal slabs across both ends of it
+    send anything going out of one end back in at the other, so rays
+    looking along it go through portal after portal """
+    def setup_map(self):
+        world.setup_map(self)
+
+        # Leaving the back of either slab comes out at the front of the
+        # other
+        self.set_portal(0, numpy.matrix([
+            [1, 0, 0, -25],
+            [0, 1, 0, 0],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1]]))
+        self.set_portal(1, numpy.matrix([
+            [1, 0, 0, 25],
+            [0, 1, 0, 0],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1]]))
+        size = (self.x_size(), self.y_size(), self.z_size())
+        self.fill_box((25, 0, 0), size, BK_PORTAL[0])
+        self.fill_box((0, 0, 0), (6,) + size[1:], BK_PORTAL[1])
+
+        # A few pillars to see down the corridor
+        rand = numpy.random.RandomState(3)
+        for i in xrange(6):
+            (x, z) = (rand.randint(8, 23), rand.randint(2, self.z_size()))
+            block = BK_WALL if rand.randint(2) else BK_WALLG
+            self.fill_box((x, 0, z),
+                (x + 1, rand.randint(1, self.y_size()), z + 1), block)
+
+class filemap(world):
+    """ A map saved with mapfile.save, loaded from fname """
+    def __init__(self, fname):
+        self.fname = fname
+        world.__init__(self)
+
+    def setup_map(self):
+        mapfile.load(self, self.fname)
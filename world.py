@@ -1,9 +1,12 @@
 
 import math
 import numpy 
-import ctypes
 
-import pyopencl as cl
+try:
+    import pyopencl as cl
+except ImportError:
+    # The numpy renderer (raynp) works without OpenCL
+    cl = None
 
 # Edge types - i.e. what you see at the end of the grid (world/map)
 ET_WALL = 0
@@ -14,6 +17,9 @@ ET_SOLID_AIR = 2
 BK_AIR = 0
 BK_WALL = 1
 BK_WALLG = 2
+# Fills the parts of a streaming world that are not loaded (see
+# UNKNOWN_BRICK)
+BK_UNKNOWN = 3
 # 246-255 reserved for BK_PORTAL[n]
 BK_PORTAL = [255 - x for x in xrange(0,9)]
 
@@ -25,12 +31,53 @@ FOV_360 = 2*math.pi
 WALK_SPEED = 4.0 # m/s
 JUMP_VELOCITY = 6.0 # m/s
 
-# Allocate 16kb for the map data. This is the most we can expect from most
-# cards (though some go up to 64kb).
-MAPDAT_SZ = 16*1024
-
-# Offset of the grid within mapdat
-GRID_OFF = 4
+# How far away the player can pick blocks with the mouse
+PICK_DIST = 5.0 # m
+
+# GLUT mouse buttons and states, as passed to send_click
+MOUSE_LEFT = 0
+MOUSE_RIGHT = 2
+MOUSE_DOWN = 0
+
+# The grid is stored as a brick map: it is divided into bricks of
+# BRICK_DIM^3 cells, and brick_index maps the position of each brick to
+# a brick in the brick pool. Bricks of nothing but air all share
+# EMPTY_BRICK, which is never written to, so only the parts of the map
+# with something in them take up memory. UNKNOWN_BRICK, all BK_UNKNOWN,
+# stands in the same way for the bricks of a streaming world that are not
+# loaded (see streaming.py), so that rays and physics treat them as solid.
+BRICK_SHIFT = 3
+BRICK_DIM = 1 << BRICK_SHIFT
+BRICK_MASK = BRICK_DIM - 1
+BRICK_SZ = BRICK_DIM ** 3
+EMPTY_BRICK = 0
+UNKNOWN_BRICK = 1
+
+# Layout of the mapinfo header
+MI_X_SIZE = 0
+MI_Y_SIZE = 1
+MI_Z_SIZE = 2
+MI_EDGE_TYPE = 3
+MI_BRICKS_X = 4
+MI_BRICKS_Y = 5
+MI_BRICKS_Z = 6
+MAPINFO_SZ = 8
+
+# Empty-space skipping: brick_dist holds, for every brick, the Chebyshev
+# distance (in bricks) to the nearest brick that is not EMPTY_BRICK, up
+# to this limit. A ray in a brick with distance d > 0 can jump straight
+# out of the cube of 2d-1 bricks around it, which is known to be all air.
+MAX_BRICK_DIST = 255
+
+# Portal crossings: a ray entering a portal cell is carried straight
+# through to the first cell past the portal volume along its step. The
+# number of steps that takes, for every portal cell and each of the
+# PORTAL_DIRS step directions (2*axis, +1 if the step is positive), is
+# kept in exit bricks laid out like the bricks of the brick pool.
+# exit_index maps the position of each brick to its exit brick, with
+# NO_EXITS (all zeros) shared by the bricks without portal cells.
+PORTAL_DIRS = 6
+NO_EXITS = 0
 
 def floor(x):
     return int(math.floor(x))
@@ -38,6 +85,11 @@ def floor(x):
 def blocking(block_type):
     return block_type != BK_AIR
 
+def portal_block(block_type):
+    """ portal_block: whether block_type (or each of an array of them) is
+    one of BK_PORTAL """
+    return (block_type >= BK_PORTAL[-1]) & (block_type <= BK_PORTAL[0])
+
 def v(x,y,z):
     return numpy.array([x,y,z])
 
@@ -70,7 +122,7 @@ class physical_object(world_object):
         # Height of the centre of the object over the floor
         self.hover_height = hover_height
 
-        # Used for rendering only?
+        # Size of the sphere the entity is drawn as
         self.radius = radius
 
         # These vectors allow us to change the size and orientation
@@ -120,6 +172,77 @@ class entity(physical_object):
         self.vel[1] = JUMP_VELOCITY * self.uy[1]
         self.vel[2] = JUMP_VELOCITY * self.uy[2]
 
+class entity_batch(object):
+    """
+    A crowd of entities stored as a structure of arrays: row i of each
+    array belongs to the i'th entity. Physics for the whole crowd is
+    resolved in vectorized passes, with the same results as advancing
+    each entity as a physical_object.
+    """
+    def __init__(self, world):
+        self.world = world
+        self.pos = numpy.zeros((0,3))
+        self.vel = numpy.zeros((0,3))
+        (self.ux, self.uy, self.uz) = (numpy.zeros((0,3)),
+                                       numpy.zeros((0,3)),
+                                       numpy.zeros((0,3)))
+        self.hover_height = numpy.zeros(0)
+        self.radius = numpy.zeros(0)
+        self.supported = numpy.zeros(0, dtype=bool)
+        # Bumped whenever the crowd moves, so renderers can tell whether
+        # it has since their last frame
+        self.version = 0
+
+    def __len__(self):
+        return len(self.pos)
+
+    def add(self, x, y, z, hover_height, radius):
+        """ add: add an entity and return its row number """
+        def append(a, row):
+            return numpy.concatenate((a, [row]))
+        self.pos = append(self.pos, (x, y, z))
+        self.vel = append(self.vel, (0.0, 0.0, 0.0))
+        self.ux = append(self.ux, (1, 0, 0))
+        self.uy = append(self.uy, (0, 1, 0))
+        self.uz = append(self.uz, (0, 0, 1))
+        self.hover_height = append(self.hover_height, hover_height)
+        self.radius = append(self.radius, radius)
+        self.supported = append(self.supported, False)
+        self.version += 1
+        return len(self) - 1
+
+    def scatter(self, n, hover_height, radius, seed=0):
+        """ scatter: add n entities at random places in the air """
+        rand = numpy.random.RandomState(seed)
+        size = (self.world.x_size(), self.world.y_size(), self.world.z_size())
+        added = 0
+        while added < n:
+            p = rand.uniform(0, 1, (n - added, 3)) * size
+            c = numpy.floor(p).astype(numpy.int64)
+            p = p[self.world.grid_get_many(c[:,0], c[:,1], c[:,2]) == BK_AIR]
+            for (x, y, z) in p:
+                self.add(x, y, z, hover_height, radius)
+            added += len(p)
+
+    def advance(self, t):
+        import physics
+        if not self.world.physics_on or len(self) == 0:
+            return
+
+        self.vel += self.uy * self.world.gravity * t / 1000.0
+        target = self.pos + self.vel * t / 1000.0
+
+        pos = physics.legal_move_many(self.world, self.pos, target,
+            self.uy, self.uz, self.hover_height)
+        if not numpy.array_equal(pos, self.pos):
+            self.version += 1
+        self.pos = pos
+
+        stopped = self.pos != target
+        self.vel[stopped] = 0.0
+        # FIXME: assumes down is in the Y direction!
+        self.supported = stopped[:,1]
+
 class camera(world_object):
     def __init__(self, world):
         world_object.__init__(self, world)
@@ -140,10 +263,23 @@ class camera(world_object):
         else:
             self.fov = (self.prev_fov + self.fov_trans_count *
                 (self.target_fov-self.prev_fov)/1000)
-    def fov_x(self):
-        return self.fov
-    def fov_y(self):
-        return self.fov if self.fov <= math.pi else math.pi
+    def fov_x(self, fov=None):
+        return self.fov if fov is None else fov
+    def fov_y(self, fov=None):
+        fov = self.fov if fov is None else fov
+        return fov if fov <= math.pi else math.pi
+    def fov_transition(self):
+        """ fov_transition: (from_fov, to_fov, s) - the FOV is s of the
+        way through a transition from from_fov to to_fov """
+        if self.target_fov == self.prev_fov:
+            return (self.fov, self.fov, 0.0)
+        return (self.prev_fov, self.target_fov,
+            (self.fov - self.prev_fov) / (self.target_fov - self.prev_fov))
+    def view_vector(self):
+        """ view_vector: unit vector along the centre of the view """
+        return (math.sin(self.rot_x) * math.cos(self.rot_y),
+                -math.sin(self.rot_y),
+                math.cos(self.rot_x) * math.cos(self.rot_y))
     def toggle_fov(self):
         # Toggles FOV only if there is no current transition!
         if self.fov == FOV_DEFAULT:
@@ -200,7 +336,27 @@ class player_character(entity, camera):
             camera.toggle_fov(self)
 
     def on_click(self, button, state, x, y):
-        pass
+        # Left click removes the block in the centre of the view, right
+        # click puts a wall block against the face of it we can see
+        if state != MOUSE_DOWN or button not in (MOUSE_LEFT, MOUSE_RIGHT):
+            return
+        (hit, voxel, normal, dist) = self.world.raycast_many(
+            [(self.x, self.y, self.z)], [self.view_vector()], PICK_DIST)
+        if not hit[0]:
+            return
+
+        if button == MOUSE_LEFT:
+            (x, y, z) = voxel[0]
+            self.world.grid_set(x, y, z, BK_AIR)
+        else:
+            (x, y, z) = voxel[0] + normal[0]
+            if self.world.in_grid(x, y, z) and not self.occupies(x, y, z):
+                self.world.grid_set(x, y, z, BK_WALL)
+
+    def occupies(self, x, y, z):
+        """ occupies: whether the player's body is in cell x,y,z """
+        return (x == floor(self.x) and z == floor(self.z) and
+            floor(self.y - self.hover_height) <= y <= floor(self.y))
 
     def on_mouse_motion(self, x, y):
         #print "Motion: %d, %d" % (x, y)
@@ -214,61 +370,529 @@ class player_character(entity, camera):
 
         #print "rot = (%f, %f)" % (self.rot_x, self.rot_y)
 
+class map_buffers(object):
+    """
+    The OpenCL copies of a world's map arrays in one context, and which
+    rows of them (bricks, brick_index entries, portals...) have changed
+    on the host since they were last written to the device.
+    """
+    # The world's map arrays, in the order the raytrace kernel takes them
+    ARRAYS = ('mapinfo', 'brick_index', 'bricks', 'portals', 'brick_dist',
+              'exit_index', 'portal_exits')
+
+    def __init__(self, world, ctx):
+        self.world = world
+        self.ctx = ctx
+        self.bufs = {}
+        self.dirty_rows = dict((name, set()) for name in self.ARRAYS)
+        self.dirty_all = set()
+        # Bytes written to the device by the last flush(), and in total
+        self.bytes_uploaded = 0
+        self.total_bytes_uploaded = 0
+
+        for name in self.ARRAYS:
+            self.bufs[name] = self.create_buffer(self.host_array(name))
+
+    def host_array(self, name):
+        if name == 'brick_dist':
+            return self.world.brick_distances()
+        if name == 'exit_index':
+            return self.world.portal_exit_table()[0]
+        if name == 'portal_exits':
+            return self.world.portal_exit_table()[1]
+        return getattr(self.world, name)
+
+    def create_buffer(self, host):
+        return cl.Buffer(self.ctx,
+            cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=host)
+
+    def mark(self, name, row):
+        self.dirty_rows[name].add(row)
+
+    def mark_all(self, name):
+        self.dirty_all.add(name)
+
+    def flush(self, queue):
+        """ flush: enqueue non-blocking writes of every changed span of
+        rows to the device. The host arrays may keep changing while the
+        writes are in flight; any rows changed since are marked dirty
+        again and go out with the next flush. """
+        self.bytes_uploaded = 0
+        for name in self.ARRAYS:
+            host = self.host_array(name)
+            rows = self.dirty_rows[name]
+            if host.nbytes > self.bufs[name].size:
+                # The array has grown (e.g. the brick pool), so it needs
+                # a bigger buffer
+                self.bufs[name] = self.create_buffer(host)
+                self.bytes_uploaded += host.nbytes
+            elif name in self.dirty_all:
+                cl.enqueue_copy(queue, self.bufs[name], host,
+                    is_blocking=False)
+                self.bytes_uploaded += host.nbytes
+            elif rows:
+                row_bytes = host.nbytes // len(host)
+                for (lo, hi) in spans(rows):
+                    cl.enqueue_copy(queue, self.bufs[name], host[lo:hi],
+                        device_offset=lo * row_bytes, is_blocking=False)
+                    self.bytes_uploaded += (hi - lo) * row_bytes
+            rows.clear()
+        self.dirty_all.clear()
+        self.total_bytes_uploaded += self.bytes_uploaded
+
+    def kernel_args(self):
+        return tuple(self.bufs[name] for name in self.ARRAYS)
+
+def spans(rows):
+    """ spans: the runs of consecutive numbers in a set of row numbers,
+    as sorted (start, end) pairs with exclusive ends """
+    result = []
+    for row in sorted(rows):
+        if result and result[-1][1] == row:
+            result[-1][1] = row + 1
+        else:
+            result.append([row, row + 1])
+    return result
+
 class world(object):
 
     def __init__(self):
+        # map_buffers to tell about changes to the map
+        self.uploads = []
+        # Renderer whose OpenCL context raycast_many runs on, if any
+        self.raycaster = None
+        # Bumped on every change to the map, so renderers can tell whether
+        # it has changed since their last frame
+        self.map_version = 0
+        # Bumped when the bricks of a streaming world (see streaming.py)
+        # are loaded or evicted, which changes what is drawn but isn't an
+        # edit of the map
+        self.residency_version = 0
+        # Bumped whenever brick_dist changes
+        self.brick_dist_version = 0
+
         self.setup_map()
 
         self.player = player_character(self, 0.5, 1.5, 0.5)
         self.camera = self.player
         self.entities = [self.player]
+        # NPCs, advanced together by vectorized physics
+        self.crowd = entity_batch(self)
+        # Where the renderers look for entities, built when first needed
+        self.ent_grid = None
         self.gravity = -10
 
         self.physics_on = True
 
     def init_cldata(self, ctx):
-        self.mapdat_clbuf = cl.Buffer(ctx,
-            cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
-            size=MAPDAT_SZ, hostbuf=self.mapdat)
-
-    def x_size(self): return self.mapdat[0]
-    def y_size(self): return self.mapdat[1]
-    def z_size(self): return self.mapdat[2]
-    def edge_type(self): return self.mapdat[3]
+        """ init_cldata: copy the map to the device, returning the
+        map_buffers that keep it up to date """
+        bufs = map_buffers(self, ctx)
+        self.uploads.append(bufs)
+        return bufs
+
+    def mark_dirty(self, name, row):
+        self.map_version += 1
+        for bufs in self.uploads:
+            bufs.mark(name, row)
+
+    def mark_resident(self, name, row):
+        """ mark_resident: mark_dirty for a brick being loaded or
+        evicted rather than edited """
+        self.residency_version += 1
+        for bufs in self.uploads:
+            bufs.mark(name, row)
+
+    def x_size(self): return int(self.mapinfo[MI_X_SIZE])
+    def y_size(self): return int(self.mapinfo[MI_Y_SIZE])
+    def z_size(self): return int(self.mapinfo[MI_Z_SIZE])
+    def edge_type(self): return int(self.mapinfo[MI_EDGE_TYPE])
+    def brick_off(self, x, y, z):
+        """ brick_off: offset into brick_index of the brick holding
+        integer cell coordinates x,y,z """
+        return ((x >> BRICK_SHIFT) +
+            (y >> BRICK_SHIFT) * self.mapinfo[MI_BRICKS_X] +
+            (z >> BRICK_SHIFT) * self.mapinfo[MI_BRICKS_X] *
+                self.mapinfo[MI_BRICKS_Y])
+    def cell_off(self, x, y, z):
+        """ cell_off: offset of integer cell coordinates x,y,z within
+        their brick """
+        return ((x & BRICK_MASK) +
+            ((y & BRICK_MASK) << BRICK_SHIFT) +
+            ((z & BRICK_MASK) << (2*BRICK_SHIFT)))
+    def in_grid(self, x, y, z):
+        return (0 <= x < self.x_size() and 0 <= y < self.y_size() and
+            0 <= z < self.z_size())
     def grid_get(self, x, y, z):
-        return self.mapdat[GRID_OFF + floor(x) +
-            floor(y) * self.x_size() +
-            floor(z) * self.x_size() * self.y_size()]
+        (x, y, z) = (floor(x), floor(y), floor(z))
+        brick = self.brick_index[self.brick_off(x, y, z)]
+        return int(self.bricks[brick, self.cell_off(x, y, z)])
     def grid_set(self, x, y, z, v):
-        self.mapdat[GRID_OFF + floor(x) +
-            floor(y) * self.x_size() +
-            floor(z) * self.x_size() * self.y_size()] = v
-    def get_portal_off(self):
-        return GRID_OFF + self.x_size() * self.y_size() * self.z_size()
+        (x, y, z) = (floor(x), floor(y), floor(z))
+        off = self.brick_off(x, y, z)
+        brick = self.brick_index[off]
+        if brick == EMPTY_BRICK:
+            if v == BK_AIR:
+                return
+            brick = self.alloc_brick()
+            self.brick_index[off] = brick
+            self.mark_dirty('brick_index', off)
+        cell = self.cell_off(x, y, z)
+        if portal_block(self.bricks[brick, cell]) or portal_block(v):
+            self.portal_exits = None
+        self.bricks[brick, cell] = v
+        self.mark_dirty('bricks', brick)
+    def grid_get_many(self, x, y, z):
+        """ grid_get_many: vectorized grid_get for arrays of integer
+        coordinates, which must all lie within the bounds of the grid """
+        brick = self.brick_index[self.brick_off(x, y, z)]
+        return self.bricks[brick, self.cell_off(x, y, z)]
+    def brick_cells(self, brick):
+        """ brick_cells: a (BRICK_DIM,)*3 view of the cells of a brick of
+        the pool, indexed [x,y,z] like grid_get. Writes through it go
+        straight into the pool, so they are not tracked: use grid_write
+        to change the map. """
+        return self.bricks[brick].reshape((BRICK_DIM,) * 3).T
+    def bricks_in_box(self, lo, hi):
+        """ bricks_in_box: for each brick overlapping the box of integer
+        cells from lo up to (but not including) hi, yield its offset into
+        brick_index, the slices of the box and of the brick it shares """
+        (lo, hi) = (numpy.array(lo), numpy.array(hi))
+        first = lo >> BRICK_SHIFT
+        last = (hi - 1) >> BRICK_SHIFT
+        for bz in xrange(first[2], last[2] + 1):
+            for by in xrange(first[1], last[1] + 1):
+                for bx in xrange(first[0], last[0] + 1):
+                    corner = numpy.array((bx, by, bz)) << BRICK_SHIFT
+                    start = numpy.maximum(lo, corner)
+                    end = numpy.minimum(hi, corner + BRICK_DIM)
+                    yield (self.brick_off(*corner),
+                        tuple(slice(a, b) for (a, b)
+                            in zip(start - lo, end - lo)),
+                        tuple(slice(a, b) for (a, b)
+                            in zip(start - corner, end - corner)))
+    def grid_read(self, lo, hi):
+        """ grid_read: the block types in the box of integer cells from lo
+        up to (but not including) hi, which must lie within the grid, as
+        a uint8 array indexed [x,y,z] """
+        result = numpy.zeros(numpy.subtract(hi, lo), dtype=numpy.uint8)
+        for (off, box, cells) in self.bricks_in_box(lo, hi):
+            brick = self.brick_index[off]
+            if brick != EMPTY_BRICK:
+                result[box] = self.brick_cells(brick)[cells]
+        return result
+    def occupancy(self, lo, hi):
+        """ occupancy: which cells of the box from lo to hi are blocking,
+        as a bool array indexed [x,y,z] """
+        return blocking(self.grid_read(lo, hi))
+    def grid_write(self, lo, blocks, mask=None):
+        """
+        grid_write: set the cells of the box starting at integer cell lo
+        the size of the [x,y,z] array blocks to blocks, or only those
+        where the bool array mask is set. The box must lie within the
+        grid. Does the same as grid_set on each of them, but a brick at a
+        time rather than a cell at a time.
+        """
+        blocks = numpy.asarray(blocks, dtype=numpy.uint8)
+        hi = numpy.add(lo, blocks.shape)
+        for (off, box, cells) in self.bricks_in_box(lo, hi):
+            new = blocks[box]
+            m = (numpy.ones(new.shape, dtype=bool) if mask is None else
+                mask[box])
+            brick = self.brick_index[off]
+            if brick == EMPTY_BRICK:
+                if not (m & (new != BK_AIR)).any():
+                    continue
+                brick = self.alloc_brick()
+                self.brick_index[off] = brick
+                self.mark_dirty('brick_index', off)
+            view = self.brick_cells(brick)[cells]
+            if portal_block(view[m]).any() or portal_block(new[m]).any():
+                self.portal_exits = None
+            view[m] = new[m]
+            self.mark_dirty('bricks', brick)
+    def fill_box(self, lo, hi, v):
+        """ fill_box: set every cell from integer cell lo up to (but not
+        including) hi to v """
+        self.grid_write(lo, numpy.full(numpy.subtract(hi, lo), v,
+            dtype=numpy.uint8))
+    def paste(self, lo, blocks, air=True):
+        """ paste: copy the [x,y,z] array of block types blocks into the
+        grid starting at integer cell lo; unless air, the air in blocks
+        leaves what is already in the grid """
+        mask = None if air else numpy.asarray(blocks) != BK_AIR
+        self.grid_write(lo, blocks, mask)
+    def set_mask(self, lo, mask, v):
+        """ set_mask: set the cells of the box starting at integer cell lo
+        where the [x,y,z] bool array mask is set to v """
+        self.grid_write(lo, numpy.full(numpy.shape(mask), v,
+            dtype=numpy.uint8), mask)
+    def alloc_brick(self):
+        """ alloc_brick: take a new (all air) brick from the pool,
+        growing it if necessary, and return its number """
+        if self.n_bricks == len(self.bricks):
+            self.bricks = numpy.concatenate((self.bricks,
+                numpy.zeros(self.bricks.shape, dtype=numpy.uint8)))
+        self.n_bricks += 1
+        self.brick_dist = None
+        return self.n_bricks - 1
+    def brick_distances(self):
+        """ brick_distances: the brick distance field used for
+        empty-space skipping (see MAX_BRICK_DIST), rebuilt if bricks have
+        been allocated since it was last asked for """
+        if self.brick_dist is None:
+            shape = (self.mapinfo[MI_BRICKS_Z], self.mapinfo[MI_BRICKS_Y],
+                     self.mapinfo[MI_BRICKS_X])
+            reached = (self.brick_index != EMPTY_BRICK).reshape(shape)
+            dist = numpy.where(reached, 0, MAX_BRICK_DIST).astype(
+                numpy.uint8)
+            # Grow the filled region by one brick in every direction (a
+            # cube, as the metric is Chebyshev) until nothing new is
+            # reached.
+            for d in xrange(1, MAX_BRICK_DIST):
+                grown = reached.copy()
+                for axis in xrange(3):
+                    a = numpy.swapaxes(grown, 0, axis)
+                    a[1:] |= a[:-1].copy()
+                    a[:-1] |= a[1:].copy()
+                grown &= ~reached
+                if not grown.any():
+                    break
+                dist[grown] = d
+                reached |= grown
+            self.brick_dist = dist.ravel()
+            self.brick_dist_version += 1
+            for bufs in self.uploads:
+                bufs.mark_all('brick_dist')
+        return self.brick_dist
+    def update_brick_distances(self, offs):
+        """ update_brick_distances: bring brick_dist up to date after the
+        bricks at brick_index offsets offs have changed between empty and
+        not, working out again only the part of it they can have changed """
+        if self.brick_dist is None or len(offs) == 0:
+            return
+        shape = numpy.array([self.mapinfo[MI_BRICKS_Z],
+            self.mapinfo[MI_BRICKS_Y], self.mapinfo[MI_BRICKS_X]])
+        dist = self.brick_dist.reshape(shape)
+        pos = numpy.array(numpy.unravel_index(numpy.asarray(offs,
+            dtype=numpy.int64), shape))
+        (lo, hi) = (pos.min(axis=1), pos.max(axis=1) + 1)
+        # Distances change by at most one from brick to brick, so once
+        # every brick in a shell around the changed ones is nearer to a
+        # filled brick than to them, nothing past the shell can have
+        # changed: grow the box of changed bricks out to there
+        r = 0
+        while True:
+            (a, b) = (numpy.maximum(lo - r - 1, 0),
+                      numpy.minimum(hi + r + 1, shape))
+            window = tuple(slice(i, j) for (i, j) in zip(a, b))
+            shell = numpy.ones(b - a, dtype=bool)
+            shell[tuple(slice(i, j) for (i, j) in zip(
+                numpy.maximum(lo - r, 0) - a,
+                numpy.minimum(hi + r, shape) - a))] = False
+            if not (dist[window][shell] > r).any():
+                break
+            r += 1
+
+        # Work the box out again from its filled bricks and the shell,
+        # which is right already and carries in the distances to the
+        # bricks past it, growing the nearest distances one brick at a
+        # time until they stop changing
+        old = dist[window]
+        new = numpy.where((self.brick_index != EMPTY_BRICK).reshape(
+            shape)[window], 0, MAX_BRICK_DIST).astype(numpy.int32)
+        new[shell] = numpy.minimum(new[shell], old[shell])
+        while True:
+            near = new.copy()
+            for axis in xrange(3):
+                v = numpy.swapaxes(near, 0, axis)
+                v[1:] = numpy.minimum(v[1:], v[:-1].copy())
+                v[:-1] = numpy.minimum(v[:-1], v[1:].copy())
+            grown = numpy.minimum(new, numpy.minimum(near + 1,
+                MAX_BRICK_DIST))
+            if numpy.array_equal(grown, new):
+                break
+            new = grown
+
+        changed = numpy.nonzero(new != old)
+        if len(changed[0]) == 0:
+            return
+        dist[window] = new
+        self.brick_dist_version += 1
+        rows = numpy.ravel_multi_index(tuple(i + start for (i, start) in
+            zip(changed, a)), shape)
+        for bufs in self.uploads:
+            for row in rows:
+                bufs.mark('brick_dist', row)
+    def portal_exit_table(self):
+        """ portal_exit_table: (exit_index, portal_exits) - see
+        PORTAL_DIRS - rebuilt if portal blocks have been placed or removed
+        since it was last asked for """
+        if self.portal_exits is None:
+            # Coordinates of every portal cell
+            bricks = numpy.nonzero((self.brick_index != EMPTY_BRICK) &
+                (self.brick_index != UNKNOWN_BRICK))[0]
+            (i, cell) = numpy.nonzero(portal_block(
+                self.bricks[self.brick_index[bricks]]))
+            (pos, cell) = (bricks[i], cell.astype(numpy.int32))
+            (bx, by) = (self.mapinfo[MI_BRICKS_X], self.mapinfo[MI_BRICKS_Y])
+            coords = numpy.column_stack((
+                (pos % bx) << BRICK_SHIFT | cell & BRICK_MASK,
+                (pos // bx % by) << BRICK_SHIFT |
+                    cell >> BRICK_SHIFT & BRICK_MASK,
+                (pos // (bx * by)) << BRICK_SHIFT |
+                    cell >> 2*BRICK_SHIFT)).astype(numpy.int32)
+
+            (used, rows) = numpy.unique(pos, return_inverse=True)
+            rows += 1
+            exit_index = numpy.zeros(len(self.brick_index),
+                dtype=numpy.uint32)
+            exit_index[used] = numpy.arange(1, len(used) + 1)
+            exits = numpy.zeros((len(used) + 1, PORTAL_DIRS * BRICK_SZ),
+                dtype=numpy.uint8)
+
+            for axis in xrange(3):
+                # Sort the cells into lines along the axis, and split
+                # each line into runs of neighbouring cells
+                others = [a for a in xrange(3) if a != axis]
+                order = numpy.lexsort((coords[:,axis],
+                    coords[:,others[1]], coords[:,others[0]]))
+                c = coords[order]
+                new_run = numpy.ones(len(c), dtype=bool)
+                new_run[1:] = (numpy.any(c[1:,others] != c[:-1,others],
+                    axis=1) | (c[1:,axis] != c[:-1,axis] + 1))
+                starts = numpy.nonzero(new_run)[0]
+                ends = numpy.append(starts[1:], len(c))
+                run = numpy.cumsum(new_run) - 1
+                n = numpy.arange(len(c))
+                for (d, steps) in ((2*axis, n - starts[run] + 1),
+                                   (2*axis + 1, ends[run] - n)):
+                    exits[rows[order], d * BRICK_SZ + cell[order]] = \
+                        numpy.minimum(steps, 255)
+
+            (self.exit_index, self.portal_exits) = (exit_index, exits)
+            for bufs in self.uploads:
+                bufs.mark_all('exit_index')
+                bufs.mark_all('portal_exits')
+        return (self.exit_index, self.portal_exits)
+    def raycast_many(self, origins, directions, max_dist):
+        """
+        raycast_many: cast a ray from each of the (N,3) points origins
+        along the matching (N,3) directions, following portals the same way
+        the renderer does, until it enters a solid block or gets further
+        than max_dist. Returns (hit, voxel, normal, dist) - see
+        raynp.raycast. Rays with a zero-length (or non-finite) direction
+        go nowhere, and miss. Runs on the renderer's OpenCL device if it
+        has set itself as the raycaster, otherwise vectorized on the CPU.
+        """
+        origins = numpy.asarray(origins, dtype=numpy.float32).reshape(-1, 3)
+        directions = numpy.asarray(directions,
+            dtype=numpy.float32).reshape(-1, 3)
+        n = len(origins)
+        length = numpy.sqrt(numpy.sum(directions.astype(numpy.float64) ** 2,
+            axis=1))
+        cast = numpy.isfinite(length) & (length > 0)
+
+        hit = numpy.zeros(n, dtype=bool)
+        voxel = numpy.empty((n,3), dtype=numpy.int32)
+        voxel[:] = -1
+        normal = numpy.zeros((n,3), dtype=numpy.int32)
+        dist = numpy.empty(n, dtype=numpy.float32)
+        dist[:] = numpy.inf
+        m = int(cast.sum())
+        if m == 0:
+            return (hit, voxel, normal, dist)
+
+        u = numpy.ones((m,4), dtype=numpy.float32)
+        u[:,0:3] = origins[cast]
+        v = numpy.zeros((m,4), dtype=numpy.float32)
+        v[:,0:3] = directions[cast] / length[cast,None]
+
+        if self.raycaster is not None:
+            results = self.raycaster.raycast(u, v, max_dist)
+        else:
+            import raynp
+            results = raynp.raycast(self, u, v, max_dist)
+        for (whole, cast_part) in zip((hit, voxel, normal, dist), results):
+            whole[cast] = cast_part
+        return (hit, voxel, normal, dist)
     def get_portal(self, i):
-        flts = ctypes.cast(ctypes.byref(self.mapdat, self.get_portal_off() + 64*i),
-            ctypes.POINTER(ctypes.c_float))
-        return numpy.matrix([flts[0:4], flts[4:8], flts[8:12], flts[12:16]])
+        return numpy.matrix(self.portals[i])
+    def portal_count(self):
+        """ portal_count: one more than the highest numbered portal that
+        has a matrix set, or 0 if there are none """
+        used = numpy.nonzero(self.portals.reshape(len(BK_PORTAL), -1).any(
+            axis=1))[0]
+        return int(used[-1]) + 1 if len(used) else 0
+    def portals_in_use(self):
+        """ portals_in_use: one more than the highest numbered portal that
+        has a matrix set or any blocks in the map, or 0 if there are none """
+        exit_index = self.portal_exit_table()[0]
+        if self.portal_blocks[0] is not exit_index:
+            # Only bricks with exits hold portal blocks
+            blocks = self.bricks[self.brick_index[
+                numpy.flatnonzero(exit_index)]]
+            numbers = BK_PORTAL[0] - blocks[portal_block(blocks)].astype(
+                numpy.int32)
+            self.portal_blocks = (exit_index,
+                int(numbers.max()) + 1 if len(numbers) else 0)
+        return max(self.portal_count(), self.portal_blocks[1])
     def set_portal(self, i, portal):
-        flts = ctypes.cast(ctypes.byref(self.mapdat, self.get_portal_off() + 64*i),
-            ctypes.POINTER(ctypes.c_float))
-        for x in xrange(0,4):
-            for y in xrange(0,4):
-                flts[x + y*4] = portal[y,x]
+        self.portals[i] = portal
+        self.mark_dirty('portals', i)
+
+    def alloc_map(self, x_size, y_size, z_size, edge_type):
+        """ alloc_map: set up an empty map of the given size """
+        bricks = [(d + BRICK_MASK) >> BRICK_SHIFT
+            for d in (x_size, y_size, z_size)]
+
+        self.mapinfo = numpy.zeros(MAPINFO_SZ, dtype=numpy.int32)
+        self.mapinfo[MI_X_SIZE:MI_Z_SIZE+1] = (x_size, y_size, z_size)
+        self.mapinfo[MI_EDGE_TYPE] = edge_type
+        self.mapinfo[MI_BRICKS_X:MI_BRICKS_Z+1] = bricks
+
+        self.brick_index = numpy.zeros(bricks[0] * bricks[1] * bricks[2],
+            dtype=numpy.uint32)
+        # The pool starts out holding only EMPTY_BRICK and UNKNOWN_BRICK,
+        # and doubles in size whenever it runs out
+        self.bricks = numpy.zeros((2, BRICK_SZ), dtype=numpy.uint8)
+        self.bricks[UNKNOWN_BRICK] = BK_UNKNOWN
+        self.n_bricks = 2
+        self.brick_dist = None
+        self.portal_exits = None
+        # The exit_index portals_in_use last looked through for portal
+        # blocks, and what it found
+        self.portal_blocks = (None, 0)
+        self.map_version += 1
+
+        # Portal matrices, each stored row by row
+        self.portals = numpy.zeros((len(BK_PORTAL), 4, 4),
+            dtype=numpy.float32)
 
     def setup_map(self):
-        # Create the array to use as the map data
-        self.mapdat = (ctypes.c_byte*MAPDAT_SZ)(0)
-
-        ## Set up mapdat header
-        self.mapdat[0] = 31      # x_size
-        self.mapdat[1] = 16      # y_size
-        self.mapdat[2] = 31      # z_size
-        self.mapdat[3] = ET_WALL # edge_type
-        
+        self.alloc_map(31, 16, 31, ET_WALL)
+
         # Subclasses are to call this function and
         # then place blocks in the grid
 
+    def view_key(self):
+        """ view_key: everything a rendered frame depends on, so that
+        two frames with equal keys are the same picture """
+        cam = self.camera
+        return (cam.x, cam.y, cam.z, cam.rot_x, cam.rot_y,
+                cam.fov, cam.prev_fov, cam.target_fov, self.map_version,
+                self.residency_version, self.crowd.version)
+
+    def entity_grid(self):
+        """ entity_grid: the entitygrid.entity_grid the renderers find
+        entities to draw in, brought up to date """
+        import entitygrid
+        if self.ent_grid is None:
+            self.ent_grid = entitygrid.entity_grid(self)
+        self.ent_grid.update()
+        return self.ent_grid
+
     def legal_move(self, wo, x, y, z):
         """ legal_move: return the next position of an attempted move
         of wo (a world_object) from its current position to x,y,z """
@@ -279,6 +903,11 @@ class world(object):
         """ Advance the world t ms """
         for e in self.entities:
             e.advance(t)
+        self.crowd.advance(t)
+
+    def close(self):
+        """ close: stop anything the world runs in the background """
+        pass
 
     def send_key_down(self, key, x, y):
         self.player.on_key_down(key, x, y)